@@ -1,4 +1,5 @@
 import os
+import click
 from functools import wraps
 from flask import Flask, render_template, redirect, url_for, flash, session, request
 from dotenv import load_dotenv
@@ -32,7 +33,44 @@ def create_app():
     app.config['SECRET_KEY'] = 'your_super_secret_key'
     app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///library.db'
     app.config['UPLOAD_FOLDER'] = 'uploads'
+    # Browser cache lifetimes: downloads (private) and unversioned upload URLs.
+    app.config['DOWNLOAD_CACHE_SECONDS'] = 3600
+    app.config['UPLOAD_CACHE_SECONDS'] = 3600
+    # Let the proxy send files after the app's checks: None (the app streams
+    # them), 'x-accel' (nginx X-Accel-Redirect to an internal location
+    # aliased to UPLOAD_FOLDER) or 'x-sendfile'.
+    app.config['FILE_OFFLOAD'] = os.getenv('FILE_OFFLOAD') or None
+    app.config['FILE_OFFLOAD_PREFIX'] = '/protected-uploads/'
+    # Serve uploaded images only through signed URLs expiring after one to
+    # two periods of UPLOAD_URL_SECONDS.
+    app.config['UPLOAD_URLS_SIGNED'] = False
+    app.config['UPLOAD_URL_SECONDS'] = 3600
+    # Time queries and templates per request and send a Server-Timing
+    # header; repeated statements are logged as N+1 suspects.
+    app.config['SERVER_TIMING'] = os.getenv('SERVER_TIMING') == '1'
+    # Where each worker process leaves its metrics for /metrics to add up;
+    # None when the server runs a single process.
+    app.config['METRICS_DIR'] = os.getenv('METRICS_DIR') or None
+    app.config['METRICS_TOKEN'] = os.getenv('METRICS_TOKEN') or None
+    # Statements slower than this are kept with their query plan for
+    # /admin/slow-queries (None: off); also logged to a file when set.
+    app.config['SLOW_QUERY_MS'] = 100
+    app.config['SLOW_QUERY_LOG_FILE'] = os.getenv('SLOW_QUERY_LOG_FILE') or None
     app.config['LANGUAGES'] = ['en', 'zu']
+    # 'sql' searches the FTS5 table; 'memory' uses the in-process BM25 index.
+    app.config['SEARCH_BACKEND'] = os.getenv('SEARCH_BACKEND', 'sql')
+    app.config['SUGGEST_CACHE_SECONDS'] = 300
+    # Days of raw log rows to keep (None: forever). Older rows are moved to
+    # gzipped monthly files under ARCHIVE_FOLDER by `flask apply-retention`;
+    # the rollups keep their counts.
+    app.config['LOG_RETENTION_DAYS'] = {
+        'download_log': 365,
+        'search_history': 365,
+        'search_query_log': 90,
+    }
+    app.config['ROLLUP_HOURLY_RETENTION_DAYS'] = 90
+    app.config['ARCHIVE_FOLDER'] = 'archive'
+    app.config['RETENTION_BATCH_SIZE'] = 1000
 
     app.config['MAIL_SERVER'] = 'smtp.googlemail.com'
     app.config['MAIL_PORT'] = 587
@@ -44,6 +82,39 @@ def create_app():
     db.init_app(app)
     mail.init_app(app)
 
+    from services.search_engine import search_index
+    from services.suggestions import suggestion_index
+    from services.result_cache import result_cache
+    from services.extraction import text_extractor
+    from services.spelling import spelling_index
+    from services.log_writer import log_writer
+    from services.rollups import rollups
+    from services.trends import search_trends
+    from services.storage import blob_store
+    from services.previews import previews
+    from services.chunked_uploads import chunked_uploads
+    from services.assets import assets
+    from services.principals import principals
+    from services.instrumentation import request_timings
+    from services.metrics import metrics
+    from services.slow_queries import slow_queries
+    search_index.init_app(app)
+    suggestion_index.init_app(app)
+    spelling_index.init_app(app)
+    result_cache.init_app(app)
+    text_extractor.init_app(app)
+    log_writer.init_app(app)
+    rollups.init_app(app)
+    search_trends.init_app(app)
+    blob_store.init_app(app)
+    previews.init_app(app)
+    chunked_uploads.init_app(app)
+    assets.init_app(app)
+    principals.init_app(app)
+    request_timings.init_app(app)
+    metrics.init_app(app)
+    slow_queries.init_app(app)
+
     def get_locale():
         if 'language' in session:
             return session['language']
@@ -57,7 +128,8 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        return db.session.get(User, int(user_id))
+        # A cached Principal, not the User row; routes load that on demand.
+        return principals.get(user_id)
 
     # --- CLI COMMANDS ---
     # FIXED: Restored the full create-admin function
@@ -84,6 +156,101 @@ def create_app():
         db.session.commit()
         print(f"Admin user '{username}' created successfully!")
 
+    @app.cli.command("rebuild-search-index")
+    def rebuild_search_index():
+        """Rebuilds the full-text search index from the resource table."""
+        from services.fts import rebuild_fts
+        count = rebuild_fts()
+        print(f"Search index rebuilt with {count} resources.")
+
+    @app.cli.command("rebuild-rollups")
+    def rebuild_rollups():
+        """Recomputes the analytics rollups from the raw log tables."""
+        from services.rollups import rollups
+        count = rollups.rebuild()
+        print(f"Rollups rebuilt from {count} log rows.")
+
+    @app.cli.command("apply-retention")
+    @click.option('--dry-run', is_flag=True,
+                  help='Only report what would be archived.')
+    @click.option('--vacuum', is_flag=True,
+                  help='VACUUM afterwards to return the space to the filesystem.')
+    def apply_retention_command(dry_run, vacuum):
+        """Archives and deletes log rows past their retention period."""
+        from services.retention import apply_retention
+        apply_retention(app, dry_run=dry_run, vacuum=vacuum)
+
+    @app.cli.command("sweep-blobs")
+    @click.option('--grace', type=int, default=None,
+                  help='Seconds a blob must be unreferenced (default: BLOB_GRACE_SECONDS).')
+    @click.option('--dry-run', is_flag=True,
+                  help='Only report what would be deleted.')
+    def sweep_blobs(grace, dry_run):
+        """Deletes uploaded files no resource references any more."""
+        count, size = blob_store.sweep(grace=grace, dry_run=dry_run)
+        verb = 'Would delete' if dry_run else 'Deleted'
+        print(f"{verb} {count} files ({size / 1024:.1f} KiB).")
+
+    @app.cli.command("import-uploads")
+    def import_uploads():
+        """Moves files stored under their upload name into the blob store."""
+        moved, merged, unreferenced = blob_store.import_legacy()
+        print(f"Imported {moved} files, {merged} of them duplicates; "
+              f"{len(unreferenced)} unreferenced files left in place.")
+
+    @app.cli.command("build-previews")
+    @click.option('--workers', type=int, default=None,
+                  help='Worker processes (default: PREVIEW_WORKERS).')
+    @click.option('--force', is_flag=True,
+                  help='Render again images that already have previews.')
+    def build_previews(workers, force):
+        """Renders the resized preview images missing on disk."""
+        rendered, unreadable = previews.backfill(workers=workers, force=force)
+        print(f"Rendered previews of {rendered} images; {unreadable} could not be read.")
+
+    @app.cli.command("build-assets")
+    def build_assets():
+        """Minifies and fingerprints the stylesheets and scripts."""
+        manifest = assets.build()
+        print(f"Built {len(manifest['assets'])} assets.")
+
+    @app.cli.command("vendor-assets")
+    def vendor_assets():
+        """Downloads the CDN stylesheets, scripts and fonts to static/vendor."""
+        import requests
+
+        def fetch(url):
+            # Google Fonts only sends woff2 to browsers that ask like one.
+            response = requests.get(url, timeout=30, headers={
+                'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:128.0) Gecko/20100101 Firefox/128.0'})
+            response.raise_for_status()
+            return response.content
+
+        for path in assets.vendor(fetch):
+            print(path)
+
+    @app.cli.command("benchmark-year-filters")
+    @click.option('--rows', type=int, default=500000,
+                  help='Size of the generated catalogue.')
+    def benchmark_year_filters(rows):
+        """Compares year filter query plans on a generated catalogue."""
+        from services.benchmark import year_filter_benchmark
+        year_filter_benchmark(rows)
+
+    @app.cli.command("extract-text")
+    @click.option('--retry-failed', is_flag=True,
+                  help='Also retry files whose extraction failed.')
+    @click.option('--workers', type=int, default=None,
+                  help='Worker processes (default: EXTRACTION_WORKERS).')
+    def extract_text(retry_failed, workers):
+        """Extracts the searchable text of uploaded files not processed yet."""
+        from services.extraction import backfill
+        counts = backfill(app, retry_failed=retry_failed, workers=workers)
+        if not counts:
+            print("All resources are already extracted.")
+        for status, count in sorted(counts.items()):
+            print(f"{status}: {count}")
+
     # --- BLUEPRINTS ---
     from routes.auth import auth_bp
     from routes.admin import admin_bp
@@ -98,6 +265,12 @@ def create_app():
     # --- CREATE DATABASE TABLES ---
     with app.app_context():
         db.create_all()
+        from services.schema import upgrade_schema
+        upgrade_schema()
+        from services.fts import init_fts
+        init_fts()
+        rollups.build_if_empty()
+        suggestion_index.build()
 
     return app
 
@@ -108,4 +281,7 @@ if __name__ == '__main__':
     local_app.run(debug=True)
 
 
-app = create_app()
+# Spawned pool workers (services/processes.py) re-run this script as
+# __mp_main__; they need none of the app.
+if __name__ != '__mp_main__':
+    app = create_app()
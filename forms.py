@@ -1,5 +1,5 @@
 from flask_wtf import FlaskForm
-from wtforms import StringField, PasswordField, SubmitField, TextAreaField, DateField, SelectField, IntegerField, BooleanField, SelectMultipleField
+from wtforms import StringField, PasswordField, SubmitField, TextAreaField, DateField, SelectField, IntegerField, BooleanField, SelectMultipleField, HiddenField
 from wtforms.validators import DataRequired, Email, EqualTo, Length, ValidationError, Regexp, Optional
 from wtforms.widgets import ListWidget, CheckboxInput
 from flask_wtf.file import FileField, FileAllowed
@@ -7,6 +7,8 @@ from models import User, Category
 from flask_babel import lazy_gettext as _l
 from datetime import date, datetime
 
+RESOURCE_FILE_EXTENSIONS = ['pdf', 'epub', 'html']
+
 # --- Custom Validators ---
 
 
@@ -99,9 +101,11 @@ class ResourceForm(FlaskForm):
 
     resource_file = FileField(_l('Resource File'), validators=[
         DataRequired(),
-        FileAllowed(['pdf', 'epub', 'html'],
+        FileAllowed(RESOURCE_FILE_EXTENSIONS,
                     _l('Only PDF, EPUB, and HTML files are allowed!'))
     ])
+    # Set instead of resource_file when the file was sent in chunks
+    upload_id = HiddenField()
     preview_image = FileField(_l('Preview Image (Optional, JPG/PNG)'), validators=[
         FileAllowed(['jpg', 'png', 'jpeg'], _l(
             'Only image files are allowed!'))
@@ -122,11 +126,13 @@ class CategoryForm(FlaskForm):
 
 
 class AdvancedSearchForm(FlaskForm):
-    term1 = StringField(_l('Search Term'), validators=[DataRequired()])
+    query = StringField(_l('Query'), validators=[Optional(), Length(max=500)])
+    term1 = StringField(_l('Search Term'), validators=[Optional()])
     field1 = SelectField(_l('in'), choices=[
         ('all', _l('All Metadata')), ('title', _l(
             'Title')), ('creator', _l('Creator/Author')),
-        ('subject', _l('Subject')), ('description', _l('Description/Abstract'))
+        ('subject', _l('Subject')), ('description', _l('Description/Abstract')),
+        ('body', _l('Full Text'))
     ])
     op2 = SelectField(_l('Operator'), choices=[
                       ('AND', 'AND'), ('OR', 'OR'), ('NOT', 'NOT')])
@@ -134,7 +140,8 @@ class AdvancedSearchForm(FlaskForm):
     field2 = SelectField(_l('in'), choices=[
         ('all', _l('All Metadata')), ('title', _l(
             'Title')), ('creator', _l('Creator/Author')),
-        ('subject', _l('Subject')), ('description', _l('Description/Abstract'))
+        ('subject', _l('Subject')), ('description', _l('Description/Abstract')),
+        ('body', _l('Full Text'))
     ])
     op3 = SelectField(_l('Operator'), choices=[
                       ('AND', 'AND'), ('OR', 'OR'), ('NOT', 'NOT')])
@@ -142,7 +149,8 @@ class AdvancedSearchForm(FlaskForm):
     field3 = SelectField(_l('in'), choices=[
         ('all', _l('All Metadata')), ('title', _l(
             'Title')), ('creator', _l('Creator/Author')),
-        ('subject', _l('Subject')), ('description', _l('Description/Abstract'))
+        ('subject', _l('Subject')), ('description', _l('Description/Abstract')),
+        ('body', _l('Full Text'))
     ])
     # Dynamically generate years
     years = [(str(y), str(y)) for y in range(date.today().year, 1989, -1)]
@@ -1,5 +1,6 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy.orm import validates
 from datetime import datetime
 from itsdangerous import URLSafeTimedSerializer as Serializer
 from flask import current_app
@@ -31,7 +32,7 @@ class User(UserMixin, db.Model):
     theme_preference = db.Column(
         db.String(10), nullable=False, default='light')
 
-    favorite_resources = db.relationship('Resource', secondary=favorites, lazy='subquery',
+    favorite_resources = db.relationship('Resource', secondary=favorites, lazy=True,
                                          backref=db.backref('favorited_by', lazy=True))
     downloads = db.relationship('DownloadLog', backref='user', lazy=True)
     search_history = db.relationship(
@@ -53,7 +54,11 @@ class User(UserMixin, db.Model):
 
 class Resource(db.Model):
     id = db.Column(db.Integer, primary_key=True)
+    # Path of the file under UPLOAD_FOLDER: a blob (see Blob) for uploads,
+    # a plain name for files stored before content addressing.
     filename = db.Column(db.String(100), nullable=False)
+    # Name the file was uploaded under, offered when it is downloaded
+    original_filename = db.Column(db.String(100))
     upload_date = db.Column(db.DateTime, nullable=False,
                             default=datetime.utcnow)
     title = db.Column(db.String(200), nullable=False)
@@ -61,21 +66,110 @@ class Resource(db.Model):
     subject = db.Column(db.String(200))
     description = db.Column(db.Text)
     publisher = db.Column(db.String(150))
-    publication_date = db.Column(db.Date)
+    publication_date = db.Column(db.Date, index=True)
+    # Kept in step with publication_date, for the year facet.
+    publication_year = db.Column(db.Integer, index=True)
     resource_type = db.Column(db.String(50), nullable=False)
     format = db.Column(db.String(50))
     language = db.Column(db.String(50))
     rights = db.Column(db.String(250))
     preview_image = db.Column(db.String(100), nullable=True)
+    # SHA-256 of the file, sent as its ETag
+    content_hash = db.Column(db.String(64))
     downloads = db.relationship(
         'DownloadLog', backref='resource', lazy=True, cascade="all, delete-orphan")
     categories = db.relationship('Category', secondary=resource_categories, lazy='subquery',
                                  backref=db.backref('resources', lazy=True))
+    text = db.relationship('ResourceText', uselist=False, lazy=True,
+                           cascade="all, delete-orphan")
+
+    # Year filters are ranges on publication_date, so these serve a type or
+    # language filter combined with a year range or a date sort.
+    __table_args__ = (
+        db.Index('ix_resource_type_published',
+                 'resource_type', 'publication_date'),
+        db.Index('ix_resource_language_published',
+                 'language', 'publication_date'),
+    )
+
+    @validates('publication_date')
+    def _set_publication_year(self, key, value):
+        self.publication_year = value.year if value else None
+        return value
 
     def __repr__(self):
         return f"Resource('{self.title}', '{self.creator}')"
 
 
+class Blob(db.Model):
+    """An uploaded file stored once under its content hash."""
+    sha256 = db.Column(db.String(64), primary_key=True)
+    # Path under UPLOAD_FOLDER, e.g. blobs/ab/ab12...ef.pdf
+    filename = db.Column(db.String(100), nullable=False, unique=True)
+    size = db.Column(db.Integer, nullable=False)
+    # Resource files and preview images pointing at this blob
+    refcount = db.Column(db.Integer, nullable=False, default=0)
+    touched_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<Blob {self.sha256[:12]} refs={self.refcount}>'
+
+
+class UploadSession(db.Model):
+    """A resource file being uploaded in chunks (see services/chunked_uploads.py)."""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    filename = db.Column(db.String(100), nullable=False)
+    content_type = db.Column(db.String(100))
+    size = db.Column(db.BigInteger, nullable=False)
+    # Bytes verified and written so far: where the next chunk starts
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    # Optional SHA-256 of the whole file, checked when the upload finishes
+    sha256 = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    @property
+    def complete(self):
+        return self.received == self.size
+
+    def __repr__(self):
+        return f'<UploadSession {self.id} {self.received}/{self.size}>'
+
+
+class ResourceText(db.Model):
+    """Text extracted from a resource's file, fed to the search index."""
+    resource_id = db.Column(db.Integer, db.ForeignKey(
+        'resource.id'), primary_key=True)
+    # The file the row describes; a replaced upload is extracted again.
+    filename = db.Column(db.String(100), nullable=False)
+    # 'pending', 'done', 'failed' or 'skipped' (not a PDF)
+    status = db.Column(db.String(10), nullable=False, default='pending')
+    body = db.Column(db.Text)
+    page_count = db.Column(db.Integer)
+    byte_size = db.Column(db.Integer)
+    error = db.Column(db.String(250))
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<ResourceText {self.resource_id} {self.status}>'
+
+
+class CatalogueVersion(db.Model):
+    """
+    One row counting resource changes, so that each worker's in-memory
+    search index can tell that another worker changed the catalogue
+    (see services/search_engine.py).
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<CatalogueVersion {self.version}>'
+
+
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
@@ -118,3 +212,32 @@ class SearchQueryLog(db.Model):
 
     def __repr__(self):
         return f'<SearchQueryLog "{self.query_text}" ({self.results_count} results)>'
+
+
+# --- Rollups ---
+# Pre-aggregated counts of the log tables, kept current by services.rollups
+# as the log writer commits each batch. `grain` is 'hour' or 'day' and
+# `bucket` the start of that hour or day.
+
+class DownloadRollup(db.Model):
+    grain = db.Column(db.String(4), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    # 'all' (key 0), 'resource' or 'user' (key is the resource or user id)
+    dimension = db.Column(db.String(8), primary_key=True)
+    key = db.Column(db.Integer, primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<DownloadRollup {self.grain} {self.bucket} {self.dimension}:{self.key} {self.count}>'
+
+
+class SearchRollup(db.Model):
+    grain = db.Column(db.String(4), primary_key=True)
+    bucket = db.Column(db.DateTime, primary_key=True)
+    # Lowercased, whitespace-collapsed query text
+    query_text = db.Column(db.String(200), primary_key=True)
+    searches = db.Column(db.Integer, nullable=False, default=0)
+    zero_results = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<SearchRollup {self.grain} {self.bucket} "{self.query_text}" {self.searches}>'
@@ -1,19 +1,44 @@
-import os
 from datetime import datetime, date, time, timedelta
 from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app, jsonify, Response
 from flask_login import login_required, current_user
 from werkzeug.utils import secure_filename
 from werkzeug.datastructures import FileStorage
-from sqlalchemy import func, extract
+from wtforms.validators import DataRequired
 from io import BytesIO
 from xhtml2pdf import pisa
-from models import db, Resource, User, DownloadLog, Category, SearchQueryLog
-from forms import ResourceForm, CategoryForm
+from models import db, Resource, User, DownloadLog, Category
+from forms import ResourceForm, CategoryForm, RESOURCE_FILE_EXTENSIONS
 from app import admin_required
+from services.signals import resource_saved, resource_deleted, category_changed, user_changed
+from services.pagination import KeysetPage, cached_count
+from services.rollups import rollups
+from services.trends import search_trends
+from services.slow_queries import slow_queries
+from services.instrumentation import request_timings
+from services.storage import blob_store
+from services.chunked_uploads import chunked_uploads, UploadError
 from flask_babel import gettext as _
+from flask_wtf.csrf import validate_csrf
+from wtforms import ValidationError
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
+ACTIVITY_ORDER = [(DownloadLog.download_date, True), (DownloadLog.id, True)]
+RESOURCES_ORDER = [(Resource.upload_date, True), (Resource.id, True)]
+USERS_ORDER = [(User.id, False)]
+
+# Windows offered for the search trend panels; 'all' reads the rollups.
+TREND_WINDOWS = ('hour', 'day', 'week', 'all')
+
+
+def search_trends_for(window, limit):
+    """(popular, zero-result) searches over a window, as query_text/count rows."""
+    if window == 'all':
+        return (rollups.popular_searches(limit=limit),
+                rollups.zero_result_searches(limit=limit, days=None))
+    return (search_trends.top('popular', window, limit),
+            search_trends.top('zero_results', window, limit))
+
 
 @admin_bp.route('/dashboard')
 @login_required
@@ -22,42 +47,50 @@ def dashboard():
     # --- Basic Stats ---
     total_resources = Resource.query.count()
     total_users = User.query.filter_by(is_active=True).count()
-    total_downloads = DownloadLog.query.count()
+    total_downloads = rollups.total_downloads()
 
     # --- Recent Activity Pagination ---
     activity_page = request.args.get('activity_page', 1, type=int)
-    recent_downloads_pagination = DownloadLog.query.order_by(
-        DownloadLog.download_date.desc()
-    ).paginate(page=activity_page, per_page=4, error_out=False)
+    recent_downloads_pagination = KeysetPage(
+        DownloadLog.query, ACTIVITY_ORDER, per_page=4,
+        after=request.args.get('activity_after'),
+        before=request.args.get('activity_before'),
+        page=activity_page,
+        total=cached_count('downloads', DownloadLog.query))
 
     # --- Search Trend Analytics ---
-    popular_searches = db.session.query(
-        SearchQueryLog.query_text,
-        func.count(SearchQueryLog.id).label('count')
-    ).group_by(SearchQueryLog.query_text).order_by(func.count(SearchQueryLog.id).desc()).limit(5).all()
-
-    zero_result_searches = SearchQueryLog.query.filter_by(results_count=0)\
-        .order_by(SearchQueryLog.search_date.desc()).limit(5).all()
+    trend_window = request.args.get('trend_window', 'day')
+    if trend_window not in TREND_WINDOWS:
+        trend_window = 'day'
+    popular_searches, zero_result_searches = search_trends_for(trend_window, 5)
 
     # --- Resource Pagination with Filtering ---
     resource_page = request.args.get('resource_page', 1, type=int)
     type_filter = request.args.get('type_filter', None)
+    all_resource_types = [r[0] for r in db.session.query(
+        Resource.resource_type).distinct().order_by(Resource.resource_type).all()]
+    if type_filter not in all_resource_types:
+        type_filter = None
 
     resources_query = Resource.query
     if type_filter:
         resources_query = resources_query.filter_by(resource_type=type_filter)
 
-    resources_pagination = resources_query.order_by(Resource.upload_date.desc()).paginate(
-        page=resource_page, per_page=5, error_out=False
-    )
-    all_resource_types = [r[0] for r in db.session.query(
-        Resource.resource_type).distinct().order_by(Resource.resource_type).all()]
+    resources_pagination = KeysetPage(
+        resources_query, RESOURCES_ORDER, per_page=5,
+        after=request.args.get('resource_after'),
+        before=request.args.get('resource_before'),
+        page=resource_page,
+        total=cached_count(('resources', type_filter), resources_query)
+        if type_filter else total_resources)
 
     # --- User Pagination ---
     user_page = request.args.get('user_page', 1, type=int)
-    users_pagination = User.query.order_by(User.id.asc()).paginate(
-        page=user_page, per_page=5, error_out=False
-    )
+    users_pagination = KeysetPage(
+        User.query, USERS_ORDER, per_page=5,
+        after=request.args.get('user_after'),
+        before=request.args.get('user_before'),
+        page=user_page, total=cached_count('users', User.query))
 
     # --- Category Management Data ---
     category_form = CategoryForm()
@@ -71,6 +104,8 @@ def dashboard():
                            recent_downloads_pagination=recent_downloads_pagination,
                            popular_searches=popular_searches,
                            zero_result_searches=zero_result_searches,
+                           trend_window=trend_window,
+                           trend_windows=TREND_WINDOWS,
                            resources_pagination=resources_pagination,
                            users_pagination=users_pagination,
                            category_form=category_form,
@@ -91,26 +126,50 @@ def download_analytics_by_day():
     end_date = datetime.utcnow().date()
     start_date = end_date - timedelta(days=period_days - 1)
 
-    downloads_query = db.session.query(
-        func.date(DownloadLog.download_date).label('download_day'),
-        func.count(DownloadLog.id).label('count')
-    ).filter(
-        func.date(DownloadLog.download_date).between(start_date, end_date)
-    ).group_by('download_day').all()
-
-    downloads_by_day = {str(d.download_day): d.count for d in downloads_query}
+    downloads_by_day = rollups.downloads_by_day(start_date, end_date)
 
     labels = []
     data = []
     for i in range(period_days):
         current_date = start_date + timedelta(days=i)
-        date_str = str(current_date)
         labels.append(current_date.strftime('%b %d'))
-        data.append(downloads_by_day.get(date_str, 0))
+        data.append(downloads_by_day.get(current_date, 0))
 
     return jsonify({'labels': labels, 'data': data})
 
 
+@admin_bp.route('/analytics/search-trends')
+@login_required
+@admin_required
+def search_trends_json():
+    window = request.args.get('window', 'day')
+    if window not in TREND_WINDOWS:
+        return jsonify({'error': _('Unknown window.')}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    popular, zero_results = search_trends_for(window, limit)
+
+    def rows(trends):
+        return [{'query': t.query_text, 'count': t.count,
+                 'error': getattr(t, 'error', 0)} for t in trends]
+
+    return jsonify({'window': window, 'popular': rows(popular),
+                    'zero_results': rows(zero_results)})
+
+
+@admin_bp.route('/slow-queries')
+@login_required
+@admin_required
+def slow_query_log():
+    return render_template('admin/slow_queries.html',
+                           title=_('Slow Queries'),
+                           offenders=slow_queries.offenders(),
+                           recent=slow_queries.entries()[:50],
+                           threshold=current_app.config['SLOW_QUERY_MS'],
+                           timings_enabled=current_app.config['SERVER_TIMING'],
+                           endpoint_timings=sorted(request_timings.snapshot().items(),
+                                                   key=lambda item: -item[1]['total']))
+
+
 @admin_bp.route('/reports/download/<report_type>')
 @login_required
 @admin_required
@@ -139,6 +198,13 @@ def download_report(report_type):
     return redirect(url_for('admin.dashboard'))
 
 
+def _categories(category_ids):
+    """The chosen categories, in one query rather than one per id."""
+    if not category_ids:
+        return []
+    return Category.query.filter(Category.id.in_(category_ids)).all()
+
+
 @admin_bp.route('/upload', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -146,36 +212,113 @@ def upload():
     form = ResourceForm()
     form.categories.choices = [(c.id, c.name)
                                for c in Category.query.order_by('name')]
+    if form.upload_id.data:
+        # Sent beforehand through the chunked upload API.
+        form.resource_file.validators = [
+            v for v in form.resource_file.validators if not isinstance(v, DataRequired)]
     if form.validate_on_submit():
-        file = form.resource_file.data
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        file.save(file_path)
+        if form.upload_id.data:
+            try:
+                upload_session = chunked_uploads.get(form.upload_id.data, current_user.id)
+                original_filename = upload_session.filename
+                mimetype = upload_session.content_type
+                stored = chunked_uploads.finish(upload_session)
+            except UploadError as e:
+                flash(str(e), 'danger')
+                return render_template('upload.html', title=_('Upload Resource'), form=form)
+        else:
+            file = form.resource_file.data
+            original_filename = secure_filename(file.filename)
+            mimetype = file.mimetype
+            stored = blob_store.save(file)
+        existing = blob_store.users(stored.filename)
+        if existing:
+            flash(_('This file is identical to "%(title)s"; it is stored only once.',
+                    title=existing[0].title), 'info')
         preview_filename = None
         if form.preview_image.data:
-            preview_file = form.preview_image.data
-            preview_filename = secure_filename(preview_file.filename)
-            preview_file.save(os.path.join(
-                current_app.config['UPLOAD_FOLDER'], preview_filename))
+            preview_filename = blob_store.save(form.preview_image.data).filename
         new_resource = Resource(
-            filename=filename, title=form.title.data, creator=form.creator.data,
+            filename=stored.filename, original_filename=original_filename,
+            title=form.title.data, creator=form.creator.data,
             subject=form.subject.data, description=form.description.data,
             publisher=form.publisher.data, publication_date=form.publication_date.data,
-            resource_type=form.resource_type.data, format=file.mimetype,
+            resource_type=form.resource_type.data, format=mimetype,
             language=form.language.data, rights=form.rights.data,
-            preview_image=preview_filename
+            preview_image=preview_filename, content_hash=stored.sha256
         )
-        for category_id in form.categories.data:
-            category = Category.query.get(category_id)
-            if category:
-                new_resource.categories.append(category)
+        new_resource.categories.extend(_categories(form.categories.data))
         db.session.add(new_resource)
+        blob_store.acquire(new_resource.filename)
+        blob_store.acquire(new_resource.preview_image)
         db.session.commit()
+        resource_saved.send(current_app._get_current_object(), resource=new_resource)
         flash(_('New resource uploaded successfully!'), 'success')
         return redirect(url_for('main.index'))
     return render_template('upload.html', title=_('Upload Resource'), form=form)
 
 
+# --- Chunked uploads (JSON API used by upload.html for large files) ---
+
+def _check_csrf():
+    if current_app.config.get('WTF_CSRF_ENABLED', True):
+        try:
+            validate_csrf(request.headers.get('X-CSRFToken'))
+        except ValidationError:
+            raise UploadError(_('The CSRF token is missing or invalid.'), 400)
+
+
+def _upload_state(upload_session):
+    return {'id': upload_session.id, 'offset': upload_session.received,
+            'size': upload_session.size,
+            'chunk_size': current_app.config['UPLOAD_CHUNK_SIZE']}
+
+
+@admin_bp.errorhandler(UploadError)
+def upload_error(error):
+    return jsonify({'error': str(error), **error.details}), error.status
+
+
+@admin_bp.route('/uploads', methods=['POST'])
+@login_required
+@admin_required
+def start_upload():
+    _check_csrf()
+    data = request.get_json(silent=True) or {}
+    upload_session = chunked_uploads.start(
+        current_user.id, data.get('filename'), data.get('size'), RESOURCE_FILE_EXTENSIONS,
+        content_type=data.get('content_type'), sha256=data.get('sha256'))
+    return jsonify(_upload_state(upload_session)), 201
+
+
+@admin_bp.route('/uploads/<upload_id>', methods=['GET'])
+@login_required
+@admin_required
+def upload_status(upload_id):
+    return jsonify(_upload_state(chunked_uploads.get(upload_id, current_user.id)))
+
+
+@admin_bp.route('/uploads/<upload_id>', methods=['PUT'])
+@login_required
+@admin_required
+def upload_chunk(upload_id):
+    _check_csrf()
+    upload_session = chunked_uploads.get(upload_id, current_user.id)
+    chunked_uploads.write_chunk(
+        upload_session, request.args.get('offset', -1, type=int), request.stream,
+        request.content_length, request.headers.get('X-Chunk-SHA256'))
+    return jsonify(_upload_state(upload_session))
+
+
+@admin_bp.route('/uploads/<upload_id>', methods=['DELETE'])
+@login_required
+@admin_required
+def cancel_upload(upload_id):
+    _check_csrf()
+    chunked_uploads.cancel(chunked_uploads.get(upload_id, current_user.id))
+    return '', 204
+
+
 @admin_bp.route('/edit/<int:resource_id>', methods=['GET', 'POST'])
 @login_required
 @admin_required
@@ -184,7 +327,6 @@ def edit_resource(resource_id):
     form = ResourceForm(obj=resource)
     form.categories.choices = [(c.id, c.name)
                                for c in Category.query.order_by('name')]
-    from wtforms.validators import DataRequired
     form.resource_file.validators = [
         v for v in form.resource_file.validators if not isinstance(v, DataRequired)]
 
@@ -200,21 +342,22 @@ def edit_resource(resource_id):
         resource.rights = form.rights.data
         if isinstance(form.resource_file.data, FileStorage):
             file = form.resource_file.data
-            resource.filename = secure_filename(file.filename)
-            file.save(os.path.join(
-                current_app.config['UPLOAD_FOLDER'], resource.filename))
+            stored = blob_store.save(file)
+            blob_store.acquire(stored.filename)
+            blob_store.release(resource.filename)
+            resource.filename = stored.filename
+            resource.original_filename = secure_filename(file.filename)
+            resource.content_hash = stored.sha256
             resource.format = file.mimetype
         if isinstance(form.preview_image.data, FileStorage):
-            preview_file = form.preview_image.data
-            resource.preview_image = secure_filename(preview_file.filename)
-            preview_file.save(os.path.join(
-                current_app.config['UPLOAD_FOLDER'], resource.preview_image))
+            stored = blob_store.save(form.preview_image.data)
+            blob_store.acquire(stored.filename)
+            blob_store.release(resource.preview_image)
+            resource.preview_image = stored.filename
         resource.categories.clear()
-        for category_id in form.categories.data:
-            category = Category.query.get(category_id)
-            if category:
-                resource.categories.append(category)
+        resource.categories.extend(_categories(form.categories.data))
         db.session.commit()
+        resource_saved.send(current_app._get_current_object(), resource=resource)
         flash(_('Resource has been updated!'), 'success')
         return redirect(url_for('main.browse'))
     if request.method == 'GET':
@@ -227,8 +370,12 @@ def edit_resource(resource_id):
 @admin_required
 def delete_resource(resource_id):
     resource = Resource.query.get_or_404(resource_id)
+    # The files go once the sweeper finds them unreferenced.
+    blob_store.release(resource.filename)
+    blob_store.release(resource.preview_image)
     db.session.delete(resource)
     db.session.commit()
+    resource_deleted.send(current_app._get_current_object(), resource_id=resource_id)
     flash(_('Resource has been deleted.'), 'success')
     return redirect(url_for('admin.dashboard', _anchor='resource-management'))
 
@@ -243,6 +390,7 @@ def toggle_user_active(user_id):
         return redirect(url_for('admin.dashboard', _anchor='user-management'))
     user.is_active = not user.is_active
     db.session.commit()
+    user_changed.send(current_app._get_current_object(), user_id=user.id)
     if user.is_active:
         flash(_('User %(username)s has been activated.',
               username=user.username), 'success')
@@ -261,6 +409,7 @@ def add_category():
         new_category = Category(name=form.name.data)
         db.session.add(new_category)
         db.session.commit()
+        category_changed.send(current_app._get_current_object())
         flash(_('Category "%(name)s" has been added.',
               name=new_category.name), 'success')
     else:
@@ -278,5 +427,6 @@ def delete_category(category_id):
     category = Category.query.get_or_404(category_id)
     db.session.delete(category)
     db.session.commit()
+    category_changed.send(current_app._get_current_object())
     flash(_('Category "%(name)s" has been deleted.', name=category.name), 'success')
     return redirect(url_for('admin.dashboard', _anchor='category-management'))
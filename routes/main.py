@@ -1,13 +1,69 @@
-from flask import Blueprint, render_template, send_from_directory, current_app, request, redirect, url_for, session, jsonify
-from sqlalchemy import or_, and_, not_, extract, func
+from flask import Blueprint, render_template, current_app, request, redirect, url_for, session, jsonify, flash
+from sqlalchemy import false, values, column, Integer, Float
 from flask_login import login_required, current_user
 from datetime import datetime
-from models import db, Resource, DownloadLog, Category, SearchHistory, SearchQueryLog
+from models import db, Resource, DownloadLog, Category, SearchHistory, SearchQueryLog, User
 from forms import AdvancedSearchForm
+from flask_babel import gettext as _
+from services.fts import term_expression, match_subquery
+from services.facets import facet_counts
+from services.search_engine import search_index
+from services.suggestions import suggestion_index
+from services.spelling import spelling_index
+from services.log_writer import log_writer
+from services import file_serving
+from services.previews import previews
+from services import favorites
+from services.metrics import metrics
+from services.signals import user_changed
+from services.result_cache import result_cache, normalize_key, CachedPagination
+from services.pagination import KeysetPage, seek
+from services.query_language import (parse, rows_to_tree, compile_query, year_clause,
+                                     And, QuerySyntaxError)
 
 main_bp = Blueprint('main', __name__)
 
 
+def matching_resources(expression):
+    """Returns (query, hits) for an FTS expression; hits carries the rank."""
+    if not expression:
+        return Resource.query.filter(false()), None
+    hits = match_subquery(expression)
+    return Resource.query.join(hits, hits.c.resource_id == Resource.id), hits
+
+
+def ranked_resources(ranked):
+    """
+    Same as matching_resources, for [(id, score)] from the memory index.
+    The ids are inlined as a VALUES table, which the index caps at
+    SEARCH_MAX_HITS rows.
+    """
+    if not ranked:
+        return Resource.query.filter(false()), None
+    hits = values(column('resource_id', Integer), column('rank', Float),
+                  name='hits', literal_binds=True).data(
+        [(resource_id, -score) for resource_id, score in ranked]).cte('hits')
+    return Resource.query.join(hits, hits.c.resource_id == Resource.id), hits
+
+
+def sort_order(sort_by, hits):
+    """(column, descending) pairs for a search sort, ending in a unique id."""
+    if sort_by == 'date_asc':
+        return [(Resource.publication_date, False), (Resource.id, False)]
+    elif sort_by == 'title_asc':
+        return [(Resource.title, False), (Resource.id, False)]
+    elif sort_by == 'title_desc':
+        return [(Resource.title, True), (Resource.id, True)]
+    elif sort_by == 'date_desc' or hits is None:
+        return [(Resource.publication_date, True), (Resource.id, True)]
+    # Relevance: best bm25 score first, newest first among equals.
+    return [(hits.c.rank, False), (Resource.publication_date, True),
+            (Resource.id, True)]
+
+
+BROWSE_ORDER = [(Resource.upload_date, True), (Resource.id, True)]
+
+
 @main_bp.route('/')
 def index():
     return render_template('index.html')
@@ -22,13 +78,17 @@ def about():
 @login_required
 def browse():
     page = request.args.get('page', 1, type=int)
-    pagination = Resource.query.order_by(Resource.upload_date.desc()).paginate(
-        page=page, per_page=6, error_out=False
-    )
+    total = result_cache.get_or_compute(('count', 'resources'),
+                                        Resource.query.count)
+    pagination = KeysetPage(Resource.query, BROWSE_ORDER, per_page=6,
+                            after=request.args.get('after'),
+                            before=request.args.get('before'),
+                            page=page, total=total)
     resources = pagination.items
     return render_template('browse.html',
                            title='Browse',
                            resources=resources,
+                           favorite_ids=favorites.among(current_user.id, [r.id for r in resources]),
                            pagination=pagination,
                            page=page)
 
@@ -37,26 +97,35 @@ def browse():
 @login_required
 def resource_detail(resource_id):
     resource = Resource.query.get_or_404(resource_id)
-    return render_template('resource_detail.html', title=resource.title, resource=resource)
+    return render_template('resource_detail.html', title=resource.title, resource=resource,
+                           favorite_ids=favorites.among(current_user.id, [resource.id]))
+
+
+@main_bp.app_template_global()
+def upload_url(filename):
+    return file_serving.upload_url(filename)
+
+
+@main_bp.app_template_global()
+def preview_sources(filename):
+    return previews.sources(filename)
 
 
 @main_bp.route('/uploads/<path:filename>')
 def serve_upload(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    return file_serving.send_upload(filename)
 
 
 @main_bp.route('/download/<int:resource_id>')
 @login_required
 def download(resource_id):
     resource = Resource.query.get_or_404(resource_id)
-
-    new_log = DownloadLog(user_id=current_user.id, resource_id=resource.id)
-    db.session.add(new_log)
-    db.session.commit()
-
-    return send_from_directory(
-        current_app.config['UPLOAD_FOLDER'], resource.filename, as_attachment=True
-    )
+    response = file_serving.send_resource(resource)
+    metrics.inc('download_bytes_total', response.content_length or 0)
+    if file_serving.is_new_download(response):
+        log_writer.enqueue(DownloadLog, user_id=current_user.id,
+                           resource_id=resource.id)
+    return response
 
 
 @main_bp.route('/search')
@@ -64,7 +133,7 @@ def download(resource_id):
 def search():
     query = request.args.get('q', '')
     page = request.args.get('page', 1, type=int)
-    sort_by = request.args.get('sort', 'date_desc')
+    sort_by = request.args.get('sort', 'relevance')
     active_types = request.args.getlist('type')
     active_langs = request.args.getlist('lang')
     active_categories = request.args.getlist('cat')
@@ -93,78 +162,70 @@ def search():
     if not query:
         return redirect(url_for('main.browse'))
 
-    if query:
-        new_search = SearchHistory(query_text=query, user_id=current_user.id)
-        db.session.add(new_search)
-        db.session.commit()
+    log_writer.enqueue(SearchHistory, query_text=query, user_id=current_user.id)
 
-    base_query = Resource.query.filter(
-        or_(
-            Resource.title.ilike(f'%{query}%'),
-            Resource.description.ilike(f'%{query}%'),
-            Resource.creator.ilike(f'%{query}%'),
-            Resource.subject.ilike(f'%{query}%')
-        )
-    )
-
-    type_counts_query = base_query.with_entities(Resource.resource_type, func.count(
-        Resource.id)).group_by(Resource.resource_type).all()
-    type_counts = dict(type_counts_query)
-
-    lang_counts_query = base_query.with_entities(
-        Resource.language, func.count(Resource.id)).group_by(Resource.language).all()
-    lang_counts = dict(lang_counts_query)
-
-    category_counts = {}
-    search_results_ids = [
-        r.id for r in base_query.with_entities(Resource.id).all()]
-    if search_results_ids:
-        category_counts_query = db.session.query(Category.id, func.count(Resource.id)).join(
-            Category.resources).filter(Resource.id.in_(search_results_ids)).group_by(Category.id).all()
-        category_counts = dict(category_counts_query)
-
-    filtered_query = base_query
-
-    if active_types:
-        filtered_query = filtered_query.filter(
-            Resource.resource_type.in_(active_types))
-
-    if active_langs:
-        filtered_query = filtered_query.filter(
-            Resource.language.in_(active_langs))
-
-    if active_categories:
-        active_category_ids = [int(c) for c in active_categories]
-        filtered_query = filtered_query.filter(
-            Resource.categories.any(Category.id.in_(active_category_ids)))
-
-    if start_year:
-        filtered_query = filtered_query.filter(
-            extract('year', Resource.publication_date) >= start_year)
-
-    if end_year:
-        filtered_query = filtered_query.filter(
-            extract('year', Resource.publication_date) <= end_year)
+    backend = current_app.config['SEARCH_BACKEND']
 
-    if sort_by == 'date_asc':
-        filtered_query = filtered_query.order_by(
-            Resource.publication_date.asc())
-    elif sort_by == 'title_asc':
-        filtered_query = filtered_query.order_by(Resource.title.asc())
-    elif sort_by == 'title_desc':
-        filtered_query = filtered_query.order_by(Resource.title.desc())
-    else:
-        filtered_query = filtered_query.order_by(
-            Resource.publication_date.desc())
+    def run(text):
+        if backend == 'memory':
+            base_query, hits = ranked_resources(search_index.search(text))
+        else:
+            base_query, hits = matching_resources(term_expression(text))
 
-    pagination = filtered_query.paginate(
-        page=page, per_page=5, error_out=False)
+        facets = result_cache.get_or_compute(
+            normalize_key('facets', backend, text),
+            lambda: facet_counts(base_query))
+
+        filtered_query = base_query
+
+        if active_types:
+            filtered_query = filtered_query.filter(
+                Resource.resource_type.in_(active_types))
+
+        if active_langs:
+            filtered_query = filtered_query.filter(
+                Resource.language.in_(active_langs))
+
+        if active_categories:
+            active_category_ids = [int(c) for c in active_categories]
+            filtered_query = filtered_query.filter(
+                Resource.categories.any(Category.id.in_(active_category_ids)))
+
+        if start_year or end_year:
+            filtered_query = filtered_query.filter(
+                year_clause(start_year, end_year))
+
+        order = sort_order(sort_by, hits)
+
+        matched = result_cache.get_or_compute(
+            normalize_key('search', backend, text, active_types, active_langs,
+                          active_categories, start_year, end_year, sort_by),
+            lambda: result_cache.match_ids(seek(filtered_query, order)))
+        pagination = CachedPagination(page=page, per_page=5, error_out=False,
+                                      query=filtered_query, order=order,
+                                      matched=matched)
+        return pagination, facets
+
+    pagination, facets = run(query)
+    exact_total = pagination.total
+
+    # Nothing matched as typed: offer respellings from the trigram index and
+    # show the results of the first one that finds something.
+    suggestions, corrected_query = [], None
+    if not exact_total:
+        suggestions = spelling_index.suggest(query)
+        for suggestion in suggestions:
+            corrected, corrected_facets = run(suggestion)
+            if corrected.total:
+                pagination, facets = corrected, corrected_facets
+                corrected_query = suggestion
+                suggestions.remove(suggestion)
+                break
     results = pagination.items
 
-    log_search = SearchQueryLog(
-        query_text=query, results_count=pagination.total)
-    db.session.add(log_search)
-    db.session.commit()
+    log_writer.enqueue(SearchQueryLog, query_text=query,
+                       results_count=exact_total)
+    metrics.observe('search_results', exact_total, kind='simple')
 
     all_types = ['E-book', 'Journal',
                  'Research Paper', 'Magazine', 'Newspaper']
@@ -183,11 +244,14 @@ def search():
                            start_year=start_year,
                            end_year=end_year,
                            sort_by=sort_by,
-                           type_counts=type_counts,
-                           lang_counts=lang_counts,
+                           type_counts=facets['type'],
+                           lang_counts=facets['lang'],
                            all_categories=all_categories,
                            active_categories=active_categories,
-                           category_counts=category_counts,
+                           category_counts=facets['category'],
+                           year_counts=facets['year'],
+                           suggestions=suggestions,
+                           corrected_query=corrected_query,
                            now=datetime.utcnow())
 
 
@@ -200,80 +264,47 @@ def advanced_search():
     else:
         form = AdvancedSearchForm(request.args)
 
-    if form.term1.data:
-
-        query = Resource.query
-        filters = []
-
-        def build_condition(term, field):
-            search_term = f'%{term}%'
-            if field == 'all':
-                return or_(Resource.title.ilike(search_term), Resource.creator.ilike(search_term),
-                           Resource.subject.ilike(search_term), Resource.description.ilike(search_term))
-            else:
-                return getattr(Resource, field).ilike(search_term)
-
-        condition1 = build_condition(form.term1.data, form.field1.data)
-        filters.append(condition1)
-
-        if form.term2.data:
-            condition2 = build_condition(form.term2.data, form.field2.data)
-            if form.op2.data == 'OR':
-                last_filter = filters.pop()
-                filters.append(or_(last_filter, condition2))
-            elif form.op2.data == 'NOT':
-                filters.append(not_(condition2))
-            else:  # AND
-                filters.append(condition2)
-
-        if form.term3.data:
-            condition3 = build_condition(form.term3.data, form.field3.data)
-            if form.op3.data == 'OR':
-                last_filter = filters.pop()
-                filters.append(or_(last_filter, condition3))
-            elif form.op3.data == 'NOT':
-                filters.append(not_(condition3))
-            else:  # AND
-                filters.append(condition3)
-
-        if form.start_year.data:
-            try:
-                filters.append(extract('year', Resource.publication_date) >= int(
-                    form.start_year.data))
-            except (ValueError, TypeError):
-                pass
-        if form.end_year.data:
-            try:
-                filters.append(
-                    extract('year', Resource.publication_date) <= int(form.end_year.data))
-            except (ValueError, TypeError):
-                pass
-
-        base_query = query.filter(and_(*filters))
-
-        type_counts_query = base_query.with_entities(
-            Resource.resource_type, func.count(Resource.id)
-        ).group_by(Resource.resource_type).all()
-        type_counts = dict(type_counts_query)
-
-        lang_counts_query = base_query.with_entities(
-            Resource.language, func.count(Resource.id)
-        ).group_by(Resource.language).all()
-        lang_counts = dict(lang_counts_query)
-
-        category_counts = {}
-        search_results_ids = [
-            r.id for r in base_query.with_entities(Resource.id).all()]
-        if search_results_ids:
-            category_counts_query = db.session.query(
-                Category.id, func.count(Resource.id)
-            ).join(Category.resources).filter(
-                Resource.id.in_(search_results_ids)
-            ).group_by(Category.id).all()
-            category_counts = dict(category_counts_query)
+    if form.query.data or form.term1.data:
+
+        # The free-text query and the three form rows are combined into one
+        # boolean tree, which compiles to a single MATCH plus SQL filters.
+        try:
+            parts = [parse(form.query.data), rows_to_tree((
+                ('AND', form.term1.data, form.field1.data),
+                (form.op2.data, form.term2.data, form.field2.data),
+                (form.op3.data, form.term3.data, form.field3.data)))]
+            parts = [p for p in parts if p is not None]
+            compiled = compile_query(And(tuple(parts))) if parts else None
+            # Nothing searchable, e.g. only punctuation: same as no query.
+            if compiled is None or (compiled.fts is None and not compiled.filters):
+                return render_template('advanced_search.html', title='Advanced Search', form=form)
+        except QuerySyntaxError as e:
+            flash(_('Could not understand the query: %(error)s', error=str(e)), 'danger')
+            return render_template('advanced_search.html', title='Advanced Search', form=form)
+
+        if compiled.fts:
+            query, hits = matching_resources(compiled.fts)
+        else:
+            query, hits = Resource.query, None
+        filters = list(compiled.filters)
+
+        try:
+            start_year = int(form.start_year.data) if form.start_year.data else None
+            end_year = int(form.end_year.data) if form.end_year.data else None
+            if start_year is not None or end_year is not None:
+                filters.append(year_clause(start_year, end_year))
+        except (ValueError, TypeError):
+            pass
+
+        base_query = query.filter(*filters)
+
+        facet_key = normalize_key('advanced', compiled.key,
+                                  form.start_year.data, form.end_year.data)
+        facets = result_cache.get_or_compute(
+            facet_key, lambda: facet_counts(base_query))
 
         page = request.args.get('page', 1, type=int)
-        sort_by = request.args.get('sort', 'date_desc')
+        sort_by = request.args.get('sort', 'relevance')
         active_types = request.args.getlist('type')
         active_langs = request.args.getlist('lang')
         active_categories = request.args.getlist('cat')
@@ -293,32 +324,25 @@ def advanced_search():
                 filtered_query = filtered_query.filter(
                     Resource.categories.any(Category.id.in_(active_category_ids)))
 
-        if sort_by == 'date_asc':
-            filtered_query = filtered_query.order_by(
-                Resource.publication_date.asc())
-        elif sort_by == 'title_asc':
-            filtered_query = filtered_query.order_by(Resource.title.asc())
-        elif sort_by == 'title_desc':
-            filtered_query = filtered_query.order_by(Resource.title.desc())
-        else:
-            filtered_query = filtered_query.order_by(
-                Resource.publication_date.desc())
+        order = sort_order(sort_by, hits)
 
-        pagination = filtered_query.paginate(
-            page=page, per_page=5, error_out=False)
+        matched = result_cache.get_or_compute(
+            facet_key + normalize_key(active_types, active_langs,
+                                      active_categories, sort_by),
+            lambda: result_cache.match_ids(seek(filtered_query, order)))
+        pagination = CachedPagination(page=page, per_page=5, error_out=False,
+                                      query=filtered_query, order=order,
+                                      matched=matched)
         results = pagination.items
 
         if request.method == 'POST' and form.validate_on_submit():
-            query_text = form.term1.data
+            query_text = form.query.data or form.term1.data
 
-            new_search = SearchHistory(
-                query_text=query_text, user_id=current_user.id)
-            db.session.add(new_search)
-
-            log_search = SearchQueryLog(
-                query_text=f"Advanced: {query_text}", results_count=pagination.total)
-            db.session.add(log_search)
-            db.session.commit()
+            log_writer.enqueue(SearchHistory, query_text=query_text,
+                               user_id=current_user.id)
+            log_writer.enqueue(SearchQueryLog, query_text=f"Advanced: {query_text}",
+                               results_count=pagination.total)
+            metrics.observe('search_results', pagination.total, kind='advanced')
 
         all_types = ['E-book', 'Journal',
                      'Research Paper', 'Magazine', 'Newspaper']
@@ -327,6 +351,7 @@ def advanced_search():
         all_categories = Category.query.order_by(Category.name.asc()).all()
 
         adv_params_for_url = {
+            'query': form.query.data,
             'term1': form.term1.data, 'field1': form.field1.data,
             'op2': form.op2.data, 'term2': form.term2.data, 'field2': form.field2.data,
             'op3': form.op3.data, 'term3': form.term3.data, 'field3': form.field3.data
@@ -348,9 +373,10 @@ def advanced_search():
                                active_categories=active_categories,
                                start_year=form.start_year.data or '',
                                end_year=form.end_year.data or '',
-                               type_counts=type_counts,
-                               lang_counts=lang_counts,
-                               category_counts=category_counts,
+                               type_counts=facets['type'],
+                               lang_counts=facets['lang'],
+                               category_counts=facets['category'],
+                               year_counts=facets['year'],
                                advanced_params_for_url=adv_params_for_url,
                                link_params=link_params,
                                now=datetime.utcnow()
@@ -365,10 +391,13 @@ def search_suggestions():
     if not query or len(query) < 2:
         return jsonify([])
 
-    suggestions = Resource.query.filter(
-        Resource.title.ilike(f'%{query}%')).limit(5).all()
-
-    return jsonify([s.title for s in suggestions])
+    response = jsonify(suggestion_index.suggest(query))
+    # Suggestions only change with the catalogue, so let browsers and any
+    # shared cache answer repeat keystrokes without reaching the app.
+    response.cache_control.public = True
+    response.cache_control.max_age = current_app.config['SUGGEST_CACHE_SECONDS']
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @main_bp.route('/language/<lang>')
@@ -381,7 +410,8 @@ def set_language(lang=None):
 @login_required
 def set_theme(theme=None):
     if theme in ['light', 'dark']:
-        current_user.theme_preference = theme
+        User.query.filter_by(id=current_user.id).update({'theme_preference': theme})
         db.session.commit()
+        user_changed.send(current_app._get_current_object(), user_id=current_user.id)
         session['theme'] = theme
     return redirect(request.referrer)
@@ -1,12 +1,16 @@
 # routes/user.py
 
-from flask import Blueprint, render_template, flash, redirect, url_for, request
+from flask import Blueprint, render_template, flash, redirect, url_for, request, abort
 from flask_login import login_required, current_user
 from models import db, Resource, SearchHistory
 from flask_babel import gettext as _
+from services.pagination import KeysetPage
+from services import favorites
 
 user_bp = Blueprint('user', __name__)
 
+FAVORITES_ORDER = [(Resource.title, False), (Resource.id, False)]
+
 
 @user_bp.route('/my-account')
 @login_required
@@ -14,18 +18,10 @@ def my_account():
     # Paginate favorites - 6 per page
     page = request.args.get('page', 1, type=int)
 
-    # Get IDs of user's favorite resources
-    favorite_ids = [fav.id for fav in current_user.favorite_resources]
-
-    # Query and paginate favorites
-    favorites_query = Resource.query.filter(Resource.id.in_(
-        favorite_ids)) if favorite_ids else Resource.query.filter(Resource.id == -1)
-
-    favorites_pagination = favorites_query.order_by(Resource.title.asc()).paginate(
-        page=page, per_page=6, error_out=False
-    )
-
-    favorites = favorites_pagination.items
+    favorites_pagination = KeysetPage(
+        favorites.query(current_user.id), FAVORITES_ORDER, per_page=6,
+        after=request.args.get('after'), before=request.args.get('before'),
+        page=page, total=favorites.count(current_user.id))
 
     # Get the user's recent search history - limit to 10
     search_history = SearchHistory.query.filter_by(user_id=current_user.id)\
@@ -34,17 +30,22 @@ def my_account():
 
     return render_template('my_account.html',
                            title=_('My Account'),
-                           favorites=favorites,
+                           favorites=favorites_pagination.items,
                            favorites_pagination=favorites_pagination,
                            search_history=search_history)
 
 
+def _resource_exists_or_404(resource_id):
+    # An id lookup: loading the Resource would also load its categories.
+    if db.session.query(Resource.id).filter_by(id=resource_id).first() is None:
+        abort(404)
+
+
 @user_bp.route('/add-favorite/<int:resource_id>', methods=['POST'])
 @login_required
 def add_favorite(resource_id):
-    resource = Resource.query.get_or_404(resource_id)
-    if resource not in current_user.favorite_resources:
-        current_user.favorite_resources.append(resource)
+    _resource_exists_or_404(resource_id)
+    if favorites.add(current_user.id, resource_id):
         db.session.commit()
         flash(_('Resource added to your favorites!'), 'success')
     else:
@@ -55,9 +56,8 @@ def add_favorite(resource_id):
 @user_bp.route('/remove-favorite/<int:resource_id>', methods=['POST'])
 @login_required
 def remove_favorite(resource_id):
-    resource = Resource.query.get_or_404(resource_id)
-    if resource in current_user.favorite_resources:
-        current_user.favorite_resources.remove(resource)
+    _resource_exists_or_404(resource_id)
+    if favorites.remove(current_user.id, resource_id):
         db.session.commit()
         flash(_('Resource removed from your favorites.'), 'success')
     else:
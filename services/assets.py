@@ -0,0 +1,304 @@
+import hashlib
+import json
+import os
+import re
+from urllib.parse import urljoin, urlsplit
+from flask import request, send_from_directory, url_for, abort
+
+SOURCE_DIR = 'src'      # static/src/{css,js}/<name>, as written
+DIST_DIR = 'dist'       # static/dist/<stem>.<hash><ext>, as served
+VENDOR_DIR = 'vendor'   # static/vendor/..., copies of the CDN files
+MANIFEST = 'manifest.json'
+
+# A year: fingerprinted and versioned files never change under one URL.
+IMMUTABLE_MAX_AGE = 31536000
+
+# Third-party files the templates used to load from CDNs: the CDN URL
+# and, once `flask vendor-assets` has fetched it, the copy under
+# static/vendor (versioned paths, so they can be cached for good).
+# Vendoring is a deploy step and the copies are not in the repository;
+# until it has run, vendor_url() keeps pointing at the CDN.
+VENDOR = {
+    'bootstrap.css': ('https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/css/bootstrap.min.css',
+                      'bootstrap-5.3.2/bootstrap.min.css'),
+    'bootstrap.js': ('https://cdn.jsdelivr.net/npm/bootstrap@5.3.2/dist/js/bootstrap.bundle.min.js',
+                     'bootstrap-5.3.2/bootstrap.bundle.min.js'),
+    'fontawesome.css': ('https://cdnjs.cloudflare.com/ajax/libs/font-awesome/6.0.0/css/all.min.css',
+                        'fontawesome-6.0.0/css/all.min.css'),
+    'fonts.css': ('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700'
+                  '&family=Playfair+Display:wght@600;700&display=swap',
+                  'google-fonts-2025/fonts.css'),
+    'chart.js': ('https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js',
+                 'chart.js-4.4.1/chart.umd.min.js'),
+}
+
+_CSS_URL = re.compile(r'url\(\s*([\'"]?)([^\'")]+)\1\s*\)')
+
+
+# --- Minification ---
+
+def _css_tokens(tokens):
+    """Serializes component values with whitespace collapsed."""
+    import tinycss2
+    out = []
+    tight = False   # after a comma or child combinator: no space needed
+    for token in tokens:
+        if token.type == 'whitespace':
+            if out and out[-1] != ' ' and not tight:
+                out.append(' ')
+            continue
+        if token.type == 'comment':
+            continue
+        tight = token.type == 'literal' and token.value in (',', '>')
+        if tight and out and out[-1] == ' ':
+            out.pop()
+        if token.type == 'function':
+            out.append(f'{token.name}({_css_tokens(token.arguments)})')
+        elif token.type in ('() block', '[] block'):
+            out.append(f'{token.type[0]}{_css_tokens(token.content)}{token.type[1]}')
+        else:
+            out.append(tinycss2.serialize([token]))
+    return ''.join(out).strip()
+
+
+def _css_declarations(content):
+    import tinycss2
+    parts = []
+    for item in tinycss2.parse_blocks_contents(content, skip_comments=True, skip_whitespace=True):
+        if item.type == 'declaration':
+            value = _css_tokens(item.value)
+            parts.append(f'{item.name}:{value}' + ('!important' if item.important else ''))
+        elif item.type in ('qualified-rule', 'at-rule'):
+            parts.append(_css_rule(item))
+    return ';'.join(parts)
+
+
+# At-rules whose block holds rules rather than declarations.
+_GROUPING_RULES = {'media', 'supports', 'keyframes', '-webkit-keyframes', 'container', 'layer'}
+
+
+def _css_rule(rule):
+    import tinycss2
+    if rule.type == 'qualified-rule':
+        return f'{_css_tokens(rule.prelude)}{{{_css_declarations(rule.content)}}}'
+    prelude = _css_tokens(rule.prelude)
+    head = f'@{rule.at_keyword}' + (f' {prelude}' if prelude else '')
+    if rule.content is None:
+        return head + ';'
+    if rule.lower_at_keyword in _GROUPING_RULES:
+        rules = tinycss2.parse_rule_list(rule.content, skip_comments=True, skip_whitespace=True)
+        return f'{head}{{{"".join(_css_rule(r) for r in rules if r.type != "error")}}}'
+    return f'{head}{{{_css_declarations(rule.content)}}}'
+
+
+def minify_css(text):
+    """Drops comments and redundant whitespace, keeping every rule as is."""
+    import tinycss2
+    rules = tinycss2.parse_stylesheet(text, skip_comments=True, skip_whitespace=True)
+    errors = [r for r in rules if r.type == 'error']
+    if errors:
+        raise ValueError(f'CSS parse error: {errors[0].message}')
+    return ''.join(_css_rule(rule) for rule in rules)
+
+
+def minify_js(text):
+    """
+    Strips indentation, blank lines and whole-line // comments. Line breaks
+    are kept, so automatic semicolon insertion works as before; Brotli
+    takes care of the rest.
+    """
+    lines = []
+    in_template = False
+    for line in text.splitlines():
+        stripped = line.strip() if not in_template else line
+        if not in_template and (not stripped or stripped.startswith('//')):
+            continue
+        lines.append(stripped)
+        # Keep multi-line template literals byte for byte.
+        if line.count('`') % 2:
+            in_template = not in_template
+    return '\n'.join(lines) + '\n'
+
+
+MINIFIERS = {'.css': minify_css, '.js': minify_js}
+
+
+class Assets:
+    """
+    The stylesheets and scripts of the templates, served as minified,
+    fingerprinted files.
+
+    Sources live in static/src/css and static/src/js. The build writes
+    each one to static/dist/<name>.<content hash><ext>, with a Brotli
+    copy next to it, and records the names in static/dist/manifest.json;
+    asset_url() looks them up there. Those URLs change with the content,
+    so they are served as immutable and repeat views come from the
+    browser cache. The build runs at startup when the sources differ from
+    the manifest (ASSETS_AUTO_BUILD), and with `flask build-assets`.
+
+    The CDN libraries are served from static/vendor once a deployment has
+    run `flask vendor-assets`, and from their CDN until then.
+    """
+
+    def __init__(self, app=None):
+        self._manifest = {}
+        self._vendored = set()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('ASSETS_AUTO_BUILD', True)
+        app.config.setdefault('ASSETS_BROTLI_QUALITY', 11)
+        self.app = app
+        self.static = app.static_folder
+        app.extensions['assets'] = self
+        app.add_url_rule(f'{app.static_url_path}/{DIST_DIR}/<path:filename>',
+                         'dist_asset', lambda filename: self.send(DIST_DIR, filename))
+        app.add_url_rule(f'{app.static_url_path}/{VENDOR_DIR}/<path:filename>',
+                         'vendor_asset', lambda filename: self.send(VENDOR_DIR, filename))
+        app.add_template_global(self.url, 'asset_url')
+        app.add_template_global(self.vendor_url, 'vendor_url')
+        self._manifest = self._read_manifest()
+        if app.config['ASSETS_AUTO_BUILD'] and \
+                self._manifest.get('sources') != self.sources_digest():
+            try:
+                self.build()
+            except OSError as e:
+                # A read-only deployment serves the sources unminified.
+                app.logger.warning('Could not build the assets: %s', e)
+        self._vendored = {name for name, (_, path) in VENDOR.items()
+                          if os.path.isfile(os.path.join(self.static, VENDOR_DIR, path))}
+
+    # --- Build ---
+
+    def _sources(self):
+        root = os.path.join(self.static, SOURCE_DIR)
+        found = []
+        for kind in sorted(os.listdir(root)) if os.path.isdir(root) else ():
+            folder = os.path.join(root, kind)
+            for name in sorted(os.listdir(folder)):
+                if os.path.splitext(name)[1] in MINIFIERS:
+                    found.append((name, os.path.join(folder, name)))
+        return found
+
+    def sources_digest(self):
+        digest = hashlib.sha256()
+        for name, path in self._sources():
+            with open(path, 'rb') as f:
+                digest.update(name.encode() + b'\0' + f.read() + b'\0')
+        return digest.hexdigest()
+
+    def _read_manifest(self):
+        try:
+            with open(os.path.join(self.static, DIST_DIR, MANIFEST), encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def build(self):
+        """Minifies, fingerprints and compresses every source. Returns the manifest."""
+        import brotli
+        dist = os.path.join(self.static, DIST_DIR)
+        os.makedirs(dist, exist_ok=True)
+        assets = {}
+        for name, path in self._sources():
+            stem, ext = os.path.splitext(name)
+            with open(path, encoding='utf-8') as f:
+                data = MINIFIERS[ext](f.read()).encode('utf-8')
+            output = f'{stem}.{hashlib.sha256(data).hexdigest()[:10]}{ext}'
+            _write(os.path.join(dist, output), data)
+            _write(os.path.join(dist, output + '.br'), brotli.compress(
+                data, quality=self.app.config['ASSETS_BROTLI_QUALITY']))
+            assets[name] = output
+        # Pages rendered before a deploy may still ask for the last build.
+        keep = set(assets.values()) | set(self._manifest.get('assets', {}).values())
+        for name in os.listdir(dist):
+            if name != MANIFEST and name.removesuffix('.br') not in keep:
+                os.remove(os.path.join(dist, name))
+        manifest = {'sources': self.sources_digest(), 'assets': assets}
+        _write(os.path.join(dist, MANIFEST),
+               json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8') + b'\n')
+        self._manifest = manifest
+        return manifest
+
+    def vendor(self, fetch):
+        """
+        Downloads the VENDOR files with `fetch(url) -> bytes`, plus the
+        fonts their stylesheets load, and compresses them. Relative URLs
+        keep their layout; absolute ones are saved next to the stylesheet.
+        """
+        import brotli
+        root = os.path.join(self.static, VENDOR_DIR)
+        fetched = []
+        for name, (source, path) in VENDOR.items():
+            data = fetch(source)
+            target = os.path.join(root, path)
+            if path.endswith('.css'):
+                text = data.decode('utf-8')
+                for url in sorted({m.group(2) for m in _CSS_URL.finditer(text)}):
+                    if url.startswith('data:'):
+                        continue
+                    local = url.split('?')[0].split('#')[0]
+                    if urlsplit(url).scheme:
+                        local = os.path.basename(urlsplit(url).path)
+                        text = text.replace(url, local)
+                    font = os.path.normpath(os.path.join(os.path.dirname(target), local))
+                    if not os.path.exists(font):
+                        _write(font, fetch(urljoin(source, url)))
+                        fetched.append(font)
+                data = text.encode('utf-8')
+            _write(target, data)
+            _write(target + '.br', brotli.compress(data, quality=11))
+            fetched.append(target)
+        self._vendored = set(VENDOR)
+        return fetched
+
+    # --- Serving ---
+
+    def url(self, name):
+        asset = self._manifest.get('assets', {}).get(name)
+        if asset is None:
+            kind = os.path.splitext(name)[1][1:]
+            return url_for('static', filename=f'{SOURCE_DIR}/{kind}/{name}')
+        return url_for('dist_asset', filename=asset)
+
+    def vendor_url(self, name):
+        source, path = VENDOR[name]
+        if name not in self._vendored:
+            return source
+        return url_for('vendor_asset', filename=path)
+
+    def send(self, folder, filename):
+        """Sends a built or vendored file, Brotli-compressed if accepted."""
+        directory = os.path.join(self.static, folder)
+        response = None
+        if 'br' in request.accept_encodings and not filename.endswith('.br') \
+                and os.path.isfile(os.path.join(directory, filename + '.br')):
+            response = send_from_directory(directory, filename + '.br',
+                                           max_age=IMMUTABLE_MAX_AGE)
+            response.content_encoding = 'br'
+            response.mimetype = _mimetype(filename)
+        elif filename.endswith('.br'):
+            abort(404)
+        if response is None:
+            response = send_from_directory(directory, filename, max_age=IMMUTABLE_MAX_AGE)
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+def _mimetype(filename):
+    import mimetypes
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp = f'{path}.{os.getpid()}.tmp'
+    with open(temp, 'wb') as f:
+        f.write(data)
+    os.replace(temp, path)
+
+
+assets = Assets()
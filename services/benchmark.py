@@ -0,0 +1,109 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+from sqlalchemy import create_engine, select, extract, func, and_
+from models import Resource
+from services.query_language import year_clause
+
+TYPES = ['E-book', 'Journal', 'Research Paper', 'Magazine', 'Newspaper']
+LANGUAGES = ['English', 'isiZulu', 'isiXhosa', 'Afrikaans', 'Sesotho']
+
+
+def _old_years(start, end):
+    year = extract('year', Resource.publication_date)
+    return and_(year >= start, year <= end)
+
+
+# (label, old query, new query): the search route's filter and sort
+# combinations, before and after the year filter became a date range.
+def _cases():
+    order = (Resource.publication_date.desc(), Resource.id.desc())
+    page = select(Resource.id).order_by(*order).limit(5)
+    count = select(func.count()).select_from(Resource)
+    typed = Resource.resource_type == 'Journal'
+    language = Resource.language == 'isiZulu'
+    return [
+        ('type + years, newest first',
+         page.where(typed, _old_years(2000, 2005)),
+         page.where(typed, year_clause(2000, 2005))),
+        ('language + years, count',
+         count.where(language, _old_years(1990, 1999)),
+         count.where(language, year_clause(1990, 1999))),
+        ('years only, newest first',
+         page.where(_old_years(2010, 2012)),
+         page.where(year_clause(2010, 2012))),
+    ]
+
+
+def _populate(engine, rows, seed):
+    rng = random.Random(seed)
+    first = date(1900, 1, 1)
+    span = (date(2025, 12, 31) - first).days
+    Resource.__table__.create(engine)
+    # Drop the new indexes: the "before" runs see the old schema.
+    for index in Resource.__table__.indexes:
+        index.drop(engine)
+    raw = engine.raw_connection()
+    try:
+        batch = []
+        for i in range(1, rows + 1):
+            published = first + timedelta(days=rng.randrange(span))
+            batch.append((i, f'file{i}.pdf', '2024-01-01 00:00:00.000000',
+                          f'Title {i}', f'Creator {i % 5000}',
+                          published.isoformat(), published.year,
+                          rng.choice(TYPES), rng.choice(LANGUAGES)))
+            if len(batch) == 10000 or i == rows:
+                raw.executemany(
+                    'INSERT INTO resource (id, filename, upload_date, title, creator, '
+                    'publication_date, publication_year, resource_type, language) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', batch)
+                batch = []
+        raw.commit()
+    finally:
+        raw.close()
+
+
+def _measure(conn, statement, repeat):
+    sql = str(statement.compile(conn, compile_kwargs={'literal_binds': True}))
+    plan = [row[3] for row in conn.exec_driver_sql(f'EXPLAIN QUERY PLAN {sql}')]
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        conn.exec_driver_sql(sql).fetchall()
+        timings.append(time.perf_counter() - started)
+    return plan, statistics.median(timings) * 1000
+
+
+def year_filter_benchmark(rows=500000, repeat=5, seed=1, out=print):
+    """
+    Builds a throwaway catalogue of `rows` resources and compares the query
+    plans and median times of the year filters before (extract() on an
+    unindexed column) and after (date ranges on the composite indexes).
+    """
+    handle, path = tempfile.mkstemp(suffix='.db')
+    os.close(handle)
+    engine = create_engine(f'sqlite:///{path}')
+    try:
+        out(f'Populating {rows} resources...')
+        _populate(engine, rows, seed)
+        results = []
+        with engine.connect() as conn:
+            for label, old, _ in _cases():
+                results.append([label, _measure(conn, old, repeat)])
+        for index in Resource.__table__.indexes:
+            index.create(engine)
+        with engine.connect() as conn:
+            conn.exec_driver_sql('ANALYZE')
+            for result, (_, _, new) in zip(results, _cases()):
+                result.append(_measure(conn, new, repeat))
+
+        for label, (old_plan, old_ms), (new_plan, new_ms) in results:
+            out(f'\n{label}')
+            out(f'  before: {old_ms:9.2f} ms  ' + ' | '.join(old_plan))
+            out(f'  after:  {new_ms:9.2f} ms  ' + ' | '.join(new_plan))
+    finally:
+        engine.dispose()
+        os.remove(path)
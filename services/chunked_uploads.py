@@ -0,0 +1,195 @@
+import hashlib
+import hmac
+import mimetypes
+import os
+import shutil
+import threading
+import uuid
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from werkzeug.utils import secure_filename
+from flask_babel import gettext as _
+from models import db, UploadSession
+from services.storage import blob_store
+
+
+class UploadError(Exception):
+    """A rejected upload request, with the HTTP status to answer with."""
+
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+
+class ChunkedUploads:
+    """
+    Resumable uploads of large resource files, sent as a series of chunks.
+
+    start() opens a session for a file of known size; each chunk is then
+    PUT at the offset the server reports, with its SHA-256. Chunks are
+    streamed from the request to a file of their own in the blob store's
+    temp folder, hashed on the way, and only appended to the upload's part
+    file once the hash matches and the offset is claimed: after a dropped
+    connection the client asks for the offset and sends the rest. At most
+    UPLOAD_MAX_CONCURRENT chunks are written at once per process, so
+    uploads cannot take every worker; the others are told to retry.
+    finish() hands the complete file to the blob store for admin.upload.
+    Sessions idle for UPLOAD_SESSION_SECONDS are dropped.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('UPLOAD_CHUNK_SIZE', 8 * 1024 * 1024)
+        app.config.setdefault('UPLOAD_MAX_SIZE', 1024 * 1024 * 1024)
+        app.config.setdefault('UPLOAD_MAX_CONCURRENT', 4)
+        app.config.setdefault('UPLOAD_SESSION_SECONDS', 86400)
+        self.app = app
+        self._slots = threading.BoundedSemaphore(app.config['UPLOAD_MAX_CONCURRENT'])
+        app.extensions['chunked_uploads'] = self
+
+    def _part(self, session_id):
+        return os.path.join(blob_store.temp_dir(), f'upload-{session_id}.part')
+
+    def start(self, user_id, filename, size, allowed, content_type=None, sha256=None):
+        """Opens a session for `filename`, whose extension must be `allowed`."""
+        name = secure_filename(filename or '')
+        if os.path.splitext(name)[1][1:].lower() not in allowed:
+            raise UploadError(_('Only PDF, EPUB, and HTML files are allowed!'))
+        if not isinstance(size, int) or size <= 0:
+            raise UploadError(_('The file size is required.'))
+        if size > self.app.config['UPLOAD_MAX_SIZE']:
+            raise UploadError(_('The file is too large.'), 413)
+        if sha256 is not None and (len(sha256) != 64 or not _is_hex(sha256)):
+            raise UploadError(_('Invalid SHA-256.'))
+        self.expire()
+        session = UploadSession(
+            id=uuid.uuid4().hex, user_id=user_id, filename=name[:100], size=size,
+            content_type=content_type or mimetypes.guess_type(name)[0], sha256=sha256)
+        open(self._part(session.id), 'wb').close()
+        db.session.add(session)
+        db.session.commit()
+        return session
+
+    def get(self, session_id, user_id):
+        session = db.session.get(UploadSession, session_id)
+        if session is None or session.user_id != user_id:
+            raise UploadError(_('Unknown upload.'), 404)
+        return session
+
+    def write_chunk(self, session, offset, stream, length, checksum):
+        """
+        Writes `length` bytes from `stream` at `offset`, which must be where
+        the session stands. Returns the new offset.
+        """
+        if offset != session.received:
+            raise UploadError(_('Wrong offset.'), 409, offset=session.received)
+        if length is None or length <= 0 or length > self.app.config['UPLOAD_CHUNK_SIZE']:
+            raise UploadError(_('Chunks must have a length of at most %(size)d bytes.',
+                                size=self.app.config['UPLOAD_CHUNK_SIZE']), 413)
+        if offset + length > session.size:
+            raise UploadError(_('The chunk goes past the end of the file.'))
+        if not checksum:
+            raise UploadError(_('The chunk checksum is missing.'))
+        if not self._slots.acquire(blocking=False):
+            raise UploadError(_('Too many uploads in progress.'), 503)
+        chunk = os.path.join(blob_store.temp_dir(),
+                             f'upload-{session.id}-{uuid.uuid4().hex}.chunk')
+        try:
+            # Each attempt streams to its own file, so a failed or racing
+            # retry never touches the bytes already accepted.
+            digest = hashlib.sha256()
+            remaining = length
+            with open(chunk, 'wb') as f:
+                while remaining:
+                    data = stream.read(min(remaining, 64 * 1024))
+                    if not data:
+                        raise UploadError(_('The chunk was cut short.'), offset=session.received)
+                    digest.update(data)
+                    f.write(data)
+                    remaining -= len(data)
+            if not hmac.compare_digest(digest.hexdigest(), checksum.lower()):
+                raise UploadError(_('Chunk checksum mismatch.'), 422, offset=session.received)
+            # The conditional update claims the offset: of two requests
+            # racing for it, one advances it and the other gets a 409. The
+            # chunk is spliced in before the commit, so the offset never
+            # moves past bytes that are not in the part file.
+            result = db.session.execute(update(UploadSession).where(
+                UploadSession.id == session.id, UploadSession.received == offset).values(
+                received=offset + length, updated_at=datetime.utcnow()))
+            if result.rowcount != 1:
+                db.session.rollback()
+                db.session.refresh(session)
+                raise UploadError(_('Wrong offset.'), 409, offset=session.received)
+            try:
+                _splice(chunk, self._part(session.id), offset)
+            except BaseException:
+                db.session.rollback()
+                raise
+            db.session.commit()
+        finally:
+            self._slots.release()
+            _remove(chunk)
+        db.session.refresh(session)
+        return session.received
+
+    def finish(self, session):
+        """Stores a complete upload in the blob store; returns its StoredFile."""
+        if not session.complete:
+            raise UploadError(_('The upload is not complete.'), 409, offset=session.received)
+        expected, part = session.sha256, self._part(session.id)
+        stored = blob_store.save_file(part, session.filename)
+        db.session.delete(session)
+        db.session.commit()
+        if expected and expected.lower() != stored.sha256:
+            # The blob stays unreferenced until the sweeper removes it.
+            raise UploadError(_('The file does not match its checksum.'), 422)
+        return stored
+
+    def cancel(self, session):
+        part = self._part(session.id)
+        db.session.delete(session)
+        db.session.commit()
+        _remove(part)
+
+    def expire(self):
+        """Drops the sessions idle for longer than UPLOAD_SESSION_SECONDS."""
+        cutoff = datetime.utcnow() - timedelta(seconds=self.app.config['UPLOAD_SESSION_SECONDS'])
+        stale = UploadSession.query.filter(UploadSession.updated_at < cutoff).all()
+        parts = [self._part(session.id) for session in stale]
+        for session in stale:
+            db.session.delete(session)
+        db.session.commit()
+        for part in parts:
+            _remove(part)
+        return len(stale)
+
+
+def _is_hex(value):
+    try:
+        int(value, 16)
+    except ValueError:
+        return False
+    return True
+
+
+def _splice(chunk, part, offset):
+    with open(chunk, 'rb') as source, open(part, 'r+b') as target:
+        target.seek(offset)
+        shutil.copyfileobj(source, target, 1024 * 1024)
+        target.truncate()
+        target.flush()
+        os.fsync(target.fileno())
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+chunked_uploads = ChunkedUploads()
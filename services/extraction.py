@@ -0,0 +1,191 @@
+import os
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from functools import partial
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from models import db, Resource, ResourceText
+from services.signals import resource_saved, ensure_committed
+from services.storage import is_blob
+from services.processes import process_pool
+
+
+def extract_text(path, max_chars):
+    """
+    Reads the text, page count and size of one file. Runs in a worker
+    process, so it only takes and returns plain values.
+    """
+    try:
+        size = os.path.getsize(path)
+        if not path.lower().endswith('.pdf'):
+            return {'status': 'skipped', 'byte_size': size}
+        from pypdf import PdfReader
+        reader = PdfReader(path)
+        parts = []
+        length = 0
+        for page in reader.pages:
+            if length >= max_chars:
+                break
+            # Collapse the layout whitespace; only the words are indexed.
+            chunk = ' '.join((page.extract_text() or '').split())
+            if chunk:
+                parts.append(chunk)
+                length += len(chunk) + 1
+        return {'status': 'done', 'body': ' '.join(parts)[:max_chars] or None,
+                'page_count': len(reader.pages), 'byte_size': size}
+    except Exception as e:
+        return {'status': 'failed', 'error': f'{type(e).__name__}: {e}'[:250]}
+
+
+class TextExtractor:
+    """
+    Extracts the text of uploaded files into ResourceText in a pool of
+    worker processes.
+
+    A saved resource whose file is new or replaced gets a 'pending' row and
+    is queued; the upload request never waits for it. Results are written
+    back from the pool's callback thread and reach the FTS index through
+    the resource_text triggers. Pending rows survive a crash and are
+    queued again on the first request after a restart. EXTRACTION_WORKERS
+    = 0 turns background extraction off, leaving it to `flask extract-text`.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._resumed = False
+        self.results = Counter()   # status -> background extractions
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('EXTRACTION_WORKERS', 2)
+        app.config.setdefault('EXTRACTION_MAX_CHARS', 200000)
+        app.extensions['text_extractor'] = self
+        if not app.config['EXTRACTION_WORKERS']:
+            return
+        resource_saved.connect(self._on_saved, sender=app, weak=False)
+
+        @app.before_request
+        def resume_pending_extractions():
+            if not self._resumed:
+                self.resume(app)
+
+    def _pool(self, app):
+        with self._lock:
+            if self._executor is None:
+                self._executor = process_pool(app.config['EXTRACTION_WORKERS'])
+            return self._executor
+
+    def _on_saved(self, sender, resource, **extra):
+        ensure_committed()
+        resource_id, filename = resource.id, resource.filename
+        # A transaction of its own, so the sender's session is left alone.
+        with db.engine.begin() as connection:
+            record = connection.execute(
+                select(ResourceText.filename, ResourceText.updated_at).where(
+                    ResourceText.resource_id == resource_id)).first()
+            if record is not None and record.filename == filename \
+                    and not _modified_since(sender, record):
+                return
+            values = {'filename': filename, 'status': 'pending', 'body': None,
+                      'page_count': None, 'byte_size': None, 'error': None,
+                      'updated_at': datetime.utcnow()}
+            connection.execute(insert(ResourceText).values(
+                resource_id=resource_id, **values).on_conflict_do_update(
+                index_elements=[ResourceText.resource_id], set_=values))
+        self.submit(sender, resource_id, filename)
+
+    def submit(self, app, resource_id, filename):
+        future = self._pool(app).submit(
+            extract_text, _path(app, filename), app.config['EXTRACTION_MAX_CHARS'])
+        future.add_done_callback(partial(self._done, app, resource_id, filename))
+
+    def _done(self, app, resource_id, filename, future):
+        try:
+            result = future.result()
+        except Exception as e:  # the worker died, e.g. BrokenProcessPool
+            result = {'status': 'failed', 'error': f'{type(e).__name__}: {e}'[:250]}
+        self.results[result['status']] += 1
+        with app.app_context():
+            store(resource_id, filename, result)
+
+    def resume(self, app):
+        """Queues every row left pending, e.g. by a crash mid-extraction."""
+        with self._lock:
+            if self._resumed:
+                return
+            self._resumed = True
+        pending = db.session.query(ResourceText.resource_id, ResourceText.filename).filter(
+            ResourceText.status == 'pending').all()
+        for resource_id, filename in pending:
+            self.submit(app, resource_id, filename)
+        return len(pending)
+
+
+def _path(app, filename):
+    return os.path.join(app.config['UPLOAD_FOLDER'], filename)
+
+
+def _modified_since(app, record):
+    # An upload under the same name overwrites a legacy file in place;
+    # a blob's name is its content, so it never changes.
+    if is_blob(record.filename):
+        return False
+    try:
+        mtime = os.path.getmtime(_path(app, record.filename))
+    except OSError:
+        return False
+    return datetime.fromtimestamp(mtime, timezone.utc).replace(tzinfo=None) > record.updated_at
+
+
+def store(resource_id, filename, result):
+    """Saves an extraction result, unless the file was replaced meanwhile."""
+    record = db.session.get(ResourceText, resource_id)
+    if record is None or record.filename != filename:
+        return False
+    record.status = result['status']
+    record.body = result.get('body')
+    record.page_count = result.get('page_count')
+    record.byte_size = result.get('byte_size')
+    record.error = result.get('error')
+    record.updated_at = datetime.utcnow()
+    db.session.commit()
+    return True
+
+
+def backfill(app, retry_failed=False, workers=None):
+    """
+    Extracts every resource that has no text yet, or whose file changed,
+    plus the pending rows (and failed ones with `retry_failed`). Runs the
+    pool in the foreground and returns a count per status.
+    """
+    statuses = ['pending', 'failed'] if retry_failed else ['pending']
+    todo = db.session.query(Resource.id, Resource.filename).outerjoin(
+        ResourceText).filter(db.or_(
+            ResourceText.resource_id.is_(None),
+            ResourceText.filename != Resource.filename,
+            ResourceText.status.in_(statuses))).all()
+    for resource_id, filename in todo:
+        record = db.session.get(ResourceText, resource_id) or ResourceText(
+            resource_id=resource_id)
+        record.filename = filename
+        record.status = 'pending'
+        db.session.add(record)
+    db.session.commit()
+
+    counts = {}
+    if not todo:
+        return counts
+    max_chars = app.config['EXTRACTION_MAX_CHARS']
+    with process_pool(workers or app.config['EXTRACTION_WORKERS']) as pool:
+        results = pool.map(extract_text, [_path(app, f) for _, f in todo],
+                           [max_chars] * len(todo))
+        for (resource_id, filename), result in zip(todo, results):
+            store(resource_id, filename, result)
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+    return counts
+
+
+text_extractor = TextExtractor()
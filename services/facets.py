@@ -0,0 +1,47 @@
+from sqlalchemy import select, union_all, literal, cast, func, String
+from models import db, Resource, resource_categories
+
+FACETS = ('type', 'lang', 'category', 'year')
+
+
+def facet_counts(base_query):
+    """
+    Computes every facet histogram for a search in one round trip.
+
+    The matching rows are materialized once in a CTE and each facet is a
+    GROUP BY over that CTE, glued together with UNION ALL, so the cost is
+    one pass over the matches no matter how many facets are shown.
+    Returns a dict of {facet: {value: count}} keyed by FACETS.
+    """
+    matches = base_query.with_entities(
+        Resource.id.label('id'),
+        Resource.resource_type.label('resource_type'),
+        Resource.language.label('language'),
+        Resource.publication_year.label('year')
+    ).order_by(None).cte('matches').prefix_with('MATERIALIZED')
+
+    def histogram(name, column, source=matches):
+        return select(
+            literal(name).label('facet'),
+            cast(column, String).label('value'),
+            func.count().label('count')
+        ).select_from(source).group_by(column)
+
+    categorized = matches.join(
+        resource_categories, resource_categories.c.resource_id == matches.c.id)
+
+    statement = union_all(
+        histogram('type', matches.c.resource_type),
+        histogram('lang', matches.c.language),
+        histogram('year', matches.c.year),
+        histogram('category', resource_categories.c.category_id, categorized),
+    )
+
+    counts = {facet: {} for facet in FACETS}
+    for facet, value, count in db.session.execute(statement):
+        if facet in ('category', 'year'):
+            if value is None:
+                continue
+            value = int(value)
+        counts[facet][value] = count
+    return counts
@@ -0,0 +1,40 @@
+from sqlalchemy import select, delete, func
+from sqlalchemy.dialects.sqlite import insert
+from models import db, Resource, favorites as table
+
+# Everything here goes through the (user_id, resource_id) primary key of
+# the favorites table, so no query reads a user's whole list.
+
+
+def among(user_id, resource_ids):
+    """The subset of `resource_ids` that `user_id` has favorited, in one query."""
+    resource_ids = list(resource_ids)
+    if not resource_ids:
+        return set()
+    return set(db.session.scalars(select(table.c.resource_id).where(
+        table.c.user_id == user_id, table.c.resource_id.in_(resource_ids))))
+
+
+def count(user_id):
+    return db.session.scalar(select(func.count()).select_from(table).where(
+        table.c.user_id == user_id))
+
+
+def query(user_id):
+    """Resource query of a user's favorites, joined rather than listed."""
+    return Resource.query.join(table, table.c.resource_id == Resource.id).filter(
+        table.c.user_id == user_id)
+
+
+def add(user_id, resource_id):
+    """Adds a favorite; False if it was already there. Not committed."""
+    result = db.session.execute(insert(table).values(
+        user_id=user_id, resource_id=resource_id).on_conflict_do_nothing())
+    return result.rowcount == 1
+
+
+def remove(user_id, resource_id):
+    """Removes a favorite; False if there was none. Not committed."""
+    result = db.session.execute(delete(table).where(
+        table.c.user_id == user_id, table.c.resource_id == resource_id))
+    return result.rowcount == 1
@@ -0,0 +1,200 @@
+import base64
+import hashlib
+import hmac
+import mimetypes
+import os
+import time
+from urllib.parse import quote
+from flask import current_app, request, send_file, send_from_directory, url_for, abort
+from werkzeug.security import safe_join
+from models import db
+
+# A year: the longest lifetime caches honour, for URLs that change with
+# their content.
+IMMUTABLE_MAX_AGE = 31536000
+
+# Folders under UPLOAD_FOLDER whose files are named after their content
+# (blobs and preview derivatives), so they never change under one name.
+CONTENT_ADDRESSED = ('blobs/', 'previews/')
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def upload_path(filename):
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
+
+
+def download_name(resource):
+    """The name a resource's file was uploaded under."""
+    return resource.original_filename or os.path.basename(resource.filename)
+
+
+def _offload(path, filename):
+    """
+    With FILE_OFFLOAD set, an empty response that has the proxy send the
+    file: 'x-accel' (nginx) redirects internally to FILE_OFFLOAD_PREFIX +
+    the path under UPLOAD_FOLDER, 'x-sendfile' (Apache, lighttpd) names
+    the file itself. The proxy answers Range requests and sends its own
+    validators; only Last-Modified is set here, so the internal location
+    should have `etag off`. Returns None without FILE_OFFLOAD.
+    """
+    mode = current_app.config['FILE_OFFLOAD']
+    if not mode:
+        return None
+    response = current_app.response_class(
+        mimetype=mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    if mode == 'x-accel':
+        prefix = current_app.config['FILE_OFFLOAD_PREFIX'].rstrip('/')
+        response.headers['X-Accel-Redirect'] = f'{prefix}/{quote(filename)}'
+    elif mode == 'x-sendfile':
+        response.headers['X-Sendfile'] = path
+    else:
+        raise ValueError(f'Unknown FILE_OFFLOAD mode: {mode!r}')
+    response.last_modified = int(os.path.getmtime(path))
+    response.make_conditional(request)
+    if response.status_code == 304:
+        # Answered here: nothing for the proxy to send.
+        response.headers.pop('X-Accel-Redirect', None)
+        response.headers.pop('X-Sendfile', None)
+    return response
+
+
+def is_offloaded(response):
+    return 'X-Accel-Redirect' in response.headers or 'X-Sendfile' in response.headers
+
+
+def send_resource(resource):
+    """
+    Sends a resource's file as an attachment, with its content hash as a
+    strong ETag. Werkzeug answers If-None-Match / If-Modified-Since with a
+    304 and Range / If-Range with a 206, so an interrupted download
+    resumes where it stopped. Whole files go out through the server's
+    wsgi.file_wrapper, which gunicorn implements with sendfile(2). With
+    FILE_OFFLOAD, the proxy sends the file instead (see _offload()).
+    """
+    path = os.path.abspath(upload_path(resource.filename))
+    if not os.path.isfile(path):
+        abort(404)
+    response = _offload(path, resource.filename)
+    if response is not None:
+        response.headers.set('Content-Disposition', 'attachment',
+                             filename=download_name(resource))
+        response.cache_control.max_age = current_app.config['DOWNLOAD_CACHE_SECONDS']
+    else:
+        if resource.content_hash is None:
+            # Files uploaded before hashes were stored get one on first use.
+            resource.content_hash = file_digest(path)
+            db.session.commit()
+        response = send_file(path, as_attachment=True,
+                             download_name=download_name(resource),
+                             etag=resource.content_hash, conditional=True,
+                             max_age=current_app.config['DOWNLOAD_CACHE_SECONDS'])
+    # Downloads need a login: only the browser's own cache may keep them.
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+def is_new_download(response):
+    """
+    Whether a response to a download starts a new download. A 304 sends
+    nothing, and a resumed or parallel range request continues one that
+    was already counted: only the part starting at byte 0 counts.
+    """
+    if request.method != 'GET':
+        return False
+    if response.status_code == 200 and is_offloaded(response):
+        # The proxy answers the Range header itself.
+        ranges = request.range
+        return ranges is None or not ranges.ranges or ranges.ranges[0][0] == 0
+    if response.status_code == 200:
+        return True
+    if response.status_code == 206:
+        content_range = response.content_range
+        return content_range is not None and content_range.start == 0
+    return False
+
+
+def upload_version(filename):
+    """A token that changes whenever the uploaded file is replaced."""
+    if filename.startswith(CONTENT_ADDRESSED):
+        # Named after their content: the name is the version.
+        return os.path.basename(filename)[:16]
+    try:
+        stat = os.stat(upload_path(filename))
+    except OSError:
+        return None
+    return f'{stat.st_mtime_ns:x}{stat.st_size:x}'
+
+
+def _signature(filename, expires):
+    key = current_app.config['SECRET_KEY'].encode()
+    mac = hmac.new(key, f'{filename}\n{expires}'.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(mac[:18]).decode()
+
+
+def upload_url(filename):
+    """
+    URL of an uploaded file, versioned so it can be cached for good. With
+    UPLOAD_URLS_SIGNED, it also carries an expiry and a signature. The
+    expiry is rounded up to a multiple of UPLOAD_URL_SECONDS, so a page
+    rendered twice in one period links the same, cached, URL; each URL is
+    valid for one to two periods.
+    """
+    params = {'v': upload_version(filename)}
+    if current_app.config['UPLOAD_URLS_SIGNED']:
+        period = current_app.config['UPLOAD_URL_SECONDS']
+        expires = (int(time.time()) // period + 2) * period
+        params.update(expires=expires, sig=_signature(filename, expires))
+    return url_for('main.serve_upload', filename=filename, **params)
+
+
+def _check_signature(filename):
+    """Seconds the signed URL of this request has left; aborts if invalid."""
+    expires = request.args.get('expires', type=int)
+    signature = request.args.get('sig', '')
+    remaining = (expires or 0) - int(time.time())
+    if expires is None or remaining <= 0 or \
+            not hmac.compare_digest(signature, _signature(filename, expires)):
+        abort(403)
+    return remaining
+
+
+def send_upload(filename):
+    """
+    Sends an uploaded file (e.g. a preview image). Requested through
+    upload_url(), whose version matches the file on disk, the response is
+    immutable; otherwise it is revalidated after UPLOAD_CACHE_SECONDS.
+    With UPLOAD_URLS_SIGNED, only unexpired signed URLs are served, and
+    caches keep the file no longer than the URL is valid.
+    """
+    lifetime = IMMUTABLE_MAX_AGE
+    if current_app.config['UPLOAD_URLS_SIGNED']:
+        lifetime = min(lifetime, _check_signature(filename))
+    if current_app.config['FILE_OFFLOAD']:
+        path = safe_join(os.path.abspath(current_app.config['UPLOAD_FOLDER']), filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = _offload(path, filename)
+        response.cache_control.max_age = current_app.config['UPLOAD_CACHE_SECONDS']
+    else:
+        response = send_from_directory(
+            current_app.config['UPLOAD_FOLDER'], filename, conditional=True,
+            max_age=current_app.config['UPLOAD_CACHE_SECONDS'])
+    version = request.args.get('v')
+    if version and version == upload_version(filename):
+        response.cache_control.public = True
+        response.cache_control.max_age = lifetime
+        response.cache_control.immutable = True
+    if current_app.config['UPLOAD_URLS_SIGNED']:
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.max_age = min(response.cache_control.max_age, lifetime)
+    return response
@@ -0,0 +1,156 @@
+import re
+from sqlalchemy import text, select, func, table, column, literal_column
+from models import db
+
+# SQLite FTS5 index over the searchable Resource columns plus the body text
+# extracted from uploaded files. It is an external-content table reading from
+# the `resource_search` view; the triggers below keep it in step with every
+# write to `resource` and `resource_text`, so the text is never stored twice.
+FTS_TABLE = 'resource_fts'
+FTS_VIEW = 'resource_search'
+FTS_COLUMNS = ('title', 'creator', 'subject', 'description', 'body')
+
+# bm25() weights, in FTS_COLUMNS order: a hit in the title counts for more
+# than one buried in the description or the full text.
+RANK_WEIGHTS = (10.0, 5.0, 3.0, 1.0, 0.5)
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+_cols = ', '.join(FTS_COLUMNS)
+_meta_cols = ', '.join(FTS_COLUMNS[:-1])
+_body = "(SELECT body FROM resource_text WHERE resource_id = {}.id)"
+_new_row = ', '.join(f'new.{c}' for c in FTS_COLUMNS[:-1]) + ', ' + _body.format('new')
+_old_row = ', '.join(f'old.{c}' for c in FTS_COLUMNS[:-1]) + ', ' + _body.format('old')
+
+# Identifies the current table definition; an index built with different
+# columns is dropped and rebuilt by init_fts().
+_FTS_SIGNATURE = f"{_cols}, content='{FTS_VIEW}'"
+
+_TRIGGERS = ('ai', 'ad', 'au', 'text_ai', 'text_au', 'text_ad')
+
+_DDL = [
+    f"""CREATE VIEW IF NOT EXISTS {FTS_VIEW} AS
+        SELECT resource.id, {', '.join(f'resource.{c}' for c in FTS_COLUMNS[:-1])},
+               resource_text.body
+        FROM resource LEFT JOIN resource_text
+        ON resource_text.resource_id = resource.id""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        {_FTS_SIGNATURE}, content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3')""",
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE}_vocab
+        USING fts5vocab({FTS_TABLE}, 'row')""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ai AFTER INSERT ON resource BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, {_cols}) VALUES (new.id, {_new_row});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_ad AFTER DELETE ON resource BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_cols})
+        VALUES ('delete', old.id, {_old_row});
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_au
+        AFTER UPDATE OF {_meta_cols} ON resource BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_cols})
+        VALUES ('delete', old.id, {_old_row});
+        INSERT INTO {FTS_TABLE}(rowid, {_cols}) VALUES (new.id, {_new_row});
+    END""",
+    # Body text changes re-index the owning resource with the new body.
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_text_ai AFTER INSERT ON resource_text BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_cols})
+        SELECT 'delete', id, {_meta_cols}, NULL FROM resource WHERE id = new.resource_id;
+        INSERT INTO {FTS_TABLE}(rowid, {_cols})
+        SELECT id, {_meta_cols}, new.body FROM resource WHERE id = new.resource_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_text_au
+        AFTER UPDATE OF body ON resource_text BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_cols})
+        SELECT 'delete', id, {_meta_cols}, old.body FROM resource WHERE id = old.resource_id;
+        INSERT INTO {FTS_TABLE}(rowid, {_cols})
+        SELECT id, {_meta_cols}, new.body FROM resource WHERE id = new.resource_id;
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS {FTS_TABLE}_text_ad AFTER DELETE ON resource_text BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, {_cols})
+        SELECT 'delete', id, {_meta_cols}, old.body FROM resource WHERE id = old.resource_id;
+        INSERT INTO {FTS_TABLE}(rowid, {_cols})
+        SELECT id, {_meta_cols}, NULL FROM resource WHERE id = old.resource_id;
+    END""",
+]
+
+fts_table = table(FTS_TABLE, column('rowid'))
+
+
+def _drop(conn):
+    for trigger in _TRIGGERS:
+        conn.execute(text(f"DROP TRIGGER IF EXISTS {FTS_TABLE}_{trigger}"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}_vocab"))
+    conn.execute(text(f"DROP TABLE IF EXISTS {FTS_TABLE}"))
+    conn.execute(text(f"DROP VIEW IF EXISTS {FTS_VIEW}"))
+
+
+def init_fts():
+    """Creates the FTS table and its sync triggers, populating it on first run."""
+    with db.engine.begin() as conn:
+        current = conn.execute(text(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"
+        ), {'name': FTS_TABLE}).scalar()
+        if current is not None and _FTS_SIGNATURE not in current:
+            _drop(conn)
+            current = None
+        for statement in _DDL:
+            conn.execute(text(statement))
+        if current is None:
+            conn.execute(text(
+                f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+
+
+def rebuild_fts():
+    """Drops and re-creates the index from the current catalogue and texts."""
+    with db.engine.begin() as conn:
+        _drop(conn)
+    init_fts()
+    return db.session.execute(text(f"SELECT count(*) FROM {FTS_TABLE}")).scalar()
+
+
+def tokenize(value):
+    return _TOKEN_RE.findall(value or '')
+
+
+def document_frequency(prefix):
+    """Roughly how many resources contain a word starting with `prefix`."""
+    return db.session.execute(text(
+        f"SELECT coalesce(sum(doc), 0) FROM {FTS_TABLE}_vocab "
+        "WHERE term >= :low AND term < :high"
+    ), {'low': prefix.lower(), 'high': prefix.lower() + '\U0010ffff'}).scalar()
+
+
+def term_expression(term, field='all'):
+    """
+    Turns free text into an FTS5 expression: every word becomes a quoted
+    prefix token and all of them must match. Returns None if the text has
+    no searchable words. `field` restricts the match to one column.
+    """
+    tokens = tokenize(term)
+    if not tokens:
+        return None
+    expression = ' '.join(f'"{token}"*' for token in tokens)
+    if field in FTS_COLUMNS:
+        return f'{field} : ({expression})'
+    return expression
+
+
+def _match(expression):
+    return literal_column(f'{FTS_TABLE}.{FTS_TABLE}').op('MATCH')(expression)
+
+
+def match_ids(expression):
+    """SELECT of the ids matching an FTS5 expression, for IN (...) filters."""
+    return select(fts_table.c.rowid).where(_match(expression))
+
+
+def match_subquery(expression):
+    """
+    Subquery of (resource_id, rank) for every resource matching an FTS5
+    expression. Lower rank is more relevant, so order by it ascending.
+    """
+    return select(
+        fts_table.c.rowid.label('resource_id'),
+        func.bm25(literal_column(FTS_TABLE), *RANK_WEIGHTS).label('rank')
+    ).where(_match(expression)).subquery()
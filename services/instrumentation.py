@@ -0,0 +1,135 @@
+import re
+import threading
+import time
+from collections import Counter
+from flask import g, has_app_context, request, request_started, request_finished, \
+    before_render_template, template_rendered
+from sqlalchemy import event
+from models import db
+
+_SPACES = re.compile(r'\s+')
+
+
+class EndpointStats:
+    __slots__ = ('requests', 'total', 'sql', 'queries', 'render', 'repeated')
+
+    def __init__(self):
+        self.requests = 0
+        self.total = self.sql = self.render = 0.0
+        self.queries = 0
+        self.repeated = Counter()   # statement -> requests it was repeated in
+
+    def as_dict(self):
+        return {'requests': self.requests, 'total': self.total, 'sql': self.sql,
+                'queries': self.queries, 'render': self.render,
+                'repeated': dict(self.repeated)}
+
+
+class RequestTimings:
+    """
+    Where the time of a request goes: query count, SQL time, template
+    render time and total time, sent back as a Server-Timing header and
+    added up per endpoint for the admin slow queries page.
+
+    Statements run at least SERVER_TIMING_REPEAT times in one request are
+    logged as N+1 suspects (one query per row of an earlier result).
+    Nothing is hooked unless SERVER_TIMING is on, so it costs nothing when
+    it is off.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self.endpoints = {}   # endpoint -> EndpointStats
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SERVER_TIMING', False)
+        app.config.setdefault('SERVER_TIMING_REPEAT', 5)
+        self.app = app
+        app.extensions['request_timings'] = self
+        if not app.config['SERVER_TIMING']:
+            return
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+        request_started.connect(self._started, sender=app, weak=False)
+        request_finished.connect(self._finished, sender=app, weak=False)
+        before_render_template.connect(self._before_render, sender=app, weak=False)
+        template_rendered.connect(self._rendered, sender=app, weak=False)
+
+    # --- Collection ---
+
+    def _started(self, sender, **extra):
+        g._timings = {'start': time.perf_counter(), 'sql': 0.0, 'render': 0.0,
+                      'rendering': None, 'statements': Counter()}
+
+    def _current(self):
+        # Queries outside a request (CLI, background threads) are not timed.
+        return g.get('_timings') if has_app_context() else None
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        timings = self._current()
+        if timings is not None:
+            conn.info.setdefault('_timings_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        timings = self._current()
+        starts = conn.info.get('_timings_start')
+        if timings is None or not starts:
+            return
+        timings['sql'] += time.perf_counter() - starts.pop()
+        timings['statements'][statement] += 1
+
+    def _before_render(self, sender, template, context, **extra):
+        timings = self._current()
+        if timings is not None and timings['rendering'] is None:
+            timings['rendering'] = time.perf_counter()
+
+    def _rendered(self, sender, template, context, **extra):
+        timings = self._current()
+        if timings is not None and timings['rendering'] is not None:
+            timings['render'] += time.perf_counter() - timings['rendering']
+            timings['rendering'] = None
+
+    def _finished(self, sender, response, **extra):
+        timings = g.pop('_timings', None)
+        if timings is None:
+            return
+        total = time.perf_counter() - timings['start']
+        statements = timings['statements']
+        queries = sum(statements.values())
+        endpoint = request.endpoint or 'unknown'
+        repeated = [(statement, count) for statement, count in statements.items()
+                    if count >= sender.config['SERVER_TIMING_REPEAT']]
+        for statement, count in repeated:
+            sender.logger.warning('Possible N+1 in %s: %d times %s', endpoint, count,
+                                  _SPACES.sub(' ', statement)[:300])
+
+        with self._lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.requests += 1
+            stats.total += total
+            stats.sql += timings['sql']
+            stats.render += timings['render']
+            stats.queries += queries
+            for statement, _ in repeated:
+                stats.repeated[_SPACES.sub(' ', statement)] += 1
+
+        metrics = [f'db;dur={timings["sql"] * 1000:.1f};desc="{queries} queries"',
+                   f'tpl;dur={timings["render"] * 1000:.1f}',
+                   f'total;dur={total * 1000:.1f}']
+        if repeated:
+            metrics.append(f'nplus1;desc="{len(repeated)} repeated statements"')
+        response.headers.add('Server-Timing', ', '.join(metrics))
+
+    def snapshot(self):
+        """{endpoint: totals} since the process started."""
+        with self._lock:
+            return {endpoint: stats.as_dict() for endpoint, stats in self.endpoints.items()}
+
+
+request_timings = RequestTimings()
@@ -0,0 +1,143 @@
+import atexit
+import os
+import queue
+import threading
+import time
+from sqlalchemy import insert
+from models import db
+from services.signals import logs_written
+
+
+class LogWriter:
+    """
+    Write-behind buffer for the append-only logs (searches, downloads).
+
+    Routes call enqueue() and return; a background thread inserts the
+    queued rows in one transaction per batch, every LOG_FLUSH_SECONDS or
+    as soon as LOG_BATCH_SIZE rows are waiting. The queue holds at most
+    LOG_QUEUE_SIZE rows: past that, new rows are dropped and counted
+    rather than growing memory or blocking the request. Whatever is still
+    queued is written when the process exits. With LOG_WRITE_BEHIND off,
+    enqueue() writes straight away (for scripts and tests).
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('LOG_WRITE_BEHIND', True)
+        app.config.setdefault('LOG_BATCH_SIZE', 200)
+        app.config.setdefault('LOG_FLUSH_SECONDS', 2.0)
+        app.config.setdefault('LOG_QUEUE_SIZE', 10000)
+        self.app = app
+        self._queue = queue.Queue(maxsize=app.config['LOG_QUEUE_SIZE'])
+        self._batch_size = app.config['LOG_BATCH_SIZE']
+        self._interval = app.config['LOG_FLUSH_SECONDS']
+        app.extensions['log_writer'] = self
+        atexit.register(self.close)
+
+    def enqueue(self, model, **values):
+        """
+        Queues one row for `model`. Column defaults such as the timestamps
+        are filled in now, so they record when the event happened rather
+        than when its batch was written.
+        """
+        for column in model.__table__.columns:
+            if column.key not in values and column.default is not None \
+                    and column.default.is_callable:
+                values[column.key] = column.default.arg(None)
+        if not self.app.config['LOG_WRITE_BEHIND']:
+            self._write([(model, values)])
+            return
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait((model, values))
+        except queue.Full:
+            self.dropped += 1
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def _ensure_thread(self):
+        # A worker forked from a parent that already started the thread has
+        # none of its own: start one per process.
+        if self._running():
+            return
+        with self._lock:
+            if not self._running():
+                self._pid = os.getpid()
+                self._stopping.clear()
+                self._thread = threading.Thread(
+                    target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+
+    def _running(self):
+        return (self._thread is not None and self._pid == os.getpid()
+                and self._thread.is_alive())
+
+    def _take(self, timeout):
+        """Waits up to `timeout` for a full batch; returns what it got."""
+        batch = []
+        deadline = time.monotonic() + timeout
+        while len(batch) < self._batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while not self._stopping.is_set():
+            batch = self._take(self._interval)
+            if batch:
+                self._write(batch)
+
+    def _write(self, batch):
+        by_model = {}
+        for model, values in batch:
+            by_model.setdefault(model, []).append(values)
+        with self.app.app_context():
+            try:
+                for model, rows in by_model.items():
+                    db.session.execute(insert(model), rows)
+                logs_written.send(self.app, rows=by_model)
+                db.session.commit()
+                self.written += len(batch)
+            except Exception:
+                db.session.rollback()
+                self.failed += len(batch)
+                self.app.logger.exception('Could not write %d log rows', len(batch))
+
+    def flush(self):
+        """Writes everything queued so far from the calling thread."""
+        while True:
+            batch = []
+            while len(batch) < self._batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                return
+            self._write(batch)
+
+    def close(self):
+        self._stopping.set()
+        if self._running():
+            self._thread.join(timeout=self._interval + 5)
+        self.flush()
+
+
+log_writer = LogWriter()
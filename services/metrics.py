@@ -0,0 +1,284 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from ipaddress import ip_address
+from flask import Response, abort, g, request, request_started, request_finished
+from flask_login import current_user
+from models import db
+from services.processes import alive
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RESULT_COUNT_BUCKETS = (0, 1, 5, 10, 25, 50, 100, 250, 1000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metrics:
+    """
+    Counters, gauges and histograms in the Prometheus text format, served
+    at /metrics.
+
+    Every request is counted and timed per blueprint and endpoint; routes
+    add their own values with inc() and observe(), and collectors read
+    the counters the other services already keep (result cache, log
+    writer, text extractor, connection pool) when the metrics are
+    written out. Updates take one lock and a few dict operations.
+
+    Each process only sees its own requests. With METRICS_DIR set, every
+    worker writes its values to <METRICS_DIR>/<pid>.json at most every
+    METRICS_FLUSH_SECONDS and /metrics adds up the files: counters and
+    histograms of every process that ever ran (empty the folder when the
+    server restarts), gauges of the live ones only. METRICS_TOKEN, when
+    set, is required as a bearer token; without it, only admins and
+    requests from the loopback address are answered (behind a proxy on
+    the same host every request looks local, so set a token there).
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._flushed = 0.0
+        self.enabled = False
+        self._help = {}          # name -> (type, help, buckets)
+        self._values = {}        # (name, labels) -> value
+        self._histograms = {}    # (name, labels) -> [bucket counts..., sum, count]
+        self._collectors = []    # (name, fn() -> [(labels dict, value)])
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('METRICS_ENABLED', True)
+        app.config.setdefault('METRICS_DIR', None)
+        app.config.setdefault('METRICS_FLUSH_SECONDS', 5)
+        app.config.setdefault('METRICS_TOKEN', None)
+        self.app = app
+        app.extensions['metrics'] = self
+        self.enabled = app.config['METRICS_ENABLED']
+        if not self.enabled:
+            return
+        self.describe('http_requests_total', 'counter', 'Requests answered.')
+        self.describe('http_request_duration_seconds', 'histogram',
+                      'Time to answer a request.', LATENCY_BUCKETS)
+        self.describe('download_bytes_total', 'counter',
+                      'Bytes of resource files sent by the app (not by an offloading proxy).')
+        self.describe('search_results', 'histogram', 'Matches per search.',
+                      RESULT_COUNT_BUCKETS)
+        self._builtin_collectors()
+        app.add_url_rule('/metrics', 'metrics', self.view)
+        request_started.connect(self._started, sender=app, weak=False)
+        request_finished.connect(self._finished, sender=app, weak=False)
+        if app.config['METRICS_DIR']:
+            os.makedirs(app.config['METRICS_DIR'], exist_ok=True)
+            atexit.register(self.flush)
+
+    # --- Recording ---
+
+    def describe(self, name, kind, text, buckets=None):
+        self._help[name] = (kind, text, buckets)
+
+    def collector(self, name, kind, text, collect):
+        """Registers `collect() -> [(labels dict, value)]`, run at each export."""
+        self.describe(name, kind, text)
+        self._collectors.append((name, collect))
+
+    def _fork_check(self):
+        # A worker forked after values were recorded starts from zero, or
+        # the parent's values would be counted once per worker.
+        if self._pid != os.getpid():
+            with self._lock:
+                self._pid = os.getpid()
+                self._values.clear()
+                self._histograms.clear()
+                self._flushed = 0.0
+
+    def inc(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        if not self.enabled:
+            return
+        buckets = self._help[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                counts = self._histograms[key] = [0] * (len(buckets) + 3)
+            counts[bisect_left(buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def _started(self, sender, **extra):
+        self._fork_check()
+        g._metrics_start = time.perf_counter()
+
+    def _finished(self, sender, response, **extra):
+        start = g.pop('_metrics_start', None)
+        if start is None:
+            return
+        endpoint = request.endpoint or 'none'
+        blueprint = request.blueprint or 'app'
+        self.observe('http_request_duration_seconds', time.perf_counter() - start,
+                     blueprint=blueprint, endpoint=endpoint)
+        self.inc('http_requests_total', blueprint=blueprint, endpoint=endpoint,
+                 method=request.method, status=str(response.status_code))
+        if sender.config['METRICS_DIR'] and \
+                time.monotonic() - self._flushed >= sender.config['METRICS_FLUSH_SECONDS']:
+            self.flush()
+
+    def _builtin_collectors(self):
+        from services.result_cache import result_cache
+        from services.log_writer import log_writer
+        from services.extraction import text_extractor
+
+        self.collector('search_cache_hits_total', 'counter', 'Search result cache hits.',
+                       lambda: [({}, result_cache.hits)])
+        self.collector('search_cache_misses_total', 'counter', 'Search result cache misses.',
+                       lambda: [({}, result_cache.misses)])
+        self.collector('log_writer_rows_total', 'counter', 'Log rows by outcome.',
+                       lambda: [({'outcome': 'written'}, log_writer.written),
+                                ({'outcome': 'dropped'}, log_writer.dropped),
+                                ({'outcome': 'failed'}, log_writer.failed)])
+        self.collector('log_writer_pending_rows', 'gauge', 'Log rows waiting to be written.',
+                       lambda: [({}, log_writer.pending)])
+        self.collector('text_extractions_total', 'counter', 'Background extractions by result.',
+                       lambda: [({'status': status}, count) for status, count
+                                in sorted(text_extractor.results.items())])
+
+        def pool():
+            with self.app.app_context():
+                engine_pool = db.engine.pool
+            values = [({'state': 'checked_out'}, _call(engine_pool, 'checkedout'))]
+            values.append(({'state': 'size'}, _call(engine_pool, 'size')))
+            return [(labels, value) for labels, value in values if value is not None]
+        self.collector('db_pool_connections', 'gauge', 'Database connections.', pool)
+
+    # --- Export ---
+
+    def _local(self):
+        """This process's values: (values, histograms, gauges)."""
+        self._fork_check()
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: list(counts) for key, counts in self._histograms.items()}
+        gauges = {}
+        for name, collect in self._collectors:
+            target = gauges if self._help[name][0] == 'gauge' else values
+            for labels, value in collect():
+                target[name, tuple(sorted(labels.items()))] = value
+        return values, histograms, gauges
+
+    def flush(self):
+        """Writes this process's values to METRICS_DIR."""
+        folder = self.app.config['METRICS_DIR']
+        if not folder:
+            return
+        values, histograms, gauges = self._local()
+        data = {kind: [[name, list(map(list, labels)), value]
+                       for (name, labels), value in items.items()]
+                for kind, items in (('values', values), ('histograms', histograms),
+                                    ('gauges', gauges))}
+        path = os.path.join(folder, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(data, f)
+        os.replace(path + '.tmp', path)
+        self._flushed = time.monotonic()
+
+    def _merged(self):
+        folder = self.app.config['METRICS_DIR']
+        if not folder:
+            return self._local()
+        self.flush()
+        values, histograms, gauges = {}, {}, {}
+        for path in glob.glob(os.path.join(folder, '*.json')):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue
+            live = alive(int(os.path.basename(path)[:-5]))
+            for name, labels, value in data['values']:
+                key = (name, tuple(map(tuple, labels)))
+                values[key] = values.get(key, 0) + value
+            for name, labels, counts in data['histograms']:
+                key = (name, tuple(map(tuple, labels)))
+                total = histograms.setdefault(key, [0] * len(counts))
+                histograms[key] = [a + b for a, b in zip(total, counts)]
+            for name, labels, value in data['gauges'] if live else ():
+                key = (name, tuple(map(tuple, labels)))
+                gauges[key] = gauges.get(key, 0) + value
+        return values, histograms, gauges
+
+    def render(self):
+        """The metrics in the Prometheus text exposition format."""
+        values, histograms, gauges = self._merged()
+        samples = {}
+        for (name, labels), value in sorted(values.items()) + sorted(gauges.items()):
+            samples.setdefault(name, []).append(f'{name}{_labels(labels)} {_number(value)}')
+        for (name, labels), counts in sorted(histograms.items()):
+            lines = samples.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self._help[name][2] + (float('inf'),), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels(labels + (("le", _number(bound)),))} '
+                             f'{cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(counts[-2])}')
+            lines.append(f'{name}_count{_labels(labels)} {counts[-1]}')
+        out = []
+        for name in sorted(samples):
+            kind, text, _ = self._help.get(name, ('untyped', '', None))
+            out.append(f'# HELP {name} {text}')
+            out.append(f'# TYPE {name} {kind}')
+            out.extend(samples[name])
+        return '\n'.join(out) + '\n'
+
+    def view(self):
+        token = self.app.config['METRICS_TOKEN']
+        if token:
+            if request.headers.get('Authorization') != f'Bearer {token}':
+                abort(403)
+        elif not _is_local(request.remote_addr) and not (
+                current_user.is_authenticated and current_user.role == 'admin'):
+            abort(403)
+        return Response(self.render(), content_type=CONTENT_TYPE)
+
+
+def _call(obj, method):
+    # SQLite's single-connection pools have no size() or checkedout().
+    fn = getattr(obj, method, None)
+    return fn() if fn is not None else None
+
+
+def _is_local(address):
+    try:
+        return ip_address(address).is_loopback
+    except ValueError:
+        return False
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
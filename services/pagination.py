@@ -0,0 +1,158 @@
+import base64
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import date, datetime
+from math import ceil
+from sqlalchemy import and_, or_, false
+
+
+class KeysetPage:
+    """
+    One page of a cursor (seek) paginated query.
+
+    `order` is a list of (column, descending) pairs whose last column is
+    unique, so every row has a distinct position. Pages are fetched with a
+    WHERE on the boundary row's sort key instead of an OFFSET, which keeps
+    deep pages as cheap as the first one. `page` is only a display hint
+    carried along in the URL.
+    """
+
+    def __init__(self, query, order, per_page, after=None, before=None,
+                 page=1, total=None):
+        self.order = order
+        self.per_page = per_page
+        self.page = max(page, 1)
+        self.total = total
+        backwards = bool(before) and not after
+        cursor = decode_cursor(before if backwards else after, order)
+
+        if cursor is None:
+            query = seek(query, order)
+        else:
+            query = seek(query, order, cursor, backwards)
+        rows = query.limit(per_page + 1).all()
+        more = len(rows) > per_page
+        rows = rows[:per_page]
+        if backwards:
+            rows.reverse()
+            self.has_prev, self.has_next = more, True
+        else:
+            self.has_prev, self.has_next = cursor is not None, more
+        if not self.has_prev:
+            self.page = 1
+        self.items = rows
+
+    @property
+    def pages(self):
+        return ceil(self.total / self.per_page) if self.total else 0
+
+    @property
+    def prev_num(self):
+        return max(self.page - 1, 1)
+
+    @property
+    def next_num(self):
+        return self.page + 1
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0], self.order) if self.items else None
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1], self.order) if self.items else None
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def key_values(row, order):
+    # ORM entities expose the key as attributes, with_entities() rows by name.
+    if hasattr(row, '_mapping'):
+        return [row._mapping[column.key] for column, _ in order]
+    return [getattr(row, column.key) for column, _ in order]
+
+
+def encode_cursor(row, order):
+    values = []
+    for value in key_values(row, order):
+        if isinstance(value, (date, datetime)):
+            value = value.isoformat()
+        values.append(value)
+    raw = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(token, order):
+    """Returns the key values stored in a cursor, or None if it is unusable."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(order):
+            return None
+        decoded = []
+        for (column, _), value in zip(order, values):
+            python_type = column.type.python_type
+            if value is not None and python_type in (date, datetime):
+                value = python_type.fromisoformat(value)
+            elif value is not None:
+                value = python_type(value)
+            decoded.append(value)
+        return decoded
+    except (ValueError, TypeError, NotImplementedError):
+        return None
+
+
+def _after(column, descending, value):
+    # SQLite sorts NULL before every other value.
+    if descending:
+        return false() if value is None else or_(column < value, column.is_(None))
+    return column.isnot(None) if value is None else column > value
+
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def seek(query, order, values=None, backwards=False):
+    """
+    Orders `query` by `order` and, given the key values of a boundary row,
+    keeps only the rows after it (or before it, walking backwards).
+    """
+    if values is not None:
+        clauses = []
+        for i, ((column, descending), value) in enumerate(zip(order, values)):
+            ties = [_equal(c, v) for (c, _), v in zip(order[:i], values[:i])]
+            clauses.append(and_(*ties, _after(column, descending != backwards, value)))
+        query = query.filter(or_(*clauses))
+    return query.order_by(*[
+        column.desc() if descending != backwards else column.asc()
+        for column, descending in order])
+
+
+# Least recently used first; keys come from request arguments, so callers
+# should only pass known values, and the size bounds the rest.
+COUNT_CACHE_SIZE = 64
+_counts = OrderedDict()
+_counts_lock = threading.Lock()
+
+
+def cached_count(key, query, ttl=60):
+    """COUNT(*) that is recomputed at most once per `ttl` seconds per key."""
+    now = time.monotonic()
+    with _counts_lock:
+        entry = _counts.get(key)
+        if entry is not None and entry[0] > now:
+            _counts.move_to_end(key)
+            return entry[1]
+    total = query.order_by(None).count()
+    with _counts_lock:
+        _counts[key] = (now + ttl, total)
+        _counts.move_to_end(key)
+        while len(_counts) > COUNT_CACHE_SIZE:
+            _counts.popitem(last=False)
+    return total
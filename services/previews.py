@@ -0,0 +1,189 @@
+import hashlib
+import os
+import threading
+from functools import partial
+from models import db, Resource
+from services.signals import resource_saved
+from services.storage import is_blob
+from services.processes import process_pool
+from services.file_serving import upload_url, upload_version
+
+PREVIEW_DIR = 'previews'
+# (Pillow format, file extension, save options), best compression first.
+FORMATS = (
+    ('WEBP', 'webp', {'method': 4}),
+    ('JPEG', 'jpg', {'optimize': True, 'progressive': True}),
+)
+
+
+def render_previews(path, prefix, widths, quality):
+    """
+    Writes `prefix`-<width>.<ext> for each format and width, never wider
+    than the original. Runs in a worker process, so it only takes and
+    returns plain values: the widths written, or None if the file is not
+    a readable image.
+    """
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(path) as image:
+            # Lets the JPEG decoder skip detail no derivative needs.
+            image.draft('RGB', (max(widths), max(widths)))
+            image = ImageOps.exif_transpose(image)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA' if 'A' in image.getbands() else 'RGB')
+            targets = sorted({min(width, image.width) for width in widths})
+            os.makedirs(os.path.dirname(prefix), exist_ok=True)
+            for width in targets:
+                height = max(1, round(image.height * width / image.width))
+                resized = image.resize((width, height), Image.LANCZOS)
+                for fmt, ext, options in FORMATS:
+                    out = resized
+                    if fmt == 'JPEG' and out.mode == 'RGBA':
+                        out = Image.new('RGB', out.size, 'white')
+                        out.paste(resized, mask=resized.getchannel('A'))
+                    temp = f'{prefix}-{width}.{ext}.{os.getpid()}.tmp'
+                    out.save(temp, fmt, quality=quality, **options)
+                    os.replace(temp, f'{prefix}-{width}.{ext}')
+            return targets
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+
+
+class Previews:
+    """
+    Resized WebP and JPEG copies of the preview images, at each of
+    PREVIEW_WIDTHS, for srcset.
+
+    They are rendered in a pool of PREVIEW_WORKERS processes when a
+    resource is saved with a preview, and by `flask build-previews` for
+    existing images. Derivatives are named after the source's content
+    (its blob hash, or name and version for files stored by name), so a
+    replaced image gets new files and the old ones are never stale; the
+    files on disk are the cache. Until an image has derivatives, pages
+    show the original.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._widths = {}   # key -> widths on disk, once found
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PREVIEW_WIDTHS', (160, 320, 640))
+        app.config.setdefault('PREVIEW_QUALITY', 80)
+        app.config.setdefault('PREVIEW_WORKERS', 2)
+        self.app = app
+        app.extensions['previews'] = self
+        if app.config['PREVIEW_WORKERS']:
+            resource_saved.connect(self._on_saved, sender=app, weak=False)
+
+    def key(self, filename):
+        if is_blob(filename):
+            return os.path.splitext(os.path.basename(filename))[0]
+        version = upload_version(filename)
+        if version is None:
+            return None
+        return hashlib.sha256(f'{filename}:{version}'.encode()).hexdigest()
+
+    def _prefix(self, key):
+        return f'{PREVIEW_DIR}/{key[:2]}/{key}'
+
+    def _path(self, filename):
+        return os.path.join(self.app.config['UPLOAD_FOLDER'], filename)
+
+    def widths(self, key):
+        """The widths rendered for `key`; only found ones are remembered."""
+        widths = self._widths.get(key)
+        if widths is not None:
+            return widths
+        prefix = self._prefix(key)
+        name = os.path.basename(prefix) + '-'
+        try:
+            files = os.listdir(os.path.dirname(self._path(prefix)))
+        except OSError:
+            return []
+        ext = FORMATS[-1][1]
+        # The last format is written last, so its files mean a full set.
+        widths = sorted(int(f[len(name):-len(ext) - 1]) for f in files
+                        if f.startswith(name) and f.endswith('.' + ext))
+        if widths:
+            self._widths[key] = widths
+        return widths
+
+    def sources(self, filename):
+        """
+        {'src': url, 'webp': srcset, 'jpg': srcset} for a preview image, or
+        None while it has no derivatives.
+        """
+        key = self.key(filename)
+        widths = self.widths(key) if key else []
+        if not widths:
+            return None
+        prefix = self._prefix(key)
+        result = {ext: ', '.join(f'{upload_url(f"{prefix}-{w}.{ext}")} {w}w' for w in widths)
+                  for _, ext, _ in FORMATS}
+        # Browsers without srcset get a card-sized image.
+        fallback = [w for w in widths if w <= 320] or widths[:1]
+        result['src'] = upload_url(f'{prefix}-{fallback[-1]}.{FORMATS[-1][1]}')
+        return result
+
+    def _args(self, filename, key):
+        return (self._path(filename), self._path(self._prefix(key)),
+                tuple(self.app.config['PREVIEW_WIDTHS']), self.app.config['PREVIEW_QUALITY'])
+
+    def _pool(self, workers):
+        with self._lock:
+            if self._executor is None:
+                self._executor = process_pool(workers)
+            return self._executor
+
+    def _on_saved(self, sender, resource, **extra):
+        filename = resource.preview_image
+        key = filename and self.key(filename)
+        if not key or self.widths(key):
+            return
+        future = self._pool(sender.config['PREVIEW_WORKERS']).submit(
+            render_previews, *self._args(filename, key))
+        future.add_done_callback(partial(self._done, key))
+
+    def _done(self, key, future):
+        try:
+            widths = future.result()
+        except Exception:  # the worker died, e.g. BrokenProcessPool
+            self.app.logger.exception('Could not render previews for %s', key)
+            return
+        if widths:
+            self._widths[key] = widths
+
+    def backfill(self, workers=None, force=False):
+        """
+        Renders the derivatives of every preview image in use that has
+        none (all of them with `force`). Returns (rendered, unreadable).
+        """
+        names = {name for name, in db.session.query(Resource.preview_image).filter(
+            Resource.preview_image.isnot(None)).distinct()}
+        todo = []
+        for filename in sorted(names):
+            key = self.key(filename)
+            if key and (force or not self.widths(key)):
+                todo.append((filename, key))
+        rendered = unreadable = 0
+        if not todo:
+            return rendered, unreadable
+        with process_pool(workers or self.app.config['PREVIEW_WORKERS']) as pool:
+            futures = [pool.submit(render_previews, *self._args(filename, key))
+                       for filename, key in todo]
+            for (filename, key), future in zip(todo, futures):
+                widths = future.result()
+                if widths:
+                    self._widths[key] = widths
+                    rendered += 1
+                else:
+                    unreadable += 1
+                    self.app.logger.warning('Not a readable image: %s', filename)
+        return rendered, unreadable
+
+
+previews = Previews()
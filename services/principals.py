@@ -0,0 +1,93 @@
+import threading
+import time
+from collections import namedtuple
+from flask_login import user_logged_in, user_logged_out
+from sqlalchemy import select
+from models import db, User
+from services.signals import user_changed
+
+PRINCIPAL_COLUMNS = ('id', 'username', 'role', 'is_active', 'theme_preference')
+
+
+class Principal(namedtuple('Principal', PRINCIPAL_COLUMNS)):
+    """
+    The logged-in user as Flask-Login sees it: the few columns every page
+    needs. The User row, with its relationships, is only loaded by the
+    routes that ask for `user`.
+    """
+    __slots__ = ()
+    is_authenticated = True
+    is_anonymous = False
+
+    def get_id(self):
+        return str(self.id)
+
+    @property
+    def user(self):
+        return db.session.get(User, self.id)
+
+
+class PrincipalCache:
+    """
+    Principals by user id, so that loading the user of a request costs
+    neither a query nor a full User row.
+
+    Routes that change a user's name, role, activation or theme send
+    user_changed after the commit, which drops the entry; so do logins and
+    logouts. The cache is per process, so PRINCIPAL_CACHE_SECONDS bounds
+    how long another worker can keep using a changed principal.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = {}   # user id -> (expires, Principal)
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('PRINCIPAL_CACHE_SECONDS', 60)
+        app.config.setdefault('PRINCIPAL_CACHE_SIZE', 10000)
+        self._ttl = app.config['PRINCIPAL_CACHE_SECONDS']
+        self._size = app.config['PRINCIPAL_CACHE_SIZE']
+        app.extensions['principals'] = self
+        user_changed.connect(self._on_change, sender=app, weak=False)
+        for signal in (user_logged_in, user_logged_out):
+            signal.connect(self._on_login, sender=app, weak=False)
+
+    def _on_change(self, sender, user_id, **extra):
+        self.invalidate(user_id)
+
+    def _on_login(self, sender, user, **extra):
+        self.invalidate(user.id)
+
+    def invalidate(self, user_id=None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(int(user_id), None)
+
+    def get(self, user_id):
+        """The Principal of `user_id`, or None if there is no such user."""
+        user_id = int(user_id)
+        now = time.monotonic()
+        entry = self._entries.get(user_id)
+        if entry is not None and entry[0] > now:
+            return entry[1]
+        row = db.session.execute(select(*(getattr(User, column) for column in PRINCIPAL_COLUMNS))
+                                 .where(User.id == user_id)).first()
+        if row is None:
+            return None
+        principal = Principal(*row)
+        with self._lock:
+            if len(self._entries) >= self._size:
+                # Expired entries go first; a full cache of live ones starts over.
+                self._entries = {key: value for key, value in self._entries.items()
+                                 if value[0] > now}
+                if len(self._entries) >= self._size:
+                    self._entries.clear()
+            self._entries[user_id] = (now + self._ttl, principal)
+        return principal
+
+
+principals = PrincipalCache()
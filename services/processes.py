@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+def process_pool(workers=None):
+    """
+    A ProcessPoolExecutor for CPU-bound work that only takes and returns
+    plain values (text extraction, preview rendering).
+
+    Its workers are spawned, not forked: a forked worker would inherit the
+    web process's threads mid-use, with any locks they held, and its
+    database connections. A spawned worker re-runs the main script as
+    __mp_main__ before it starts, so that script must not do its work at
+    import time; app.py skips create_app() there.
+    """
+    return ProcessPoolExecutor(max_workers=workers or None,
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+def alive(pid):
+    """Whether process `pid` exists (possibly under another user)."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,343 @@
+"""
+Boolean query language for advanced search.
+
+    deep learning                    both words, anywhere
+    "long walk"                      exact phrase
+    creator:mandela subject:history  field prefixes (title, creator/author,
+                                     subject, description, body/text)
+    title:(python OR java)           a field applied to a group
+    apartheid NOT fiction, -fiction  exclusion
+    (a OR b) AND c                   grouping; AND is implied between terms
+    year:1990..2000, year:>=2010     publication year ranges
+
+Queries are parsed into a small tree, normalized (flattened, deduplicated,
+double negations and year ranges folded) and compiled so that every text
+predicate ends up in a single FTS5 MATCH expression. Only year ranges, and
+text that FTS5 cannot express (such as OR across a NOT), become SQL.
+"""
+import re
+from collections import namedtuple
+from datetime import date
+from sqlalchemy import and_, or_, not_, false
+from models import Resource
+from services.fts import FTS_COLUMNS, tokenize, document_frequency, match_ids
+
+Term = namedtuple('Term', ['field', 'text', 'phrase'])
+YearRange = namedtuple('YearRange', ['start', 'end'])
+And = namedtuple('And', ['children'])
+Or = namedtuple('Or', ['children'])
+Not = namedtuple('Not', ['child'])
+
+FIELD_ALIASES = {'author': 'creator', 'abstract': 'description', 'text': 'body'}
+
+_LEXER_RE = re.compile(r'''
+    \s*(?:
+        (?P<lparen>\() |
+        (?P<rparen>\)) |
+        (?P<field>[A-Za-z]+):(?=[^\s)]) |
+        "(?P<phrase>[^"]*)"? |
+        (?P<minus>-)(?=[^\s)]) |
+        (?P<word>[^\s()"]+)
+    )''', re.X)
+
+_YEAR_RE = re.compile(r'^(>=|<=|>|<)?(\d{4})(?:(?:\.\.|-)(\d{4}))?$')
+
+
+class QuerySyntaxError(ValueError):
+    pass
+
+
+class CompiledQuery(namedtuple('CompiledQuery', ['fts', 'filters', 'key'])):
+    """
+    `fts` is the FTS5 expression to join on (None: no text constraint),
+    `filters` the remaining SQL predicates and `key` a canonical form of
+    the normalized tree, suitable for cache keys.
+    """
+
+
+def year_clause(start=None, end=None):
+    """
+    Year filter as a range on publication_date itself, so the date indexes
+    can serve it (extract('year', ...) would hide the column from them).
+    """
+    clauses = []
+    if start is not None:
+        if start > 9999:
+            return false()
+        clauses.append(Resource.publication_date >= date(max(start, 1), 1, 1))
+    if end is not None:
+        if end < 1:
+            return false()
+        clauses.append(Resource.publication_date <= date(min(end, 9999), 12, 31))
+    return and_(*clauses)
+
+
+# --- Parsing ---
+
+def _lex(query):
+    tokens = []
+    pos = 0
+    query = query.strip()
+    while pos < len(query):
+        match = _LEXER_RE.match(query, pos)
+        if not match or match.end() == pos:
+            break
+        pos = match.end()
+        kind = match.lastgroup
+        value = match.group(kind)
+        if kind == 'word' and value in ('AND', 'OR', 'NOT'):
+            kind = value
+        elif kind == 'word' and value in ('&&', '||'):
+            kind = 'AND' if value == '&&' else 'OR'
+        tokens.append((kind, value))
+    return tokens
+
+
+class _Parser:
+
+    def __init__(self, query):
+        self.tokens = _lex(query)
+        self.pos = 0
+
+    def peek(self):
+        return self.tokens[self.pos][0] if self.pos < len(self.tokens) else None
+
+    def take(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def parse(self):
+        if not self.tokens:
+            return None
+        node = self.parse_or(None)
+        if self.peek() is not None:
+            raise QuerySyntaxError(f'Unexpected "{self.tokens[self.pos][1]}"')
+        return node
+
+    def parse_or(self, field):
+        children = [self.parse_and(field)]
+        while self.peek() == 'OR':
+            self.take()
+            children.append(self.parse_and(field))
+        return children[0] if len(children) == 1 else Or(tuple(children))
+
+    def parse_and(self, field):
+        children = [self.parse_unary(field)]
+        while self.peek() not in (None, 'OR', 'rparen'):
+            if self.peek() == 'AND':
+                self.take()
+            children.append(self.parse_unary(field))
+        return children[0] if len(children) == 1 else And(tuple(children))
+
+    def parse_unary(self, field):
+        if self.peek() in ('NOT', 'minus'):
+            self.take()
+            return Not(self.parse_unary(field))
+        return self.parse_primary(field)
+
+    def parse_primary(self, field):
+        kind = self.peek()
+        if kind is None:
+            raise QuerySyntaxError('Query ends unexpectedly')
+        _, value = self.take()
+        if kind == 'lparen':
+            node = self.parse_or(field)
+            if self.peek() != 'rparen':
+                raise QuerySyntaxError('Missing closing parenthesis')
+            self.take()
+            return node
+        if kind == 'rparen':
+            raise QuerySyntaxError('Unexpected ")"')
+        if kind == 'field':
+            name = FIELD_ALIASES.get(value.lower(), value.lower())
+            if name == 'year':
+                return self.parse_year()
+            if name in FTS_COLUMNS:
+                return self.parse_primary(name)
+            # Not a field we know: treat "foo:bar" as two plain words.
+            return And((Term(field, value, False), self.parse_primary(field)))
+        if kind == 'phrase':
+            return Term(field, value, True)
+        return Term(field, value, False)
+
+    def parse_year(self):
+        _, value = self.take() if self.peek() == 'word' else (None, '')
+        match = _YEAR_RE.match(value)
+        if not match:
+            raise QuerySyntaxError(f'Invalid year range "{value}"')
+        op, first, second = match.groups()
+        first = int(first)
+        if second:
+            years = YearRange(first, int(second))
+        else:
+            years = {
+                '>=': YearRange(first, None), '>': YearRange(first + 1, None),
+                '<=': YearRange(None, first), '<': YearRange(None, first - 1),
+            }.get(op, YearRange(first, first))
+        # Dates only go from year 1 to 9999 (year:>9999 would need 10000).
+        if any(year is not None and not 1 <= year <= 9999 for year in years):
+            raise QuerySyntaxError(f'Year out of range "{value}"')
+        return years
+
+
+def parse(query):
+    """Parses a query string into a tree; None if it is empty."""
+    return _Parser(query or '').parse()
+
+
+# --- Normalization ---
+
+def normalize(node):
+    if isinstance(node, Not):
+        child = normalize(node.child)
+        return child.child if isinstance(child, Not) else Not(child)
+    if not isinstance(node, (And, Or)):
+        return node
+    kind = type(node)
+    children = []
+    for child in node.children:
+        child = normalize(child)
+        flat = child.children if isinstance(child, kind) else (child,)
+        for item in flat:
+            if item not in children:
+                children.append(item)
+    if kind is And:
+        # Fold every year range of a conjunction into their intersection.
+        ranges = [c for c in children if isinstance(c, YearRange)]
+        if len(ranges) > 1:
+            starts = [r.start for r in ranges if r.start is not None]
+            ends = [r.end for r in ranges if r.end is not None]
+            merged = YearRange(max(starts) if starts else None,
+                               min(ends) if ends else None)
+            children = [c for c in children if not isinstance(c, YearRange)]
+            children.append(merged)
+    return children[0] if len(children) == 1 else kind(tuple(children))
+
+
+# --- Compilation ---
+
+class _Conjunction:
+    """
+    A conjunction split by how it can be evaluated: positive FTS terms
+    (with a cost estimate), negated FTS expressions and plain SQL.
+    """
+
+    def __init__(self, positive=(), negative=(), sql=()):
+        self.positive = list(positive)
+        self.negative = list(negative)
+        self.sql = list(sql)
+
+    def merge(self, other):
+        self.positive += other.positive
+        self.negative += other.negative
+        self.sql += other.sql
+
+    @property
+    def empty(self):
+        return not (self.positive or self.negative or self.sql)
+
+    @property
+    def pure_text(self):
+        return bool(self.positive) and not self.sql
+
+    def fts(self):
+        # Rarest terms first, so the smallest posting lists lead the match.
+        ordered = [expr for _, expr in sorted(self.positive, key=lambda p: p[0])]
+        if len(ordered) == 1:
+            expression = ordered[0]
+        else:
+            expression = ' AND '.join(f'({expr})' for expr in ordered)
+        for expr in self.negative:
+            expression = f'({expression}) NOT ({expr})'
+        return expression
+
+    def cost(self):
+        return min(cost for cost, _ in self.positive)
+
+    def to_sql(self):
+        clauses = list(self.sql)
+        if self.positive:
+            clauses.insert(0, _in_fts(self.fts()))
+        else:
+            clauses += [not_(_in_fts(expr)) for expr in self.negative]
+        return and_(*clauses)
+
+
+def _in_fts(expression):
+    return Resource.id.in_(match_ids(expression))
+
+
+def _compile(node, estimates):
+    if isinstance(node, Term):
+        tokens = tokenize(node.text)
+        if not tokens:
+            # Punctuation only: no constraint, as with term_expression().
+            return _Conjunction()
+        if node.phrase:
+            expression = '"' + ' '.join(tokens) + '"'
+        else:
+            expression = ' '.join(f'"{token}"*' for token in tokens)
+        if node.field:
+            expression = f'{node.field} : ({expression})'
+        for token in tokens:
+            if token not in estimates:
+                estimates[token] = document_frequency(token)
+        return _Conjunction(positive=[(min(estimates[t] for t in tokens), expression)])
+    if isinstance(node, YearRange):
+        return _Conjunction(sql=[year_clause(node.start, node.end)])
+    if isinstance(node, And):
+        result = _Conjunction()
+        for child in node.children:
+            result.merge(_compile(child, estimates))
+        return result
+    if isinstance(node, Or):
+        parts = [_compile(child, estimates) for child in node.children]
+        if any(part.empty for part in parts):
+            return _Conjunction()
+        if all(part.pure_text for part in parts):
+            expression = ' OR '.join(f'({part.fts()})' for part in parts)
+            return _Conjunction(positive=[(sum(p.cost() for p in parts), expression)])
+        return _Conjunction(sql=[or_(*[part.to_sql() for part in parts])])
+    if isinstance(node, Not):
+        inner = _compile(node.child, estimates)
+        if inner.empty:
+            return inner
+        if inner.pure_text:
+            return _Conjunction(negative=[inner.fts()])
+        return _Conjunction(sql=[not_(inner.to_sql())])
+    raise TypeError(node)
+
+
+def compile_query(node):
+    """Compiles a (normalized) tree into a CompiledQuery."""
+    node = normalize(node)
+    conjunction = _compile(node, {})
+    if conjunction.positive:
+        fts, filters = conjunction.fts(), conjunction.sql
+    elif conjunction.empty:
+        fts, filters = None, []
+    else:
+        fts, filters = None, [conjunction.to_sql()]
+    return CompiledQuery(fts, filters, repr(node))
+
+
+def rows_to_tree(rows):
+    """
+    Builds a tree from the form's (operator, term, field) rows with the
+    old semantics: OR binds to the previous row, NOT excludes a row.
+    """
+    clauses = []
+    for op, term, field in rows:
+        if not term:
+            continue
+        node = Term(field if field in FTS_COLUMNS else None, term, False)
+        if op == 'OR' and clauses:
+            clauses.append(Or((clauses.pop(), node)))
+        elif op == 'NOT' and clauses:
+            clauses.append(Not(node))
+        else:
+            clauses.append(node)
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else And(tuple(clauses))
@@ -0,0 +1,154 @@
+import threading
+import time
+from array import array
+from collections import OrderedDict, namedtuple
+from flask_sqlalchemy.pagination import Pagination
+from models import Resource
+from services.pagination import seek, key_values
+from services.signals import resource_saved, resource_deleted, category_changed
+
+# Ordered ids of a search's matches. Only the first SEARCH_CACHE_MAX_IDS are
+# kept; `total` is always exact, and deeper pages fall back to the database.
+MatchedIds = namedtuple('MatchedIds', ['ids', 'total'])
+
+
+def normalize_key(*parts):
+    """Builds a cache key that ignores case, spacing and filter order."""
+    key = []
+    for part in parts:
+        if isinstance(part, str):
+            part = ' '.join(part.lower().split())
+        elif isinstance(part, (list, tuple, set)):
+            part = tuple(sorted(str(p) for p in part))
+        key.append(part)
+    return tuple(key)
+
+
+class _Flight:
+    __slots__ = ('event', 'value', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResultCache:
+    """
+    LRU cache for search results and facet counts.
+
+    Any committed catalogue change (the resource and category signals) bumps
+    `version` and empties the cache. Concurrent misses for the same key are
+    coalesced: one request computes, the rest wait for its result. The cache
+    is per process, so SEARCH_CACHE_TTL bounds how long another worker's
+    writes can go unseen.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> (version, expires, value)
+        self._inflight = {}
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_CACHE_SIZE', 256)
+        app.config.setdefault('SEARCH_CACHE_TTL', 300)
+        app.config.setdefault('SEARCH_CACHE_MAX_IDS', 10000)
+        self._size = app.config['SEARCH_CACHE_SIZE']
+        self._ttl = app.config['SEARCH_CACHE_TTL']
+        self.max_ids = app.config['SEARCH_CACHE_MAX_IDS']
+        app.extensions['result_cache'] = self
+        for signal in (resource_saved, resource_deleted, category_changed):
+            signal.connect(self._on_change, sender=app, weak=False)
+
+    def _on_change(self, sender, **extra):
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._entries.clear()
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+            version = self.version
+
+        if not leader:
+            flight.event.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            flight.value = compute()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                # A write landed while we were computing: don't keep the result.
+                if flight.error is None and version == self.version:
+                    self._entries[key] = (version, time.monotonic() + self._ttl,
+                                          flight.value)
+                    while len(self._entries) > self._size:
+                        self._entries.popitem(last=False)
+            flight.event.set()
+        return flight.value
+
+    def match_ids(self, query):
+        """Runs an ordered Resource query for ids only, capped at max_ids."""
+        ids = array('I', (row[0] for row in query.with_entities(
+            Resource.id).limit(self.max_ids + 1)))
+        if len(ids) <= self.max_ids:
+            return MatchedIds(ids, len(ids))
+        return MatchedIds(ids[:self.max_ids], query.order_by(None).count())
+
+
+class CachedPagination(Pagination):
+    """
+    Pagination over a MatchedIds entry. Pages within the cached ids load by
+    primary key. Pages past them seek from the last cached row using the
+    (column, descending) `order`, so the database never re-reads the cached
+    prefix.
+    """
+
+    def _query_items(self):
+        matched = self._query_args['matched']
+        start = (self.page - 1) * self.per_page
+        page_ids = list(matched.ids[start:start + self.per_page])
+        items = []
+        if page_ids:
+            by_id = {r.id: r for r in Resource.query.filter(
+                Resource.id.in_(page_ids))}
+            items = [by_id[i] for i in page_ids if i in by_id]
+        remaining = self.per_page - len(page_ids)
+        if not remaining or len(matched.ids) >= matched.total:
+            return items
+        query, order = self._query_args['query'], self._query_args['order']
+        anchor = query.with_entities(*[column for column, _ in order]).filter(
+            Resource.id == matched.ids[-1]).first()
+        if anchor is None:
+            return items
+        return items + seek(query, order, key_values(anchor, order)).offset(
+            max(start - len(matched.ids), 0)).limit(remaining).all()
+
+    def _query_count(self):
+        return self._query_args['matched'].total
+
+
+result_cache = ResultCache()
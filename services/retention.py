@@ -0,0 +1,159 @@
+import gzip
+import json
+import os
+import time
+from datetime import datetime, date, time as day_start, timedelta
+from sqlalchemy import delete, text
+from models import db, DownloadLog, SearchHistory, SearchQueryLog, DownloadRollup, SearchRollup
+
+# Log tables under retention, with the column that dates each row.
+LOGS = {
+    'download_log': (DownloadLog, DownloadLog.download_date),
+    'search_history': (SearchHistory, SearchHistory.search_date),
+    'search_query_log': (SearchQueryLog, SearchQueryLog.search_date),
+}
+
+
+def cutoff(days, now=None):
+    """Midnight `days` days ago: whole days are archived, never part of one."""
+    today = (now or datetime.utcnow()).date()
+    return datetime.combine(today - timedelta(days=days), day_start())
+
+
+def _free_bytes():
+    # Deleted rows go to SQLite's freelist; the file only shrinks on VACUUM.
+    page_size = db.session.execute(text('PRAGMA page_size')).scalar()
+    return db.session.execute(text('PRAGMA freelist_count')).scalar() * page_size
+
+
+def _serialize(row, columns):
+    record = {}
+    for column in columns:
+        value = getattr(row, column.key)
+        if isinstance(value, (date, datetime)):
+            value = value.isoformat()
+        record[column.key] = value
+    return record
+
+
+class _Archive:
+    """Appends rows to gzipped JSON lines files, one per table and month."""
+
+    def __init__(self, folder, table):
+        self.folder = os.path.join(folder, table)
+        self.table = table
+        self.bytes_written = 0
+
+    def path(self, moment):
+        return os.path.join(self.folder, f'{moment:%Y}',
+                            f'{self.table}-{moment:%Y-%m}.jsonl.gz')
+
+    def write(self, records):
+        by_path = {}
+        for moment, record in records:
+            by_path.setdefault(self.path(moment), []).append(record)
+        for path, lines in by_path.items():
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            before = os.path.getsize(path) if os.path.exists(path) else 0
+            # Each append adds a gzip member; readers see one stream.
+            with gzip.open(path, 'at', encoding='utf-8') as f:
+                for record in lines:
+                    f.write(json.dumps(record, separators=(',', ':')) + '\n')
+            with open(path, 'rb') as f:
+                os.fsync(f.fileno())
+            self.bytes_written += os.path.getsize(path) - before
+
+
+def archive_table(table, days, folder, batch_size=1000, pause=0.05, dry_run=False):
+    """
+    Moves the rows of one log table older than `days` into its archive, a
+    batch at a time: each batch is written and synced to disk before it is
+    deleted in its own short transaction, with a pause between batches so
+    other writers get the lock. A crash can repeat at most one batch in
+    the archive, never lose one. Returns (rows, archive bytes).
+    """
+    model, date_column = LOGS[table]
+    limit = cutoff(days)
+    old_rows = model.query.filter(date_column < limit)
+    if dry_run:
+        return old_rows.count(), 0
+
+    archive = _Archive(folder, table)
+    columns = list(model.__table__.columns)
+    moved = 0
+    while True:
+        batch = old_rows.order_by(model.id).limit(batch_size).all()
+        if not batch:
+            break
+        archive.write([(getattr(row, date_column.key), _serialize(row, columns))
+                       for row in batch])
+        db.session.execute(delete(model).where(
+            model.id.in_([row.id for row in batch])))
+        db.session.commit()
+        db.session.expunge_all()
+        moved += len(batch)
+        if pause:
+            time.sleep(pause)
+    return moved, archive.bytes_written
+
+
+def compact_hourly_rollups(days, pause=0.05, dry_run=False):
+    """
+    Drops hourly rollup rows older than `days`, one day of buckets per
+    transaction. The daily rows cover the same period, so only the
+    hour-by-hour detail is lost.
+    """
+    limit = cutoff(days)
+    removed = 0
+    for rollup in (DownloadRollup, SearchRollup):
+        old_rows = rollup.query.filter(rollup.grain == 'hour', rollup.bucket < limit)
+        if dry_run:
+            removed += old_rows.count()
+            continue
+        while True:
+            buckets = [row[0] for row in old_rows.with_entities(
+                rollup.bucket).distinct().order_by(rollup.bucket).limit(24)]
+            if not buckets:
+                break
+            result = db.session.execute(delete(rollup).where(
+                rollup.grain == 'hour', rollup.bucket.in_(buckets)))
+            db.session.commit()
+            removed += result.rowcount
+            if pause:
+                time.sleep(pause)
+    return removed
+
+
+def apply_retention(app, dry_run=False, vacuum=False, out=print):
+    """Runs every retention rule in LOG_RETENTION_DAYS and reports on it."""
+    folder = app.config['ARCHIVE_FOLDER']
+    batch_size = app.config['RETENTION_BATCH_SIZE']
+    free_before = _free_bytes()
+    database = db.engine.url.database
+    file_size = os.path.getsize(database) if database and os.path.exists(database) else None
+
+    for table, days in app.config['LOG_RETENTION_DAYS'].items():
+        if days is None:
+            continue
+        rows, written = archive_table(table, days, folder, batch_size, dry_run=dry_run)
+        verb = 'would archive' if dry_run else 'archived'
+        out(f'{table}: {verb} {rows} rows older than {days} days'
+            + (f' ({written / 1024:.1f} KiB compressed)' if written else ''))
+
+    hourly_days = app.config['ROLLUP_HOURLY_RETENTION_DAYS']
+    if hourly_days is not None:
+        removed = compact_hourly_rollups(hourly_days, dry_run=dry_run)
+        verb = 'would drop' if dry_run else 'dropped'
+        out(f'rollups: {verb} {removed} hourly rows older than {hourly_days} days')
+
+    if dry_run:
+        return
+    freed = _free_bytes() - free_before
+    out(f'{max(freed, 0) / 1024:.1f} KiB of database pages freed for reuse')
+    if vacuum:
+        db.session.commit()
+        with db.engine.connect() as conn:
+            conn.execution_options(isolation_level='AUTOCOMMIT').execute(text('VACUUM'))
+        if file_size is not None:
+            shrunk = file_size - os.path.getsize(database)
+            out(f'VACUUM shrank the database file by {shrunk / 1024:.1f} KiB')
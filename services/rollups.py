@@ -0,0 +1,171 @@
+from collections import Counter
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, delete
+from sqlalchemy.dialects.sqlite import insert
+from models import db, DownloadLog, SearchQueryLog, DownloadRollup, SearchRollup
+from services.signals import logs_written
+
+GRAINS = ('hour', 'day')
+
+
+def truncate(moment, grain):
+    if grain == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def normalize_query(text):
+    return ' '.join((text or '').lower().split())[:200]
+
+
+def _count_downloads(rows, counts):
+    for row in rows:
+        for grain in GRAINS:
+            bucket = truncate(row['download_date'], grain)
+            counts[grain, bucket, 'all', 0] += 1
+            counts[grain, bucket, 'resource', row['resource_id']] += 1
+            counts[grain, bucket, 'user', row['user_id']] += 1
+
+
+def _count_searches(rows, counts):
+    for row in rows:
+        query = normalize_query(row['query_text'])
+        zero = 1 if not row['results_count'] else 0
+        for grain in GRAINS:
+            key = (grain, truncate(row['search_date'], grain), query)
+            searches, zeros = counts.get(key, (0, 0))
+            counts[key] = (searches + 1, zeros + zero)
+
+
+def _upsert(model, rows, increments):
+    if not rows:
+        return
+    statement = insert(model)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[c.name for c in model.__table__.primary_key],
+        set_={name: getattr(model, name) + getattr(statement.excluded, name)
+              for name in increments}), rows)
+
+
+def _store(download_counts, search_counts):
+    _upsert(DownloadRollup, [
+        {'grain': grain, 'bucket': bucket, 'dimension': dimension,
+         'key': key, 'count': count}
+        for (grain, bucket, dimension, key), count in download_counts.items()
+    ], ['count'])
+    _upsert(SearchRollup, [
+        {'grain': grain, 'bucket': bucket, 'query_text': query,
+         'searches': searches, 'zero_results': zeros}
+        for (grain, bucket, query), (searches, zeros) in search_counts.items()
+    ], ['searches', 'zero_results'])
+
+
+class Rollups:
+    """
+    Hourly and daily counts of downloads (overall, per resource and per
+    user) and of searches per normalized query.
+
+    They are folded in as the log writer commits each batch, in the same
+    transaction, so the dashboard reads a few pre-aggregated rows instead
+    of grouping the raw logs. `flask rebuild-rollups` recomputes them from
+    the logs.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.extensions['rollups'] = self
+        logs_written.connect(self._on_logs_written, sender=app, weak=False)
+
+    def _on_logs_written(self, sender, rows, **extra):
+        download_counts, search_counts = Counter(), {}
+        _count_downloads(rows.get(DownloadLog, ()), download_counts)
+        _count_searches(rows.get(SearchQueryLog, ()), search_counts)
+        _store(download_counts, search_counts)
+
+    def rebuild(self, chunk_size=10000):
+        """
+        Recomputes the rollups from the raw logs in one transaction, which
+        holds the write lock until it commits. Buckets older than the
+        oldest raw row of a log are kept: once retention has archived the
+        rows, the rollups are all that is left of them. Returns the number
+        of log rows read.
+        """
+        read = 0
+        sources = (
+            (DownloadLog, DownloadRollup, _count_downloads,
+             (DownloadLog.download_date, DownloadLog.resource_id,
+              DownloadLog.user_id)),
+            (SearchQueryLog, SearchRollup, _count_searches,
+             (SearchQueryLog.search_date, SearchQueryLog.query_text,
+              SearchQueryLog.results_count)),
+        )
+        download_counts, search_counts = Counter(), {}
+        for model, rollup, count, columns in sources:
+            oldest = db.session.query(func.min(columns[0])).scalar()
+            if oldest is None:
+                continue
+            # Retention cuts at midnight, so this day is complete in the log.
+            db.session.execute(delete(rollup).where(
+                rollup.bucket >= truncate(oldest, 'day')))
+            result = db.session.execute(
+                select(*columns).execution_options(yield_per=chunk_size))
+            for chunk in result.mappings().partitions():
+                count(chunk, download_counts if model is DownloadLog else search_counts)
+                read += len(chunk)
+        _store(download_counts, search_counts)
+        db.session.commit()
+        return read
+
+    def build_if_empty(self):
+        """Seeds the rollups of a database that has logs but no rollups yet."""
+        has_rollups = db.session.query(DownloadRollup.grain).first() or \
+            db.session.query(SearchRollup.grain).first()
+        has_logs = db.session.query(DownloadLog.id).first() or \
+            db.session.query(SearchQueryLog.id).first()
+        if has_logs and not has_rollups:
+            self.rebuild()
+
+    # --- Reads ---
+
+    def downloads_by_day(self, start, end):
+        """{date: count} for the days from `start` to `end`, inclusive."""
+        rows = db.session.query(DownloadRollup.bucket, DownloadRollup.count).filter(
+            DownloadRollup.grain == 'day', DownloadRollup.dimension == 'all',
+            DownloadRollup.key == 0,
+            DownloadRollup.bucket.between(
+                datetime.combine(start, datetime.min.time()),
+                datetime.combine(end, datetime.min.time())))
+        return {bucket.date(): count for bucket, count in rows}
+
+    def total_downloads(self):
+        return db.session.query(func.coalesce(func.sum(DownloadRollup.count), 0)).filter(
+            DownloadRollup.grain == 'day', DownloadRollup.dimension == 'all').scalar()
+
+    def popular_searches(self, limit=5):
+        count = func.sum(SearchRollup.searches).label('count')
+        return db.session.query(SearchRollup.query_text, count).filter(
+            SearchRollup.grain == 'day').group_by(
+            SearchRollup.query_text).order_by(count.desc()).limit(limit).all()
+
+    def zero_result_searches(self, limit=5, days=7):
+        """
+        The queries that most recently found nothing, over the last `days`
+        (or ever, with None), with how often they did.
+        """
+        last_seen = func.max(SearchRollup.bucket)
+        count = func.sum(SearchRollup.zero_results).label('count')
+        # Hourly rows are compacted away by retention; the daily ones stay.
+        grain = 'hour' if days is not None else 'day'
+        query = db.session.query(SearchRollup.query_text, count).filter(
+            SearchRollup.grain == grain, SearchRollup.zero_results > 0)
+        if days is not None:
+            query = query.filter(SearchRollup.bucket >= truncate(
+                datetime.utcnow() - timedelta(days=days), 'hour'))
+        return query.group_by(SearchRollup.query_text).order_by(
+            last_seen.desc()).limit(limit).all()
+
+
+rollups = Rollups()
@@ -0,0 +1,42 @@
+from sqlalchemy import inspect, text
+from models import db
+
+# Fills in a column added to an existing database, keyed by (table, column).
+BACKFILLS = {
+    ('resource', 'publication_year'):
+        "UPDATE resource SET publication_year = "
+        "CAST(strftime('%Y', publication_date) AS INTEGER) "
+        "WHERE publication_date IS NOT NULL",
+}
+
+
+def upgrade_schema():
+    """
+    Brings a database created by an older version up to the models.
+    create_all() only creates missing tables, so this adds the columns and
+    indexes that were introduced later and backfills the new columns.
+    Only nullable columns can be added this way. Returns what was added.
+    """
+    added = []
+    with db.engine.begin() as conn:
+        inspector = inspect(conn)
+        for table in db.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c['name'] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing or not column.nullable:
+                    continue
+                column_type = column.type.compile(dialect=conn.dialect)
+                conn.execute(text(
+                    f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'))
+                backfill = BACKFILLS.get((table.name, column.name))
+                if backfill:
+                    conn.execute(text(backfill))
+                added.append(f'{table.name}.{column.name}')
+            indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(conn)
+                    added.append(index.name)
+    return added
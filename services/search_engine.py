@@ -0,0 +1,211 @@
+import heapq
+import math
+import re
+import threading
+from array import array
+from bisect import bisect_left, insort
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert
+from models import db, Resource, CatalogueVersion
+from services.signals import resource_saved, resource_deleted, ensure_committed
+
+# Per-field weights: a term in the title counts three times as much towards
+# the term frequency (and the document length) as one in the description.
+FIELD_WEIGHTS = {'title': 3.0, 'creator': 2.0,
+                 'subject': 1.5, 'description': 1.0}
+
+K1 = 1.2
+B = 0.75
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall((text or '').lower())
+
+
+class _Postings:
+    """Sorted resource ids with their weighted term frequencies."""
+    __slots__ = ('docs', 'freqs')
+
+    def __init__(self):
+        self.docs = array('I')
+        self.freqs = array('f')
+
+    def put(self, doc_id, freq):
+        i = bisect_left(self.docs, doc_id)
+        if i < len(self.docs) and self.docs[i] == doc_id:
+            self.freqs[i] = freq
+        else:
+            self.docs.insert(i, doc_id)
+            self.freqs.insert(i, freq)
+
+    def discard(self, doc_id):
+        i = bisect_left(self.docs, doc_id)
+        if i < len(self.docs) and self.docs[i] == doc_id:
+            del self.docs[i]
+            del self.freqs[i]
+
+
+class SearchIndex:
+    """
+    In-memory inverted index over Resource metadata with BM25 ranking.
+
+    Enabled with SEARCH_BACKEND = 'memory'. The index is built from the
+    database on first use and then kept current by the resource_saved and
+    resource_deleted signals, one document at a time. Each worker process
+    holds its own copy: a change also bumps the CatalogueVersion row, and
+    a search first compares it with the version the index was built at,
+    so a worker rebuilds after another one changed the catalogue. Searches
+    return the best SEARCH_MAX_HITS matches at most.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.RLock()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def _reset(self):
+        self._postings = {}
+        self._terms = []          # sorted vocabulary, for prefix expansion
+        self._doc_terms = {}      # resource id -> terms it was indexed under
+        self._doc_len = {}        # resource id -> weighted document length
+        self._total_len = 0.0
+        self._built = False
+        self._version = None      # CatalogueVersion the index is current with
+
+    def init_app(self, app):
+        app.config.setdefault('SEARCH_MAX_HITS', 1000)
+        self.max_hits = app.config['SEARCH_MAX_HITS']
+        app.extensions['search_index'] = self
+        if app.config.get('SEARCH_BACKEND') != 'memory':
+            return
+        resource_saved.connect(self._on_saved, sender=app, weak=False)
+        resource_deleted.connect(self._on_deleted, sender=app, weak=False)
+
+    def _on_saved(self, sender, resource, **extra):
+        ensure_committed()
+        with self._lock:
+            if self._built:
+                self.add(resource.id, {f: getattr(resource, f)
+                                       for f in FIELD_WEIGHTS})
+        self._bump()
+
+    def _on_deleted(self, sender, resource_id, **extra):
+        ensure_committed()
+        with self._lock:
+            if self._built:
+                self.remove(resource_id)
+        self._bump()
+
+    def _bump(self):
+        # This index already has the change; the others see the new version.
+        # If another worker's change got in between, the next search rebuilds.
+        # A transaction of its own, so the sender's session is left alone.
+        statement = insert(CatalogueVersion).values(id=1, version=1)
+        with db.engine.begin() as connection:
+            connection.execute(statement.on_conflict_do_update(
+                index_elements=[CatalogueVersion.id],
+                set_={'version': CatalogueVersion.version + 1}))
+            version = connection.scalar(select(CatalogueVersion.version))
+        with self._lock:
+            if self._built and version == self._version + 1:
+                self._version = version
+
+    def catalogue_version(self):
+        return db.session.scalar(select(CatalogueVersion.version)) or 0
+
+    def build(self):
+        """(Re)loads every resource from the database. Needs an app context."""
+        version = self.catalogue_version()
+        columns = [getattr(Resource, f) for f in FIELD_WEIGHTS]
+        rows = db.session.query(Resource.id, *columns).all()
+        with self._lock:
+            self._reset()
+            for row in rows:
+                self.add(row[0], dict(zip(FIELD_WEIGHTS, row[1:])))
+            self._built = True
+            self._version = version
+        return len(rows)
+
+    def add(self, doc_id, fields):
+        freqs = {}
+        length = 0.0
+        for field, weight in FIELD_WEIGHTS.items():
+            for term in tokenize(fields.get(field)):
+                freqs[term] = freqs.get(term, 0.0) + weight
+                length += weight
+        with self._lock:
+            self.remove(doc_id)
+            for term, freq in freqs.items():
+                postings = self._postings.get(term)
+                if postings is None:
+                    postings = self._postings[term] = _Postings()
+                    insort(self._terms, term)
+                postings.put(doc_id, freq)
+            self._doc_terms[doc_id] = tuple(freqs)
+            self._doc_len[doc_id] = length
+            self._total_len += length
+
+    def remove(self, doc_id):
+        with self._lock:
+            terms = self._doc_terms.pop(doc_id, None)
+            if terms is None:
+                return
+            self._total_len -= self._doc_len.pop(doc_id)
+            for term in terms:
+                postings = self._postings[term]
+                postings.discard(doc_id)
+                if not postings.docs:
+                    del self._postings[term]
+                    del self._terms[bisect_left(self._terms, term)]
+
+    def _expand(self, token):
+        i = bisect_left(self._terms, token)
+        while i < len(self._terms) and self._terms[i].startswith(token):
+            yield self._terms[i]
+            i += 1
+
+    def search(self, text):
+        """
+        Returns [(resource_id, score), ...] best first, at most max_hits of
+        them. Every word of the query must prefix-match some indexed word,
+        as with the SQL path.
+        """
+        tokens = set(tokenize(text))
+        if not tokens:
+            return []
+        version = self.catalogue_version()
+        with self._lock:
+            if not self._built or version != self._version:
+                self.build()
+            n = len(self._doc_len)
+            if not n:
+                return []
+            avgdl = self._total_len / n
+            scores = None
+            for token in tokens:
+                token_scores = {}
+                for term in self._expand(token):
+                    postings = self._postings[term]
+                    df = len(postings.docs)
+                    idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                    for doc_id, tf in zip(postings.docs, postings.freqs):
+                        norm = K1 * (1 - B + B * self._doc_len[doc_id] / avgdl)
+                        score = idf * tf * (K1 + 1) / (tf + norm)
+                        if score > token_scores.get(doc_id, 0.0):
+                            token_scores[doc_id] = score
+                if scores is None:
+                    scores = token_scores
+                else:
+                    scores = {doc_id: scores[doc_id] + score
+                              for doc_id, score in token_scores.items()
+                              if doc_id in scores}
+                if not scores:
+                    return []
+        return heapq.nsmallest(self.max_hits, scores.items(),
+                               key=lambda item: (-item[1], item[0]))
+
+
+search_index = SearchIndex()
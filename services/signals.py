@@ -0,0 +1,42 @@
+from blinker import Namespace
+from sqlalchemy import event
+from models import db
+
+# Catalogue change notifications. Admin routes send these after the change
+# is committed; in-process indexes and caches subscribe in their init_app().
+# Receivers that write do so in a transaction of their own, which SQLite
+# cannot start while the sender's session holds uncommitted writes: they
+# call ensure_committed() first, to fail clearly instead of waiting on
+# the lock.
+_signals = Namespace()
+
+resource_saved = _signals.signal('resource-saved')
+resource_deleted = _signals.signal('resource-deleted')
+category_changed = _signals.signal('category-changed')
+
+# Sent with user_id= after a change to a user's name, role, activation or
+# theme is committed.
+user_changed = _signals.signal('user-changed')
+
+# Sent by the log writer inside each batch's transaction, with
+# rows={model: [column values, ...]}. Receivers may write through
+# db.session; their changes commit (or roll back) with the batch.
+logs_written = _signals.signal('logs-written')
+
+
+def ensure_committed():
+    """Raises RuntimeError if db.session has changes it has not committed."""
+    session = db.session
+    if session.new or session.dirty or session.deleted or session.info.get('_flushed'):
+        raise RuntimeError('Catalogue signals must be sent after the change is committed.')
+
+
+@event.listens_for(db.session, 'after_flush')
+def _flushed(session, flush_context):
+    session.info['_flushed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def _ended(session):
+    session.info.pop('_flushed', None)
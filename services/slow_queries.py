@@ -0,0 +1,127 @@
+import json
+import re
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+from flask import has_request_context, request
+from sqlalchemy import event
+from models import db
+
+# `plan` holds the EXPLAIN QUERY PLAN lines; `full_scans` the ones that
+# read a whole table.
+SlowQuery = namedtuple('SlowQuery', ['at', 'endpoint', 'duration', 'statement',
+                                     'parameters', 'plan', 'full_scans'])
+Offender = namedtuple('Offender', ['statement', 'count', 'total', 'worst', 'endpoints',
+                                   'full_scans', 'last'])
+
+
+_SCAN = re.compile(r'SCAN (\w+?)(?:_\d+)?(?: AS \w+)?$')
+
+
+def is_full_scan(detail):
+    """
+    Whether a plan line reads a whole table. "SCAN resource" does; "SCAN
+    resource USING [COVERING] INDEX ..." walks an index, "SEARCH ..."
+    seeks in one, and scans of CTEs, subqueries and the FTS virtual table
+    are not table scans.
+    """
+    match = _SCAN.match(detail)
+    return match is not None and match.group(1) in db.metadata.tables
+
+
+class SlowQueryLog:
+    """
+    Statements slower than SLOW_QUERY_MS, with their parameters, the
+    endpoint that ran them and their SQLite query plan.
+
+    The plan is taken right after the slow statement, on the same
+    connection, so it reflects the indexes and statistics it ran with;
+    only SELECTs are explained. The last SLOW_QUERY_LOG_SIZE entries of
+    each process are kept in memory for the admin page, and appended as
+    JSON lines to SLOW_QUERY_LOG_FILE when it is set. SLOW_QUERY_MS =
+    None leaves the engine unhooked.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._entries = deque()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SLOW_QUERY_MS', 100)
+        app.config.setdefault('SLOW_QUERY_LOG_SIZE', 200)
+        app.config.setdefault('SLOW_QUERY_LOG_FILE', None)
+        self.app = app
+        self._entries = deque(maxlen=app.config['SLOW_QUERY_LOG_SIZE'])
+        app.extensions['slow_queries'] = self
+        if app.config['SLOW_QUERY_MS'] is None:
+            return
+        self._threshold = app.config['SLOW_QUERY_MS'] / 1000
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', self._before_execute)
+        event.listen(engine, 'after_cursor_execute', self._after_execute)
+
+    def _before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_slow_query_start', []).append(time.perf_counter())
+
+    def _after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        starts = conn.info.get('_slow_query_start')
+        if not starts:
+            return
+        duration = time.perf_counter() - starts.pop()
+        if duration < self._threshold:
+            return
+        plan = []
+        if not executemany and statement.split(None, 1)[0].upper() in ('SELECT', 'WITH'):
+            plan = self._explain(cursor.connection, statement, parameters)
+        entry = SlowQuery(
+            at=datetime.utcnow(),
+            endpoint=(request.endpoint or 'none') if has_request_context() else 'cli',
+            duration=duration, statement=statement,
+            parameters=repr(parameters)[:500], plan=plan,
+            full_scans=[line for line in plan if is_full_scan(line)])
+        with self._lock:
+            self._entries.append(entry)
+        if self.app.config['SLOW_QUERY_LOG_FILE']:
+            self._write(entry)
+
+    def _explain(self, dbapi_connection, statement, parameters):
+        explain = dbapi_connection.cursor()
+        try:
+            explain.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            return [row[3] for row in explain.fetchall()]
+        except Exception as e:  # never fail the query being measured
+            return [f'EXPLAIN failed: {type(e).__name__}: {e}']
+        finally:
+            explain.close()
+
+    def _write(self, entry):
+        line = json.dumps(dict(entry._asdict(), at=entry.at.isoformat()))
+        with self._lock, open(self.app.config['SLOW_QUERY_LOG_FILE'], 'a') as f:
+            f.write(line + '\n')
+
+    def entries(self):
+        """The captured queries, newest first."""
+        with self._lock:
+            return list(reversed(self._entries))
+
+    def offenders(self, limit=20):
+        """Captured statements by total time spent, worst first."""
+        groups = {}
+        for entry in self.entries():
+            groups.setdefault(entry.statement, []).append(entry)
+        result = [Offender(
+            statement=statement, count=len(entries),
+            total=sum(e.duration for e in entries),
+            worst=max(e.duration for e in entries),
+            endpoints=sorted({e.endpoint for e in entries}),
+            full_scans=entries[0].full_scans, last=entries[0])
+            for statement, entries in groups.items()]
+        result.sort(key=lambda offender: offender.total, reverse=True)
+        return result[:limit]
+
+
+slow_queries = SlowQueryLog()
@@ -0,0 +1,174 @@
+import itertools
+import re
+import threading
+from array import array
+from models import db, Resource
+from services.signals import resource_saved, resource_deleted
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Fields whose words can be offered as corrections.
+FIELDS = ('title', 'creator', 'subject')
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall((text or '').lower())
+
+
+def trigrams(word):
+    """pg_trgm style trigrams: the word padded with two spaces in front, one behind."""
+    padded = f'  {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class SpellingIndex:
+    """
+    Trigram index over the words of every title, creator and subject,
+    behind the "did you mean" suggestions of main.search.
+
+    Each trigram maps to the ids of the words containing it. Candidates for
+    a misspelled word are found by counting shared trigrams over just the
+    posting lists of its own trigrams, so the work depends on how common
+    those trigrams are, not on the size of the catalogue. A candidate is kept
+    when its similarity (shared / distinct trigrams of both words) reaches
+    SPELLING_THRESHOLD. Built on first use, then kept current by the
+    catalogue signals.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.RLock()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def _reset(self):
+        self._ids = {}                 # word -> word id
+        self._words = []               # word id -> word
+        self._sizes = array('H')       # word id -> number of trigrams
+        self._doc_freq = array('I')    # word id -> resources using it
+        self._postings = {}            # trigram -> array of word ids
+        self._owners = {}              # resource id -> its set of words
+        self._built = False
+
+    def init_app(self, app):
+        app.config.setdefault('SPELLING_THRESHOLD', 0.3)
+        app.config.setdefault('SPELLING_SUGGESTIONS', 3)
+        self.threshold = app.config['SPELLING_THRESHOLD']
+        self._limit = app.config['SPELLING_SUGGESTIONS']
+        app.extensions['spelling_index'] = self
+        resource_saved.connect(self._on_saved, sender=app, weak=False)
+        resource_deleted.connect(self._on_deleted, sender=app, weak=False)
+
+    # --- Maintenance ---
+
+    def _word_id(self, word):
+        word_id = self._ids.get(word)
+        if word_id is None:
+            word_id = self._ids[word] = len(self._words)
+            grams = trigrams(word)
+            self._words.append(word)
+            self._sizes.append(min(len(grams), 0xFFFF))
+            self._doc_freq.append(0)
+            for gram in grams:
+                self._postings.setdefault(gram, array('I')).append(word_id)
+        return word_id
+
+    def _set_resource(self, resource_id, texts):
+        words = set()
+        for text in texts:
+            words.update(tokenize(text))
+        with self._lock:
+            # Words nobody uses any more keep their id with a zero count and
+            # are skipped at lookup; a rebuild compacts them away.
+            for word in self._owners.pop(resource_id, ()):
+                self._doc_freq[self._ids[word]] -= 1
+            for word in words:
+                self._doc_freq[self._word_id(word)] += 1
+            if words:
+                self._owners[resource_id] = words
+
+    def _on_saved(self, sender, resource, **extra):
+        with self._lock:
+            if self._built:
+                self._set_resource(resource.id, [getattr(resource, f) for f in FIELDS])
+
+    def _on_deleted(self, sender, resource_id, **extra):
+        with self._lock:
+            if self._built:
+                self._set_resource(resource_id, ())
+
+    def build(self):
+        """Loads every resource's words. Needs an app context."""
+        rows = db.session.query(
+            Resource.id, *[getattr(Resource, f) for f in FIELDS]).all()
+        with self._lock:
+            self._reset()
+            for resource_id, *texts in rows:
+                self._set_resource(resource_id, texts)
+            self._built = True
+
+    # --- Lookup ---
+
+    def known(self, word):
+        word_id = self._ids.get(word)
+        return word_id is not None and self._doc_freq[word_id] > 0
+
+    def candidates(self, word, limit=None):
+        """[(word, similarity)] for `word`, most similar (then most common) first."""
+        if not self._built:
+            self.build()
+        grams = trigrams(word)
+        # similarity <= min(a, b) / max(a, b), so shorter or longer words
+        # than this can never reach the threshold.
+        low = len(grams) * self.threshold
+        high = len(grams) / self.threshold
+        with self._lock:
+            shared = {}
+            for gram in grams:
+                for word_id in self._postings.get(gram, ()):
+                    shared[word_id] = shared.get(word_id, 0) + 1
+            scored = []
+            for word_id, count in shared.items():
+                size = self._sizes[word_id]
+                if not low <= size <= high or not self._doc_freq[word_id]:
+                    continue
+                similarity = count / (len(grams) + size - count)
+                if similarity >= self.threshold:
+                    scored.append((similarity, self._doc_freq[word_id],
+                                   self._words[word_id]))
+        scored.sort(key=lambda s: (-s[0], -s[1], s[2]))
+        return [(w, similarity) for similarity, _, w in scored[:limit or self._limit]]
+
+    def suggest(self, query, limit=None):
+        """
+        Respellings of `query`, best first. Words of three letters or more
+        that are not in the index are replaced by their closest matches.
+        """
+        limit = limit or self._limit
+        if not self._built:
+            self.build()
+        options = []
+        for token in tokenize(query):
+            if len(token) < 3 or self.known(token):
+                options.append([(token, 1.0)])
+            else:
+                # Nothing close enough: leave the word as it was typed.
+                options.append(self.candidates(token, limit) or [(token, 1.0)])
+        if len(options) > 6:
+            options = [o[:1] for o in options]
+        # Every combination of the top candidates, best total similarity
+        # first; queries are short, so this stays small.
+        ranked = sorted(itertools.product(*options),
+                        key=lambda combo: -sum(s for _, s in combo))
+        original = ' '.join(tokenize(query))
+        suggestions = []
+        for combo in ranked:
+            text = ' '.join(word for word, _ in combo)
+            if text != original and text not in suggestions:
+                suggestions.append(text)
+            if len(suggestions) == limit:
+                break
+        return suggestions
+
+
+spelling_index = SpellingIndex()
@@ -0,0 +1,258 @@
+import glob
+import hashlib
+import os
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from sqlalchemy import delete, update, select
+from sqlalchemy.dialects.sqlite import insert
+from werkzeug.utils import secure_filename
+from models import db, Blob, Resource, ResourceText
+
+BLOB_DIR = 'blobs'
+
+# `duplicate` is True when the content was already stored.
+StoredFile = namedtuple('StoredFile', ['filename', 'sha256', 'size', 'duplicate'])
+
+
+def is_blob(filename):
+    return bool(filename) and filename.startswith(BLOB_DIR + '/')
+
+
+def _extension(name):
+    ext = os.path.splitext(secure_filename(name or ''))[1].lower()
+    return ext if len(ext) <= 10 else ''
+
+
+class BlobStore:
+    """
+    Content-addressed storage for uploads.
+
+    Each file is hashed while it streams to a temporary file and stored
+    once, as blobs/<2 hex>/<sha256><ext> under UPLOAD_FOLDER, whatever name
+    it was uploaded under. A Blob row counts the resource files and preview
+    images pointing at it. save() writes that row, and acquire() and
+    release() change the count, in the caller's transaction: nothing here
+    commits, so they commit together with the resource change. Files are
+    never deleted at release: `flask sweep-blobs` removes blobs left
+    unreferenced for longer than BLOB_GRACE_SECONDS, so an upload racing a
+    delete of the same content is never left without its file.
+    """
+
+    def __init__(self, app=None):
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('BLOB_GRACE_SECONDS', 86400)
+        app.config.setdefault('BLOB_CHUNK_SIZE', 1024 * 1024)
+        self.app = app
+        app.extensions['blob_store'] = self
+
+    @property
+    def root(self):
+        return self.app.config['UPLOAD_FOLDER']
+
+    def path(self, filename):
+        return os.path.join(self.root, filename)
+
+    def temp_dir(self):
+        folder = os.path.join(self.root, BLOB_DIR, 'tmp')
+        os.makedirs(folder, exist_ok=True)
+        return folder
+
+    def save(self, file_storage):
+        """Stores an uploaded file and returns a StoredFile."""
+        chunk_size = self.app.config['BLOB_CHUNK_SIZE']
+        digest = hashlib.sha256()
+        size = 0
+        temp = os.path.join(self.temp_dir(), f'{os.getpid()}-{time.monotonic_ns()}')
+        try:
+            with open(temp, 'wb') as f:
+                for chunk in iter(lambda: file_storage.stream.read(chunk_size), b''):
+                    digest.update(chunk)
+                    f.write(chunk)
+                    size += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            return self._commit_file(temp, digest.hexdigest(), size,
+                                     _extension(file_storage.filename))
+        finally:
+            if os.path.exists(temp):
+                os.remove(temp)
+
+    def save_file(self, path, name):
+        """
+        Stores a complete file already on the same filesystem, e.g. a
+        chunked upload, under the extension of `name`. The file is moved
+        into place (or removed, if its content is already stored).
+        """
+        chunk_size = self.app.config['BLOB_CHUNK_SIZE']
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        try:
+            return self._commit_file(path, digest.hexdigest(), os.path.getsize(path),
+                                     _extension(name))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _commit_file(self, temp, sha256, size, ext):
+        """
+        Moves a hashed temporary file into place, unless it is known. The
+        row is inserted or touched in the caller's transaction, not
+        committed: the caller commits it with the references it adds.
+        """
+        now = datetime.utcnow()
+        # One statement, so a row the sweeper deleted since the caller last
+        # looked is inserted again rather than silently not touched; the
+        # touch keeps the sweeper off the blob until the caller commits.
+        statement = insert(Blob).values(
+            sha256=sha256, filename=f'{BLOB_DIR}/{sha256[:2]}/{sha256}{ext}',
+            size=size, refcount=0, touched_at=now)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=[Blob.sha256], set_={'touched_at': now}))
+        filename = db.session.scalar(select(Blob.filename).where(Blob.sha256 == sha256))
+        if os.path.exists(self.path(filename)):
+            return StoredFile(filename, sha256, size, True)
+        os.makedirs(os.path.dirname(self.path(filename)), exist_ok=True)
+        os.replace(temp, self.path(filename))
+        return StoredFile(filename, sha256, size, False)
+
+    def acquire(self, filename):
+        """Counts a new reference to a blob, in the current transaction."""
+        if is_blob(filename):
+            db.session.execute(update(Blob).where(Blob.filename == filename).values(
+                refcount=Blob.refcount + 1, touched_at=datetime.utcnow()))
+
+    def release(self, filename):
+        """Drops a reference to a blob, in the current transaction."""
+        if is_blob(filename):
+            db.session.execute(update(Blob).where(
+                Blob.filename == filename, Blob.refcount > 0).values(
+                refcount=Blob.refcount - 1, touched_at=datetime.utcnow()))
+
+    def users(self, filename):
+        """Resources whose file is `filename`."""
+        return Resource.query.filter(Resource.filename == filename).all()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        try:
+            # The two-character prefix folder, once it is empty.
+            os.rmdir(os.path.dirname(path))
+        except OSError:
+            pass
+
+    def sweep(self, grace=None, dry_run=False):
+        """
+        Deletes the blobs unreferenced and untouched for `grace` seconds,
+        plus files under blobs/ that no row knows about (an upload that
+        crashed before its commit). Returns (files, bytes).
+        """
+        grace = self.app.config['BLOB_GRACE_SECONDS'] if grace is None else grace
+        cutoff = datetime.utcnow() - timedelta(seconds=grace)
+        removed = freed = 0
+        candidates = db.session.query(Blob.sha256, Blob.filename, Blob.size).filter(
+            Blob.refcount == 0, Blob.touched_at < cutoff).all()
+        for sha256, filename, size in candidates:
+            if dry_run:
+                removed, freed = removed + 1, freed + size
+                continue
+            # Re-checked in the DELETE itself: an upload of the same content
+            # or a new reference since the query keeps the blob.
+            result = db.session.execute(delete(Blob).where(
+                Blob.sha256 == sha256, Blob.refcount == 0, Blob.touched_at < cutoff))
+            if result.rowcount == 1:
+                # Removed while the delete holds the write lock, so a
+                # concurrent save() waits and then stores the file again.
+                self._remove(self.path(filename))
+                # Resized copies of a preview image are named after it.
+                for derivative in glob.glob(self.path(f'previews/{sha256[:2]}/{sha256}-*')):
+                    freed += os.path.getsize(derivative)
+                    self._remove(derivative)
+                removed, freed = removed + 1, freed + size
+            db.session.commit()
+
+        known = {filename for filename, in db.session.query(Blob.filename)}
+        limit = time.time() - grace
+        for folder, _, files in os.walk(self.path(BLOB_DIR)):
+            for name in files:
+                path = os.path.join(folder, name)
+                filename = os.path.relpath(path, self.root).replace(os.sep, '/')
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if filename in known or stat.st_mtime >= limit:
+                    continue
+                if not dry_run:
+                    self._remove(path)
+                removed, freed = removed + 1, freed + stat.st_size
+        return removed, freed
+
+    def import_legacy(self, out=print):
+        """
+        Moves the files resources reference by plain name into the blob
+        store, merging identical ones, and points the resources at the
+        blobs. Files no resource references are reported, not deleted.
+        """
+        referenced = {}
+        for resource in Resource.query.all():
+            for column in ('filename', 'preview_image'):
+                name = getattr(resource, column)
+                if name and not is_blob(name):
+                    referenced.setdefault(name, []).append((resource, column))
+
+        moved = merged = 0
+        for name, uses in sorted(referenced.items()):
+            legacy = self.path(name)
+            if not os.path.isfile(legacy):
+                out(f'missing: {name}')
+                continue
+            digest = hashlib.sha256()
+            temp = os.path.join(self.temp_dir(), f'{os.getpid()}-{time.monotonic_ns()}')
+            # Copied, not moved: the legacy file stays until the rows commit.
+            with open(legacy, 'rb') as src, open(temp, 'wb') as dst:
+                for chunk in iter(lambda: src.read(self.app.config['BLOB_CHUNK_SIZE']), b''):
+                    digest.update(chunk)
+                    dst.write(chunk)
+                dst.flush()
+                os.fsync(dst.fileno())
+            try:
+                stored = self._commit_file(temp, digest.hexdigest(),
+                                           os.path.getsize(legacy), _extension(name))
+            finally:
+                if os.path.exists(temp):
+                    os.remove(temp)
+            for resource, column in uses:
+                setattr(resource, column, stored.filename)
+                if column == 'filename':
+                    resource.original_filename = resource.original_filename or name
+                    resource.content_hash = stored.sha256
+                    text = db.session.get(ResourceText, resource.id)
+                    if text is not None and text.filename == name:
+                        # Same bytes, so the extracted text still holds.
+                        text.filename = stored.filename
+                self.acquire(stored.filename)
+            db.session.commit()
+            os.remove(legacy)
+            merged += stored.duplicate
+            moved += 1
+            out(f'{name} -> {stored.filename}'
+                + (' (duplicate)' if stored.duplicate else ''))
+
+        unreferenced = sorted(
+            name for name in os.listdir(self.root)
+            if os.path.isfile(self.path(name)) and name not in referenced)
+        for name in unreferenced:
+            out(f'unreferenced: {name}')
+        return moved, merged, unreferenced
+
+
+blob_store = BlobStore()
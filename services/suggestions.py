@@ -0,0 +1,150 @@
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from sqlalchemy import func
+from models import db, Resource, SearchQueryLog
+from services.signals import resource_saved, resource_deleted
+
+_WORD_START_RE = re.compile(r'\b\w', re.UNICODE)
+
+
+def normalize(text):
+    return ' '.join((text or '').lower().split())
+
+
+class SuggestionIndex:
+    """
+    Sorted-array prefix index behind /search/suggestions.
+
+    Every title and creator is indexed under each of its word positions, so
+    "walk" finds "Long Walk To Freedom" the same way the old ILIKE did. The
+    most frequent logged searches are mixed in, weighted by how often they
+    were run. Resource entries follow the catalogue signals; the popular
+    searches are reloaded every SUGGEST_REFRESH_SECONDS.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.RLock()
+        self._keys = []        # sorted (key, text) pairs
+        self._refs = {}        # text -> number of owners keeping it indexed
+        self._weights = {}     # text -> ranking weight
+        self._owners = {}      # resource id -> texts it contributed
+        self._popular = {}     # logged query text -> count
+        self._refreshed = 0.0
+        self.version = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('SUGGEST_LIMIT', 5)
+        app.config.setdefault('SUGGEST_POPULAR_QUERIES', 500)
+        app.config.setdefault('SUGGEST_REFRESH_SECONDS', 600)
+        self._limit = app.config['SUGGEST_LIMIT']
+        self._popular_size = app.config['SUGGEST_POPULAR_QUERIES']
+        self._refresh_seconds = app.config['SUGGEST_REFRESH_SECONDS']
+        app.extensions['suggestion_index'] = self
+        resource_saved.connect(self._on_saved, sender=app, weak=False)
+        resource_deleted.connect(self._on_deleted, sender=app, weak=False)
+
+    # --- Maintenance ---
+
+    def _add_text(self, text, weight):
+        if not text:
+            return
+        self._weights[text] = self._weights.get(text, 0) + weight
+        self._refs[text] = self._refs.get(text, 0) + 1
+        if self._refs[text] > 1:
+            return
+        lowered = normalize(text)
+        for match in _WORD_START_RE.finditer(lowered):
+            insort(self._keys, (lowered[match.start():], text))
+
+    def _drop_text(self, text, weight):
+        if text not in self._refs:
+            return
+        self._weights[text] -= weight
+        self._refs[text] -= 1
+        if self._refs[text]:
+            return
+        del self._refs[text]
+        del self._weights[text]
+        lowered = normalize(text)
+        for match in _WORD_START_RE.finditer(lowered):
+            i = bisect_left(self._keys, (lowered[match.start():], text))
+            if i < len(self._keys) and self._keys[i][1] == text:
+                del self._keys[i]
+
+    def _set_resource(self, resource_id, texts):
+        with self._lock:
+            for text in self._owners.pop(resource_id, ()):
+                self._drop_text(text, 1)
+            texts = tuple(t for t in texts if t)
+            for text in texts:
+                self._add_text(text, 1)
+            if texts:
+                self._owners[resource_id] = texts
+            self.version += 1
+
+    def _on_saved(self, sender, resource, **extra):
+        self._set_resource(resource.id, (resource.title, resource.creator))
+
+    def _on_deleted(self, sender, resource_id, **extra):
+        self._set_resource(resource_id, ())
+
+    def _load_popular(self):
+        rows = db.session.query(
+            SearchQueryLog.query_text, func.count(SearchQueryLog.id)
+        ).filter(
+            ~SearchQueryLog.query_text.startswith('Advanced: '),
+            SearchQueryLog.results_count > 0
+        ).group_by(SearchQueryLog.query_text).order_by(
+            func.count(SearchQueryLog.id).desc()
+        ).limit(self._popular_size).all()
+        with self._lock:
+            for text, count in self._popular.items():
+                self._drop_text(text, count)
+            self._popular = {text.strip(): count for text, count in rows
+                             if text.strip()}
+            for text, count in self._popular.items():
+                self._add_text(text, count)
+            self._refreshed = time.monotonic()
+            self.version += 1
+
+    def build(self):
+        """Loads titles, creators and popular searches. Needs an app context."""
+        rows = db.session.query(
+            Resource.id, Resource.title, Resource.creator).all()
+        with self._lock:
+            self._keys, self._refs, self._weights = [], {}, {}
+            self._owners, self._popular = {}, {}
+            for resource_id, title, creator in rows:
+                self._set_resource(resource_id, (title, creator))
+        self._load_popular()
+
+    # --- Lookup ---
+
+    def suggest(self, prefix, limit=None):
+        limit = limit or self._limit
+        key = normalize(prefix)
+        if not key:
+            return []
+        if time.monotonic() - self._refreshed > self._refresh_seconds:
+            self._load_popular()
+        with self._lock:
+            i = bisect_left(self._keys, (key,))
+            matches = {}
+            while i < len(self._keys) and self._keys[i][0].startswith(key):
+                text = self._keys[i][1]
+                # Whole-string prefix matches rank ahead of mid-title ones.
+                starts = normalize(text).startswith(key)
+                best = matches.get(text, (False,))
+                if starts or not best[0]:
+                    matches[text] = (starts, self._weights[text])
+                i += 1
+        ranked = sorted(matches.items(),
+                        key=lambda item: (not item[1][0], -item[1][1], item[0].lower()))
+        return [text for text, _ in ranked[:limit]]
+
+
+suggestion_index = SuggestionIndex()
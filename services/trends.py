@@ -0,0 +1,333 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from datetime import datetime
+from models import SearchQueryLog
+from services.processes import alive
+from services.rollups import normalize_query
+from services.signals import logs_written
+
+# Each window is a ring of panes: (seconds per pane, number of panes).
+WINDOWS = {
+    'hour': (300, 12),
+    'day': (3600, 24),
+    'week': (86400, 7),
+}
+STREAMS = ('popular', 'zero_results')
+
+_EPOCH = datetime(1970, 1, 1)
+
+# `count` may overestimate the true count by at most `error`.
+Trend = namedtuple('Trend', ['query_text', 'count', 'error'])
+
+
+class _Bucket:
+    __slots__ = ('count', 'items', 'prev', 'next')
+
+    def __init__(self, count, prev=None, next=None):
+        self.count = count
+        self.items = set()
+        self.prev = prev
+        self.next = next
+
+
+class SpaceSaving:
+    """
+    Space-Saving top-k counter (Metwally et al.) on a stream-summary list.
+
+    At most `capacity` items are monitored. A new item takes the place of
+    one with the smallest count and inherits that count as its error, so
+    any item seen more than N / capacity times is guaranteed to be kept.
+    Items sharing a count live in one bucket of an ascending linked list,
+    which makes every update O(1).
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._items = {}       # item -> [bucket, error]
+        self._head = None      # bucket with the smallest count
+
+    def _link_after(self, bucket, count):
+        # A new bucket right after `bucket` (or at the head if None).
+        nxt = bucket.next if bucket else self._head
+        new = _Bucket(count, bucket, nxt)
+        if nxt:
+            nxt.prev = new
+        if bucket:
+            bucket.next = new
+        else:
+            self._head = new
+        return new
+
+    def _unlink(self, bucket):
+        if bucket.prev:
+            bucket.prev.next = bucket.next
+        else:
+            self._head = bucket.next
+        if bucket.next:
+            bucket.next.prev = bucket.prev
+
+    def _increment(self, item, entry):
+        bucket = entry[0]
+        target = bucket.next
+        if target is None or target.count != bucket.count + 1:
+            target = self._link_after(bucket, bucket.count + 1)
+        bucket.items.discard(item)
+        target.items.add(item)
+        entry[0] = target
+        if not bucket.items:
+            self._unlink(bucket)
+
+    def add(self, item):
+        entry = self._items.get(item)
+        if entry is None:
+            if len(self._items) < self.capacity:
+                bucket = self._head
+                if bucket is None or bucket.count != 1:
+                    bucket = self._link_after(None, 1)
+                bucket.items.add(item)
+                self._items[item] = [bucket, 0]
+                return
+            bucket = self._head
+            victim = bucket.items.pop()
+            del self._items[victim]
+            bucket.items.add(item)
+            entry = self._items[item] = [bucket, bucket.count]
+        self._increment(item, entry)
+
+    def counts(self):
+        return {item: (entry[0].count, entry[1]) for item, entry in self._items.items()}
+
+    def dump(self):
+        return [[item, bucket_count, error]
+                for item, (bucket_count, error) in self.counts().items()]
+
+    @classmethod
+    def load(cls, capacity, entries):
+        sketch = cls(capacity)
+        last = None
+        for item, count, error in sorted(entries, key=lambda e: e[1])[-capacity:]:
+            if last is None or last.count != count:
+                last = sketch._link_after(last, count)
+            last.items.add(item)
+            sketch._items[item] = [last, error]
+        return sketch
+
+
+class SlidingTopK:
+    """
+    Space-Saving counts over a sliding window, kept as a ring of panes.
+    Expired panes are dropped whole; a query merges the live ones.
+    """
+
+    def __init__(self, pane_seconds, panes, capacity):
+        self.pane_seconds = pane_seconds
+        self.panes = panes
+        self.capacity = capacity
+        self._ring = deque()   # (pane index, SpaceSaving), oldest first
+
+    def _index(self, moment):
+        return int((moment - _EPOCH).total_seconds() // self.pane_seconds)
+
+    def add(self, item, moment):
+        index = self._index(moment)
+        if not self._ring or index > self._ring[-1][0]:
+            self._ring.append((index, SpaceSaving(self.capacity)))
+            while self._ring[0][0] <= index - self.panes:
+                self._ring.popleft()
+        # Rows normally arrive in order, so the pane is almost always the last.
+        for pane_index, sketch in reversed(self._ring):
+            if pane_index == index:
+                sketch.add(item)
+                return
+            if pane_index < index:
+                return
+
+    def counts(self, now):
+        """item -> (count, error) over the panes still in the window."""
+        oldest = self._index(now) - self.panes + 1
+        merged = {}
+        for index, sketch in self._ring:
+            if index < oldest:
+                continue
+            _add_counts(merged, sketch.counts())
+        return merged
+
+    def dump(self):
+        return [[index, sketch.dump()] for index, sketch in self._ring]
+
+    def load(self, panes):
+        self._ring = deque((index, SpaceSaving.load(self.capacity, entries))
+                           for index, entries in sorted(panes))
+
+    def merge(self, panes):
+        """
+        Adds another sketch's dump() to this one, pane by pane. Counts and
+        errors are summed and each pane keeps its `capacity` largest items.
+        """
+        ring = {index: sketch.dump() for index, sketch in self._ring}
+        for index, entries in panes:
+            totals = {item: (count, error) for item, count, error in ring.get(index, [])}
+            _add_counts(totals, {item: (count, error) for item, count, error in entries})
+            ring[index] = [[item, count, error] for item, (count, error) in totals.items()]
+        self.load(ring.items())
+
+
+def _add_counts(totals, counts):
+    for item, (count, error) in counts.items():
+        total = totals.get(item, (0, 0))
+        totals[item] = (total[0] + count, total[1] + error)
+
+
+def _ranked(counts, limit):
+    ranked = sorted(counts.items(), key=lambda kv: (-kv[1][0], kv[0]))
+    return [Trend(item, count, error) for item, (count, error) in ranked[:limit]]
+
+
+class SearchTrends:
+    """
+    Popular and zero-result searches over the last hour, day and week,
+    from the SearchQueryLog rows as the log writer commits them.
+
+    Memory is bounded by TRENDS_CAPACITY counters per pane whatever the
+    traffic, and each logged search costs O(1) per window. Every process
+    counts the searches it logged itself and saves its sketches to
+    <TRENDS_DIR>/<pid>.json every TRENDS_SAVE_SECONDS and at exit; top()
+    adds the saved sketches of the other processes to its own, so the
+    dashboard shows every worker's searches. A process takes over the
+    files of processes that have exited the first time it is used, so
+    the counts survive restarts without being counted twice.
+    """
+
+    def __init__(self, app=None):
+        self._lock = threading.Lock()
+        self._saved = time.monotonic()
+        self._pid = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('TRENDS_CAPACITY', 100)
+        app.config.setdefault('TRENDS_SAVE_SECONDS', 60)
+        app.config.setdefault('TRENDS_DIR', os.path.join(app.instance_path, 'trends'))
+        self._capacity = app.config['TRENDS_CAPACITY']
+        self._save_seconds = app.config['TRENDS_SAVE_SECONDS']
+        self._dir = app.config['TRENDS_DIR']
+        self._sketches = self._empty()
+        app.extensions['search_trends'] = self
+        logs_written.connect(self._on_logs_written, sender=app, weak=False)
+        atexit.register(self.save)
+
+    def _empty(self):
+        return {stream: {window: SlidingTopK(seconds, panes, self._capacity)
+                         for window, (seconds, panes) in WINDOWS.items()}
+                for stream in STREAMS}
+
+    def _check_process(self):
+        # Sketches belong to the process that filled them: one forked from
+        # a process that already counted (or adopted) searches starts over,
+        # or they would be saved once per worker.
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._sketches = self._empty()
+            self._adopt()
+            self._pid = os.getpid()
+
+    def _adopt(self):
+        # Merges the files of exited processes into this one's sketches.
+        # Renaming a file claims it, so only one new worker takes it over.
+        claimed = []
+        for path in self._files():
+            pid = int(os.path.basename(path)[:-5])
+            if pid != os.getpid() and alive(pid):
+                continue
+            claim = f'{path}.{os.getpid()}.claimed'
+            try:
+                os.rename(path, claim)
+            except OSError:
+                continue
+            state = _read(claim)
+            for stream, windows in self._sketches.items():
+                for window, sketch in windows.items():
+                    sketch.merge(state.get(stream, {}).get(window, []))
+            claimed.append(claim)
+        if claimed:
+            self._write(self._state())
+            for claim in claimed:
+                os.remove(claim)
+
+    def _files(self):
+        return [path for path in glob.glob(os.path.join(self._dir, '*.json'))
+                if os.path.basename(path)[:-5].isdigit()]
+
+    def record(self, query_text, results_count, moment=None):
+        query = normalize_query(query_text)
+        if not query:
+            return
+        self._check_process()
+        moment = moment or datetime.utcnow()
+        streams = ('popular', 'zero_results') if not results_count else ('popular',)
+        with self._lock:
+            for stream in streams:
+                for sketch in self._sketches[stream].values():
+                    sketch.add(query, moment)
+
+    def _on_logs_written(self, sender, rows, **extra):
+        for row in rows.get(SearchQueryLog, ()):
+            self.record(row['query_text'], row['results_count'], row['search_date'])
+        if time.monotonic() - self._saved > self._save_seconds:
+            self.save()
+
+    def top(self, stream, window, limit=5):
+        """The `limit` most frequent queries of every process."""
+        self._check_process()
+        now = datetime.utcnow()
+        own = self._sketches[stream][window]
+        with self._lock:
+            counts = own.counts(now)
+        mine = os.path.join(self._dir, f'{os.getpid()}.json')
+        for path in self._files():
+            if path == mine:
+                continue
+            other = SlidingTopK(own.pane_seconds, own.panes, self._capacity)
+            other.load(_read(path).get(stream, {}).get(window, []))
+            _add_counts(counts, other.counts(now))
+        return _ranked(counts, limit)
+
+    def _state(self):
+        return {stream: {window: sketch.dump() for window, sketch in windows.items()}
+                for stream, windows in self._sketches.items()}
+
+    def save(self):
+        """Writes this process's sketches to TRENDS_DIR."""
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            state = self._state()
+            self._saved = time.monotonic()
+        self._write(state)
+
+    def _write(self, state):
+        os.makedirs(self._dir, exist_ok=True)
+        path = os.path.join(self._dir, f'{os.getpid()}.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(state, f, separators=(',', ':'))
+        os.replace(path + '.tmp', path)
+
+
+def _read(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+search_trends = SearchTrends()
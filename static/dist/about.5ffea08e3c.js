@@ -0,0 +1,33 @@
+document.addEventListener("DOMContentLoaded", function () {
+const observerOptions = {
+threshold: 0.1,
+rootMargin: "0px 0px -50px 0px",
+};
+const observer = new IntersectionObserver(function (entries) {
+entries.forEach((entry) => {
+if (entry.isIntersecting) {
+entry.target.style.opacity = "1";
+entry.target.style.transform = "translateY(0)";
+}
+});
+}, observerOptions);
+const animatedElements = document.querySelectorAll(".mv-card, .value-item");
+animatedElements.forEach((el) => {
+el.style.opacity = "0";
+el.style.transform = "translateY(20px)";
+el.style.transition = "opacity 0.6s ease, transform 0.6s ease";
+observer.observe(el);
+});
+document.querySelectorAll('a[href^="#"]').forEach((anchor) => {
+anchor.addEventListener("click", function (e) {
+e.preventDefault();
+const target = document.querySelector(this.getAttribute("href"));
+if (target) {
+target.scrollIntoView({
+behavior: "smooth",
+block: "start",
+});
+}
+});
+});
+});
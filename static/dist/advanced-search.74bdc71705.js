@@ -0,0 +1,70 @@
+const settings = document.currentScript.dataset;
+document.addEventListener("DOMContentLoaded", function () {
+const form = document.getElementById("advanced-search-form");
+const searchButton = document.getElementById("search-button");
+form.addEventListener("submit", function () {
+searchButton.classList.add("loading");
+searchButton.disabled = true;
+});
+const clearButton = form.querySelector('button[type="reset"]');
+clearButton.addEventListener("click", function () {
+const inputs = form.querySelectorAll(
+'input[type="text"], input[type="number"]'
+);
+inputs.forEach((input) => {
+input.value = "";
+input.classList.remove("is-invalid");
+});
+const selects = form.querySelectorAll("select");
+selects.forEach((select) => {
+select.selectedIndex = 0;
+});
+const errorMessages = form.querySelectorAll(".invalid-feedback");
+errorMessages.forEach((error) => error.remove());
+});
+const inputs = form.querySelectorAll(
+'input[type="text"], input[type="number"]'
+);
+inputs.forEach((input) => {
+input.addEventListener("blur", function () {
+if (this.value.trim() !== "" && this.checkValidity) {
+if (!this.checkValidity()) {
+this.classList.add("is-invalid");
+} else {
+this.classList.remove("is-invalid");
+}
+}
+});
+});
+const startYear = document.getElementById(settings.startYearId);
+const endYear = document.getElementById(settings.endYearId);
+function validateYearRange() {
+if (startYear.value && endYear.value) {
+if (parseInt(startYear.value) > parseInt(endYear.value)) {
+startYear.classList.add("is-invalid");
+endYear.classList.add("is-invalid");
+let errorMessage =
+startYear.parentNode.querySelector(".year-range-error");
+if (!errorMessage) {
+errorMessage = document.createElement("div");
+errorMessage.className = "invalid-feedback year-range-error";
+errorMessage.textContent =
+settings.yearRangeError;
+startYear.parentNode.appendChild(errorMessage);
+}
+} else {
+startYear.classList.remove("is-invalid");
+endYear.classList.remove("is-invalid");
+const errorMessage =
+startYear.parentNode.querySelector(".year-range-error");
+if (errorMessage) {
+errorMessage.remove();
+}
+}
+}
+}
+if (startYear && endYear) {
+startYear.addEventListener("change", validateYearRange);
+endYear.addEventListener("change", validateYearRange);
+}
+});
@@ -0,0 +1,11 @@
+function togglePasswordVisibility(fieldId) {
+const passwordField = document.getElementById(fieldId);
+const toggleIcon = passwordField.nextElementSibling;
+if (passwordField.type === "password") {
+passwordField.type = "text";
+toggleIcon.textContent = "🙈";
+} else {
+passwordField.type = "password";
+toggleIcon.textContent = "👁️";
+}
+}
@@ -0,0 +1,58 @@
+// Translated labels and URLs come from the data-* attributes of the script tag.
+const settings = document.currentScript.dataset;
+
+document.addEventListener("DOMContentLoaded", function () {
+    // Chart.js script for analytics
+    const ctx = document.getElementById("dailyDownloadsChart").getContext("2d");
+    let dailyDownloadsChart;
+    const lineGradient = ctx.createLinearGradient(0, 0, 0, 400);
+    lineGradient.addColorStop(0, 'rgba(27, 122, 142, 0.6)');
+    lineGradient.addColorStop(1, 'rgba(27, 122, 142, 0)');
+    const chartConfig = { type: "line", data: { labels: [], datasets: [{ label: settings.downloadsLabel, data: [], borderColor: 'rgba(27, 122, 142, 1)', backgroundColor: lineGradient, tension: 0.4, fill: true, borderWidth: 3, pointBackgroundColor: 'rgba(27, 122, 142, 1)', pointBorderColor: '#fff', pointHoverRadius: 7, pointRadius: 5 }], }, options: { responsive: true, maintainAspectRatio: false, plugins: { legend: { display: false }, tooltip: { backgroundColor: '#fff', titleColor: '#333', bodyColor: '#666', borderColor: '#ddd', borderWidth: 1, padding: 10, cornerRadius: 8 } }, scales: { y: { beginAtZero: true, ticks: { stepSize: 1, color: '#6c757d' }, grid: { color: 'rgba(0,0,0,0.05)' } }, x: { ticks: { color: '#6c757d' }, grid: { display: false } } }, }, };
+    async function fetchChartData(period) {
+        try {
+            const response = await fetch(`${settings.analyticsUrl}?period=${period}`);
+            if (!response.ok) throw new Error('Network response was not ok');
+            const chartJson = await response.json();
+            dailyDownloadsChart.data.labels = chartJson.labels;
+            dailyDownloadsChart.data.datasets[0].data = chartJson.data;
+            const maxValue = Math.max(...chartJson.data, 0);
+            dailyDownloadsChart.options.scales.y.ticks.stepSize = (maxValue < 10) ? 1 : undefined;
+            dailyDownloadsChart.update();
+        } catch (error) { console.error('Failed to fetch chart data:', error); }
+    }
+    dailyDownloadsChart = new Chart(ctx, chartConfig);
+    document.querySelectorAll(".chart-btn").forEach(btn => {
+        btn.addEventListener("click", function () {
+            document.querySelectorAll(".chart-btn").forEach(b => b.classList.remove("active"));
+            this.classList.add("active");
+            fetchChartData(this.dataset.period);
+        });
+    });
+    fetchChartData(7);
+});
+
+document.addEventListener('DOMContentLoaded', function() {
+    // Find all links that point to an admin delete URL.
+    const deleteLinks = document.querySelectorAll('a[href*="/admin/delete/"]');
+
+    deleteLinks.forEach(function(link) {
+        // If the link is already inside a form, it's probably correct.
+        const parentForm = link.closest('form');
+        if (parentForm) return; 
+
+        // If it's a standalone link, override its behavior
+        link.addEventListener('click', function(event) {
+            event.preventDefault();
+
+            if (confirm(settings.confirmDelete)) {
+                const form = document.createElement('form');
+                form.method = 'POST';
+                form.action = link.href;
+
+                document.body.appendChild(form);
+                form.submit();
+            }
+        });
+    });
+});
@@ -0,0 +1,164 @@
+/**
+ * Show a toast notification
+ * @param {string} message - The message to display
+ * @param {string} type - Type: 'success', 'error', 'danger', 'warning', 'info'
+ * @param {number} duration - Duration in milliseconds (default: 5000)
+ */
+function showToast(message, type = 'info', duration = 5000) {
+  const container = document.getElementById('toast-container');
+
+  const icons = {
+    success: 'fa-check-circle',
+    error: 'fa-exclamation-circle',
+    danger: 'fa-exclamation-circle',
+    warning: 'fa-exclamation-triangle',
+    info: 'fa-info-circle'
+  };
+
+  const toast = document.createElement('div');
+  toast.className = `custom-toast ${type}`;
+  toast.innerHTML = `
+    <div class="custom-toast-icon">
+      <i class="fas ${icons[type] || icons.info}"></i>
+    </div>
+    <div class="custom-toast-content">${message}</div>
+    <button class="custom-toast-close" onclick="dismissToast(this)">
+      <i class="fas fa-times"></i>
+    </button>
+    <div class="toast-progress"></div>
+  `;
+
+  container.appendChild(toast);
+
+  // Auto-dismiss after duration
+  const timeoutId = setTimeout(() => {
+    dismissToast(toast.querySelector('.custom-toast-close'));
+  }, duration);
+
+  // Pause timer on hover
+  toast.addEventListener('mouseenter', () => {
+    clearTimeout(timeoutId);
+    const progressBar = toast.querySelector('.toast-progress');
+    if (progressBar) {
+      progressBar.style.animationPlayState = 'paused';
+    }
+  });
+
+  // Resume timer on mouse leave
+  toast.addEventListener('mouseleave', () => {
+    const remainingTime = 2000; // Give 2 more seconds on hover leave
+    setTimeout(() => {
+      dismissToast(toast.querySelector('.custom-toast-close'));
+    }, remainingTime);
+  });
+}
+
+/**
+ * Dismiss a toast notification
+ * @param {HTMLElement} button - The close button or toast element
+ */
+function dismissToast(button) {
+  const toast = button.closest ? button.closest('.custom-toast') : button;
+  if (!toast) return;
+
+  toast.classList.add('hiding');
+  setTimeout(() => {
+    if (toast.parentNode) {
+      toast.remove();
+    }
+  }, 300);
+}
+
+// Search functionality
+const searchToggleBtn = document.getElementById("searchToggleBtn");
+const searchBarExpanded = document.getElementById("searchBarExpanded");
+const searchInput = document.getElementById("search-input");
+
+if (searchToggleBtn) {
+  searchToggleBtn.addEventListener("click", function (e) {
+    e.preventDefault(); // Prevent page jump from <a> tag
+    searchBarExpanded.classList.toggle("show");
+    if (searchBarExpanded.classList.contains("show")) {
+      setTimeout(() => searchInput.focus(), 300);
+    }
+  });
+}
+
+const suggestionsBox = document.getElementById("suggestions-box");
+const searchForm = document.getElementById("search-form");
+
+if (searchInput) {
+  // Debounce keystrokes, drop responses for text the user has already
+  // typed past, and remember answers so backspacing costs nothing.
+  const suggestionCache = new Map();
+  let suggestionTimer = null;
+  let suggestionRequest = null;
+
+  function renderSuggestions(suggestions) {
+    suggestionsBox.innerHTML = "";
+    if (suggestions.length > 0) {
+      suggestionsBox.classList.remove("d-none");
+      suggestions.forEach((item) => {
+        const div = document.createElement("div");
+        div.textContent = item;
+        div.classList.add("suggestion-item");
+        div.onclick = function () {
+          searchInput.value = item;
+          suggestionsBox.classList.add("d-none");
+          searchForm.submit();
+        };
+        suggestionsBox.appendChild(div);
+      });
+    } else {
+      suggestionsBox.classList.add("d-none");
+    }
+  }
+
+  async function fetchSuggestions(query) {
+    if (suggestionCache.has(query)) {
+      renderSuggestions(suggestionCache.get(query));
+      return;
+    }
+    if (suggestionRequest) suggestionRequest.abort();
+    suggestionRequest = new AbortController();
+    try {
+      const response = await fetch(
+        `/search/suggestions?q=${encodeURIComponent(query)}`,
+        { signal: suggestionRequest.signal }
+      );
+      const suggestions = await response.json();
+      suggestionCache.set(query, suggestions);
+      if (searchInput.value.trim().toLowerCase() === query) {
+        renderSuggestions(suggestions);
+      }
+    } catch (error) {
+      if (error.name === "AbortError") return;
+      console.error("Error fetching suggestions:", error);
+      suggestionsBox.classList.add("d-none");
+    }
+  }
+
+  searchInput.addEventListener("input", function () {
+    const query = this.value.trim().toLowerCase();
+    clearTimeout(suggestionTimer);
+    if (query.length < 2) {
+      if (suggestionRequest) suggestionRequest.abort();
+      suggestionsBox.classList.add("d-none");
+      return;
+    }
+    suggestionTimer = setTimeout(() => fetchSuggestions(query), 200);
+  });
+
+  document.addEventListener("click", function (e) {
+    if (!suggestionsBox.contains(e.target) && e.target !== searchInput) {
+      suggestionsBox.classList.add("d-none");
+    }
+  });
+
+  searchInput.addEventListener("keydown", function (e) {
+    if (e.key === "Escape") {
+      suggestionsBox.classList.add("d-none");
+      searchBarExpanded.classList.remove("show");
+    }
+  });
+}
@@ -0,0 +1,162 @@
+document.addEventListener("DOMContentLoaded", function () {
+  const dateInput = document.getElementById("publication_date");
+
+  if (dateInput) {
+    // Validate on input
+    dateInput.addEventListener("input", function () {
+      const value = this.value;
+
+      if (value) {
+        const parts = value.split("-");
+        if (parts.length === 3) {
+          const year = parseInt(parts[0]);
+          const currentYear = new Date().getFullYear();
+
+          // Check if year is exactly 4 digits and in valid range
+          if (parts[0].length !== 4 || year < 1000 || year > currentYear) {
+            this.value = "";
+            this.classList.add("is-invalid");
+            alert(
+              "Please enter a valid year between 1000 and " + currentYear
+            );
+          } else {
+            this.classList.remove("is-invalid");
+          }
+        }
+      }
+    });
+
+    // Additional validation on change
+    dateInput.addEventListener("change", function () {
+      if (this.value) {
+        const date = new Date(this.value);
+        const today = new Date();
+        today.setHours(0, 0, 0, 0);
+
+        if (date > today) {
+          this.value = "";
+          this.classList.add("is-invalid");
+          alert("Publication date cannot be in the future.");
+        }
+      }
+    });
+  }
+});
+
+// Large files are sent in checksummed chunks before the form itself, so a
+// dropped connection resumes where it stopped instead of starting again.
+// The upload URL and chunk size come from the data-* attributes of the script tag.
+const settings = document.currentScript.dataset;
+
+document.addEventListener("DOMContentLoaded", function () {
+  const form = document.querySelector("form[enctype='multipart/form-data']");
+  const fileInput = document.getElementById("resource_file");
+  const uploadId = document.getElementById("upload_id");
+  const csrfInput = form && form.querySelector("input[name='csrf_token']");
+  const uploadsUrl = settings.uploadsUrl;
+  const chunkSize = parseInt(settings.chunkSize, 10);
+  if (!form || !fileInput || !uploadId || !window.fetch || !(window.crypto && crypto.subtle)) {
+    return;
+  }
+  const headers = csrfInput ? { "X-CSRFToken": csrfInput.value } : {};
+  const submitButton = form.querySelector("[type='submit']");
+
+  function hex(buffer) {
+    return Array.from(new Uint8Array(buffer))
+      .map((b) => b.toString(16).padStart(2, "0"))
+      .join("");
+  }
+
+  function sleep(ms) {
+    return new Promise((resolve) => setTimeout(resolve, ms));
+  }
+
+  async function request(url, options) {
+    const response = await fetch(url, Object.assign({ credentials: "same-origin" }, options));
+    const body = response.status === 204 ? {} : await response.json();
+    if (!response.ok && body.offset === undefined) {
+      throw new Error(body.error || response.statusText);
+    }
+    return { response: response, body: body };
+  }
+
+  async function openSession(file) {
+    const key = "upload:" + [file.name, file.size, file.lastModified].join(":");
+    const known = localStorage.getItem(key);
+    if (known) {
+      try {
+        const result = await request(uploadsUrl + "/" + known, { method: "GET" });
+        return { key: key, state: result.body };
+      } catch (e) {
+        localStorage.removeItem(key);
+      }
+    }
+    const result = await request(uploadsUrl, {
+      method: "POST",
+      headers: Object.assign({ "Content-Type": "application/json" }, headers),
+      body: JSON.stringify({ filename: file.name, size: file.size, content_type: file.type }),
+    });
+    localStorage.setItem(key, result.body.id);
+    return { key: key, state: result.body };
+  }
+
+  async function send(file) {
+    const session = await openSession(file);
+    let state = session.state;
+    let failures = 0;
+    while (state.offset < state.size) {
+      const chunk = file.slice(state.offset, Math.min(state.offset + state.chunk_size, state.size));
+      const checksum = hex(await crypto.subtle.digest("SHA-256", await chunk.arrayBuffer()));
+      try {
+        const result = await request(uploadsUrl + "/" + state.id + "?offset=" + state.offset, {
+          method: "PUT",
+          headers: Object.assign({ "X-Chunk-SHA256": checksum }, headers),
+          body: chunk,
+        });
+        if (!result.response.ok) {
+          // Resume from the offset the server has (after a retry, a
+          // checksum mismatch or while the server is busy).
+          failures += 1;
+          if (failures > 5) throw new Error(result.body.error);
+          await sleep(1000 * failures);
+        } else {
+          failures = 0;
+        }
+        state = Object.assign(state, { offset: result.body.offset });
+      } catch (e) {
+        // Network error: ask where the server stands, then carry on.
+        failures += 1;
+        if (failures > 5) throw e;
+        await sleep(1000 * failures);
+        state = (await request(uploadsUrl + "/" + state.id, { method: "GET" })).body;
+      }
+      if (submitButton) {
+        submitButton.value = Math.floor((100 * state.offset) / state.size) + "%";
+      }
+    }
+    localStorage.removeItem(session.key);
+    return state.id;
+  }
+
+  form.addEventListener("submit", async function (event) {
+    const file = fileInput.files && fileInput.files[0];
+    if (!file || file.size <= chunkSize || uploadId.value) {
+      return;
+    }
+    event.preventDefault();
+    const label = submitButton ? submitButton.value : "";
+    if (submitButton) submitButton.disabled = true;
+    try {
+      uploadId.value = await send(file);
+      fileInput.value = "";
+      // The submit button shadows form.submit().
+      HTMLFormElement.prototype.submit.call(form);
+    } catch (e) {
+      alert("The upload failed: " + e.message);
+      if (submitButton) {
+        submitButton.disabled = false;
+        submitButton.value = label;
+      }
+    }
+  });
+});
@@ -0,0 +1,108 @@
+import time
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlsplit
+import pytest
+from flask import Blueprint, Flask
+from services import file_serving
+
+BLOB = 'blobs/ab/ab12cd.pdf'
+RESOURCE = SimpleNamespace(filename=BLOB, original_filename='Annual Report.pdf',
+                           content_hash='ab12cd')
+
+
+@pytest.fixture
+def app(tmp_path):
+    """A stand-in app with the download and upload routes, and no database."""
+    (tmp_path / 'blobs' / 'ab').mkdir(parents=True)
+    (tmp_path / BLOB).write_bytes(b'%PDF-1.4 test file')
+    (tmp_path / 'cover.jpg').write_bytes(b'jpeg')
+
+    app = Flask(__name__)
+    app.config.update(
+        SECRET_KEY='test', UPLOAD_FOLDER=str(tmp_path), DOWNLOAD_CACHE_SECONDS=3600,
+        UPLOAD_CACHE_SECONDS=3600, FILE_OFFLOAD=None,
+        FILE_OFFLOAD_PREFIX='/protected-uploads/', UPLOAD_URLS_SIGNED=False,
+        UPLOAD_URL_SECONDS=3600)
+    main = Blueprint('main', __name__)
+    main.add_url_rule('/download', 'download',
+                      lambda: file_serving.send_resource(RESOURCE))
+    main.add_url_rule('/uploads/<path:filename>', 'serve_upload', file_serving.send_upload)
+    app.register_blueprint(main)
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+def signed_url(app, filename):
+    with app.test_request_context():
+        return file_serving.upload_url(filename)
+
+
+def test_x_accel_redirect(app, client):
+    app.config['FILE_OFFLOAD'] = 'x-accel'
+    response = client.get('/download')
+    assert response.status_code == 200
+    assert response.headers['X-Accel-Redirect'] == f'/protected-uploads/{BLOB}'
+    assert response.data == b''
+    assert response.headers['Content-Disposition'].startswith('attachment')
+    assert 'Annual Report.pdf' in response.headers['Content-Disposition']
+    assert 'Last-Modified' in response.headers
+    assert response.cache_control.private and not response.cache_control.public
+
+
+def test_x_sendfile(app, client, tmp_path):
+    app.config['FILE_OFFLOAD'] = 'x-sendfile'
+    response = client.get('/download')
+    assert response.status_code == 200
+    assert response.headers['X-Sendfile'] == str((tmp_path / BLOB).resolve())
+    assert 'X-Accel-Redirect' not in response.headers
+    assert response.headers['Content-Disposition'].startswith('attachment')
+
+
+def test_offloaded_not_modified_drops_the_redirect(app, client):
+    app.config['FILE_OFFLOAD'] = 'x-accel'
+    last_modified = client.get('/download').headers['Last-Modified']
+    response = client.get('/download', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+    assert 'X-Accel-Redirect' not in response.headers
+
+
+def test_offloaded_upload_stays_inside_the_folder(app, client):
+    app.config['FILE_OFFLOAD'] = 'x-accel'
+    assert client.get('/uploads/cover.jpg').headers['X-Accel-Redirect'] == \
+        '/protected-uploads/cover.jpg'
+    assert client.get('/uploads/../secret.txt').status_code == 404
+
+
+def test_signed_url_is_served_privately(app, client):
+    app.config['UPLOAD_URLS_SIGNED'] = True
+    url = signed_url(app, 'cover.jpg')
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.cache_control.private and not response.cache_control.public
+    expires = int(parse_qs(urlsplit(url).query)['expires'][0])
+    assert 0 < response.cache_control.max_age <= expires - time.time() + 1
+
+
+def test_unsigned_url_is_refused(app, client):
+    app.config['UPLOAD_URLS_SIGNED'] = True
+    assert client.get('/uploads/cover.jpg').status_code == 403
+
+
+def test_tampered_signature_is_refused(app, client):
+    app.config['UPLOAD_URLS_SIGNED'] = True
+    url = signed_url(app, 'cover.jpg')
+    assert client.get(url.replace('sig=', 'sig=x')).status_code == 403
+    # A valid signature for another file does not carry over.
+    assert client.get(url.replace('cover.jpg', BLOB)).status_code == 403
+
+
+def test_expired_signature_is_refused(app, client, monkeypatch):
+    app.config['UPLOAD_URLS_SIGNED'] = True
+    url = signed_url(app, 'cover.jpg')
+    later = time.time() + 3 * app.config['UPLOAD_URL_SECONDS']
+    monkeypatch.setattr(file_serving.time, 'time', lambda: later)
+    assert client.get(url).status_code == 403
@@ -0,0 +1,39 @@
+import pytest
+from services import query_language
+from services.query_language import And, Not, Or, Term, compile_query, parse
+
+
+@pytest.fixture(autouse=True)
+def frequencies(monkeypatch):
+    # Every word equally common, so the compiled order is the query order.
+    monkeypatch.setattr(query_language, 'document_frequency', lambda token: 1)
+
+
+def test_punctuation_is_parsed_as_terms():
+    assert parse('&') == Term(None, '&', False)
+    assert parse('-') == Term(None, '-', False)
+    assert parse('""') == Term(None, '', True)
+    assert parse('Pride & Prejudice') == And((
+        Term(None, 'Pride', False), Term(None, '&', False), Term(None, 'Prejudice', False)))
+    assert parse('a OR &') == Or((Term(None, 'a', False), Term(None, '&', False)))
+    assert parse('-&') == Not(Term(None, '&', False))
+
+
+@pytest.mark.parametrize('query, fts', [
+    ('Pride & Prejudice', '("Pride"*) AND ("Prejudice"*)'),
+    ('Pride - Prejudice', '("Pride"*) AND ("Prejudice"*)'),
+    ('"" history', '"history"*'),
+    ('title:& history', '"history"*'),
+    ('-& history', '"history"*'),
+])
+def test_punctuation_terms_add_no_constraint(query, fts):
+    compiled = compile_query(parse(query))
+    assert compiled.fts == fts
+    assert compiled.filters == []
+
+
+@pytest.mark.parametrize('query', ['&', '-', '""', 'a OR &', '-&', 'title:&'])
+def test_punctuation_only_queries_match_anything(query):
+    compiled = compile_query(parse(query))
+    assert compiled.fts is None
+    assert compiled.filters == []